@@ -0,0 +1,174 @@
+# benchmark.py
+#
+# PURPOSE: Benchmark runner for the ETL loaders. Each loader variant runs in a fresh process against a freshly created
+#          database and reports wall time, rows/sec per target table and peak RSS, so regressions can be caught and loader
+#          variants (e.g. pandas vs json parsing) compared. Use generate_data.py to create data sets of any size.
+#
+# WARNING: with the postgres sink every variant drops and recreates the sparkifydb database. The default is the null sink
+#          which measures the Python parse/transform cost only.
+#
+# Included functions:
+#     memory_lookup       - return an in-memory SongLookup loaded with the song catalog
+#     run_variant         - load a data set with one loader variant and measure it (runs in a child process)
+#     benchmark           - run the selected variants one after another and collect the results
+#     print_results       - print the results as a table
+#     main                - main function parses arguments and runs the benchmark
+#
+
+import os
+import json
+import resource
+import argparse
+import contextlib
+import multiprocessing
+from queue import Empty
+from time import time
+from functools import partial
+
+def memory_lookup(cur):
+    """return an in-memory SongLookup loaded with the song catalog"""
+    
+    from song_lookup import SongLookup
+    lookup = SongLookup()
+    lookup.load(cur)
+    return lookup
+
+
+# loader variants: name -> (phase, factory returning the process_data function given a cursor, sinks supported)
+# log variants load the songs first (untimed) so that song matching does realistic work
+VARIANTS = {
+    'song_pandas':         ('song', lambda etl, cur: etl.process_song_file, None),
+    'song_json':           ('song', lambda etl, cur: etl.process_song_file2, None),
+    'log_pandas_row':      ('log', lambda etl, cur: etl.process_log_file, None),
+    'log_json_row':        ('log', lambda etl, cur: partial(etl.process_log_file_stream, chunk_size=10000), None),
+    'log_pandas_lookup':   ('log', lambda etl, cur: partial(etl.process_log_file, lookup=memory_lookup(cur)), None),
+    'log_json_lookup':     ('log', lambda etl, cur: partial(etl.process_log_file_stream, chunk_size=10000, 
+                                                            lookup=memory_lookup(cur)), None),
+    'log_pandas_bulk':     ('log', lambda etl, cur: etl.process_log_file_bulk, ('postgres',)),
+    'log_json_bulk':       ('log', lambda etl, cur: partial(etl.process_log_file_stream, chunk_size=10000,
+                                                            write_func=etl.write_log_rows_bulk), ('postgres',)),
+}
+
+PHASE_TABLES = {'song': ('song', 'artist'), 'log': ('time', 'user', 'songplay')}
+
+
+def run_variant(name, sink, data_path, results):
+    """
+    Load a data set with one loader variant and measure it (runs in a child process)
+    Parameters:
+      name - variant name (key of VARIANTS)
+      sink - database sink (see sinks.py)
+      data_path - directory holding song_data and log_data
+      results - queue to put the result dictionary on
+    """
+    
+    import etl
+    import sinks
+    import create_tables
+    
+    phase, factory, supported = VARIANTS[name]
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        cur, conn = create_tables.create_database(sink)
+        # a plain songplays table - the variants load without the partition bookkeeping of etl.py
+        create_tables.create_tables(cur, conn, sink, partition_grain='none')
+        
+        song_path = os.path.join(data_path, 'song_data')
+        log_path = os.path.join(data_path, 'log_data')
+        if phase == 'log':
+            etl.process_data(cur, conn, song_path, etl.process_song_file2)
+            
+        start_time = time()
+        etl.process_data(cur, conn, song_path if phase == 'song' else log_path, factory(etl, cur))
+        wall_time = time() - start_time
+        
+        rows = {}
+        for table in PHASE_TABLES[phase]:
+            cur.execute(etl.count_table_queries[table])
+            rows[table] = cur.fetchone()[0]
+        conn.close()
+        
+    results.put({'variant': name, 'sink': sink, 'wall_time': round(wall_time, 3),
+                 'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                 'rows': rows,
+                 'rows_per_sec': {table: round(count / wall_time, 1) if wall_time else 0.0 for table, count in rows.items()}})
+
+
+def benchmark(variants, sink, data_path, timeout=3600):
+    """
+    Run the selected variants one after another, each in a fresh process so peak RSS is measured per variant. A variant
+    that fails or runs longer than the timeout is reported and left out of the results.
+    Parameters:
+      variants - list of variant names
+      sink - database sink
+      data_path - directory holding song_data and log_data
+      timeout - seconds to wait for a variant
+    """
+    
+    context = multiprocessing.get_context('spawn')
+    all_results = []
+    for name in variants:
+        supported = VARIANTS[name][2]
+        if supported and sink not in supported:
+            print(f"Skipping variant '{name}' - it needs one of the sinks {supported}.")
+            continue
+        results = context.Queue()
+        process = context.Process(target=run_variant, args=(name, sink, data_path, results))
+        process.start()
+        try:
+            result = results.get(timeout=timeout)
+        except Empty:
+            result = None
+        process.join(timeout=10)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+        if result is None or process.exitcode != 0:
+            reason = f'exit code {process.exitcode}' if process.exitcode else f'no result within {timeout} seconds'
+            print(f"Variant '{name}' failed ({reason}) - skipped.")
+            continue
+        all_results.append(result)
+        print(f"Variant '{name}' finished in {result['wall_time']} seconds.")
+    return all_results
+
+
+def print_results(all_results):
+    """
+    Print the results as a table
+    Parameters:
+      all_results - list of result dictionaries from run_variant
+    """
+    
+    print(f"{'variant':<20}{'table':<10}{'rows':>10}{'rows/sec':>12}{'wall (s)':>10}{'peak RSS (MB)':>15}")
+    for result in all_results:
+        for table, rows in result['rows'].items():
+            print(f"{result['variant']:<20}{table:<10}{rows:>10}{result['rows_per_sec'][table]:>12}"
+                  f"{result['wall_time']:>10}{result['peak_rss_mb']:>15}")
+
+
+def main():
+    """
+    main function parses arguments and runs the benchmark
+    Parameters: none
+    """
+    
+    import sinks
+    
+    parser = argparse.ArgumentParser(description='Benchmark the ETL loader variants.')
+    parser.add_argument('data', nargs='?', default='data', help='directory holding song_data and log_data')
+    parser.add_argument('--sink', choices=sinks.SINKS, default='null',
+                        help="database sink - WARNING: postgres drops and recreates sparkifydb for every variant")
+    parser.add_argument('--variants', nargs='+', choices=list(VARIANTS), default=list(VARIANTS), help='variants to run')
+    parser.add_argument('--output', help='also write the results to this json file')
+    parser.add_argument('--timeout', type=int, default=3600, help='seconds to wait for each variant before giving up on it')
+    args = parser.parse_args()
+    
+    all_results = benchmark(args.variants, args.sink, args.data, args.timeout)
+    print_results(all_results)
+    
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(all_results, output_file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
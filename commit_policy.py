@@ -0,0 +1,111 @@
+# commit_policy.py
+#
+# PURPOSE: Transaction handling for the Sparkify ETL. Instead of autocommitting every statement the load runs in
+#          transactions committed per file, per N rows or once per run. Every file is loaded inside a savepoint so a
+#          file that fails is rolled back and logged on its own without losing the rest of the open transaction.
+#
+# Included functions:
+#     CommitPolicy        - class: decides when to commit and wraps each file in a savepoint
+#
+
+from metrics import METRICS
+
+COMMIT_MODES = ('autocommit', 'rows', 'file', 'run')
+
+
+class CommitPolicy:
+    """
+    Commit policy of a load:
+      autocommit - every statement is its own transaction (original behaviour) - a failing file stops the load
+      rows       - commit after the file that brings the rows written since the last commit to commit_rows or more
+      file       - commit after every file
+      run        - commit once at the end of the run
+    In all modes except autocommit each file is loaded inside a savepoint; a failing file is rolled back to its savepoint,
+    logged and skipped. Rollback hooks let callers resynchronise in-memory state (e.g. caches of loaded keys) afterwards.
+    """
+    
+    def __init__(self, conn, mode='file', commit_rows=10000):
+        """
+        Parameters:
+          conn - database connection
+          mode - one of COMMIT_MODES
+          commit_rows - number of rows written between commits in 'rows' mode
+        """
+        
+        if mode not in COMMIT_MODES:
+            raise ValueError(f"Unknown commit mode '{mode}' - expected one of {COMMIT_MODES}.")
+        self.conn = conn
+        self.mode = mode
+        self.commit_rows = commit_rows
+        self.rollback_hooks = []
+        self.failed_files = []
+        self._rows_at_commit = 0
+        self._in_savepoint = False
+        
+    @classmethod
+    def for_connection(cls, conn):
+        """policy matching the current session of a connection - used when the caller does not supply one"""
+        
+        return cls(conn, 'autocommit' if conn.autocommit else 'file')
+    
+    @property
+    def savepoints(self):
+        return self.mode != 'autocommit'
+        
+    def start(self):
+        """configure the session of the connection - call before any statement is executed"""
+        
+        self.conn.set_session(autocommit=not self.savepoints)
+        self._rows_at_commit = sum(METRICS.table_rows.values())
+        
+    def add_rollback_hook(self, hook):
+        """register a function called after a file has been rolled back"""
+        
+        self.rollback_hooks.append(hook)
+        
+    def begin_file(self, cur):
+        """start loading a file"""
+        
+        if self.savepoints:
+            cur.execute("SAVEPOINT load_file")
+            self._in_savepoint = True
+            
+    def rollback_file(self, cur, filepath, error):
+        """
+        Roll back a file that failed to load
+        Returns:
+          True when the file was rolled back to its savepoint and the load can continue, False when it cannot
+        """
+        
+        METRICS.count('files_failed')
+        if not self._in_savepoint:
+            return False
+        
+        cur.execute("ROLLBACK TO SAVEPOINT load_file")
+        self.failed_files.append(filepath)
+        print(f"Load failed and was rolled back for file '{filepath}'.")
+        print(error)
+        for hook in self.rollback_hooks:
+            hook()
+        return True
+    
+    def end_file(self, cur):
+        """finish loading a file and commit if the policy says so"""
+        
+        if self._in_savepoint:
+            cur.execute("RELEASE SAVEPOINT load_file")
+            self._in_savepoint = False
+            
+        if self.mode == 'file':
+            self.conn.commit()
+        elif self.mode == 'rows':
+            rows = sum(METRICS.table_rows.values())
+            if rows - self._rows_at_commit >= self.commit_rows:
+                self.conn.commit()
+                self._rows_at_commit = rows
+                
+    def finish(self):
+        """commit whatever is still open at the end of a load"""
+        
+        if self.savepoints:
+            self.conn.commit()
@@ -0,0 +1,148 @@
+# compression.py
+#
+# PURPOSE: Transparent support for compressed source files (.gz, .bz2 and .zst) in the Sparkify ETL. Files are decompressed
+#          as a stream so no file is ever inflated in memory as a whole, optionally ahead of the reader in a background thread.
+#
+# Included functions:
+#     compression_suffix - get the compression suffix of a source file ('' for plain files)
+#     source_patterns    - expand a glob pattern of plain source files to also match their compressed variants
+#     open_compressed    - open a (possibly compressed) source file for reading with streaming decompression
+#     ThreadedReader     - class: binary stream whose content is read and decompressed ahead in a background thread
+#
+
+import io
+import bz2
+import gzip
+import threading
+from queue import Queue, Full
+
+try:
+    import zstandard
+except ImportError:                    # only needed for .zst source files
+    zstandard = None
+
+COMPRESSION_SUFFIXES = ('.gz', '.bz2', '.zst')
+
+
+def _open_zstd(filepath, mode='rb'):
+    if zstandard is None:
+        raise ImportError(f"reading '{filepath}' requires the zstandard package (pip install zstandard)")
+    return zstandard.open(filepath, mode)
+
+
+OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.zst': _open_zstd}
+
+
+def compression_suffix(filepath):
+    """
+    Get the compression suffix of a source file
+    Parameters:
+      filepath - filepath to source data file
+    Returns:
+      one of COMPRESSION_SUFFIXES or '' for a plain file
+    """
+    
+    for suffix in COMPRESSION_SUFFIXES:
+        if filepath.endswith(suffix):
+            return suffix
+    return ''
+
+
+def source_patterns(pattern):
+    """
+    Expand a glob pattern of plain source files (e.g. *.json) to also match the compressed variants (*.json.gz etc.)
+    Parameters:
+      pattern - glob pattern
+    """
+    
+    if pattern.endswith('*'):          # already matches any suffix
+        return [pattern]
+    return [pattern] + [pattern + suffix for suffix in COMPRESSION_SUFFIXES]
+
+
+def open_compressed(filepath, text=True, threaded=False):
+    """
+    Open a (possibly compressed) source file for reading - the compression is taken from the file name and the content is
+    decompressed as it is read
+    Parameters:
+      filepath - filepath to source data file
+      text - return a utf-8 text stream (else a binary stream)
+      threaded - read and decompress ahead in a background thread (only used for compressed files)
+    """
+    
+    suffix = compression_suffix(filepath)
+    if not suffix:
+        return open(filepath, 'rt' if text else 'rb', encoding='utf-8' if text else None)
+    
+    stream = OPENERS[suffix](filepath, 'rb')
+    if threaded:
+        stream = io.BufferedReader(ThreadedReader(stream), buffer_size=1 << 16)
+    return io.TextIOWrapper(stream, encoding='utf-8') if text else stream
+
+
+class ThreadedReader(io.RawIOBase):
+    """
+    Binary stream whose content is read from another stream (e.g. a decompressing one) in a background thread and handed
+    over in chunks through a bounded queue. zlib, bz2 and zstandard release the GIL while decompressing so the decompression
+    runs in parallel with the parsing in the reading thread.
+    """
+    
+    def __init__(self, stream, chunk_size=1 << 20, queue_size=4):
+        """
+        Parameters:
+          stream - binary stream to read from (closed with this reader)
+          chunk_size - number of bytes read from the stream at a time
+          queue_size - number of chunks held between the background thread and the reader
+        """
+        
+        super().__init__()
+        self._stream = stream
+        self._chunks = Queue(maxsize=queue_size)
+        self._buffer = memoryview(b'')
+        self._eof = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._read_ahead, args=(chunk_size,), daemon=True)
+        self._thread.start()
+    
+    def _read_ahead(self, chunk_size):
+        """background thread: read chunks until the end of the stream - an error is handed over like a chunk"""
+        
+        try:
+            while not self._stop.is_set():
+                chunk = self._stream.read(chunk_size)
+                self._put(chunk)
+                if not chunk:
+                    return
+        except Exception as error:
+            self._put(error)
+    
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return
+            except Full:
+                continue
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, buffer):
+        if not self._buffer and not self._eof:
+            chunk = self._chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                self._eof = True
+            self._buffer = memoryview(chunk)
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]          # a view - the chunk is not copied again
+        return size
+    
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._stream.close()
+        super().close()
@@ -8,82 +8,272 @@
 #     create_database    - create and initialize development database
 #     drop_tables        - drop DWH fact and dimension tables
 #     create_tables      - create DWH fact and dimension tables
+#     defer_constraints  - drop foreign keys and secondary indexes of the DWH tables before a large load
+#     restore_constraints - add back foreign keys (NOT VALID then VALIDATE) and rebuild indexes concurrently after a load
+#     manage_partition   - truncate or detach a single partition of songplays
+#     rebuild_rollups    - recompute the rollup tables from songplays for a date range or completely
 #     main               - main function performs database initialization 
 # 
 
-import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+import argparse
+import pandas as pd
+import sinks
+from partitions import PARTITION_GRAINS, SongplayPartitions, partition_bounds, partition_name
+from song_lookup import MATCH_NORMALIZATIONS
+from sql_queries import (dwh_tables, deferrable_constraint_select, secondary_index_select, deferred_insert, deferred_select,
+                         deferred_delete, constraint_exists_select, index_valid_select, constraint_drop, constraint_add,
+                         constraint_validate, index_drop, index_drop_concurrently, constraint_add_partitioned,
+                         partitioned_table_select, rollup_range_delete, rollup_range_rebuild)
 
 
-def create_database():
+def create_database(sink=None, dsn=None):
     """
     create and initialize database
+    Parameters:
+      sink - database sink (see sinks.py - None uses the configured default)
+      dsn - Postgres connection string without the database (see sinks.py - None uses the configured default)
     """
     
-    # connect to default database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=studentdb user=student password=student")
-    conn.set_session(autocommit=True)
-    cur = conn.cursor()
-    
-    # create sparkify database with UTF8 encoding
-    cur.execute("DROP DATABASE IF EXISTS sparkifydb")
-    cur.execute("CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
+    return sinks.create_database(sink, dsn)
 
-    # close connection to default database
-    conn.close()    
-    
-    # connect to new sparkify database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
-    conn.set_session(autocommit=True)
-    cur = conn.cursor()
-    
-    return cur, conn
 
-
-def drop_tables(cur, conn):
+def drop_tables(cur, conn, sink=None):
     """
     drop DWH fact and dimension tables
     """
     
+    drop_table_queries, create_table_queries = sinks.table_queries(sink)
     for table, query in drop_table_queries.items():
         try:
             cur.execute(query)
             conn.commit()
             print(f"Drop table command succeeded for table '{table}'.") 
-        except psycopg2.Error as e:
+        except sinks.Error as e:
             print(f"Drop table command failed for table '{table}'.")
             print(e)
             conn.rollback()
             continue
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, sink=None, partition_grain='month', natural_key=False, match_normalization='exact', 
+                  user_history=False):
     """
     create DWH fact and dimension tables
+    Parameters:
+      partition_grain - range partition grain of songplays (one of PARTITION_GRAINS - postgres only)
+      natural_key - add a unique index on the natural key of songplays so reloading a file skips the rows already loaded
+      match_normalization - normalization of title and artist name in the song match key (one of MATCH_NORMALIZATIONS - 
+                            postgres only)
+      user_history - add the user_history table keeping a type 2 history of the users' state (postgres only)
     """
     
+    drop_table_queries, create_table_queries = sinks.table_queries(sink, partition_grain, natural_key, match_normalization, 
+                                                                   user_history)
     for table, query in create_table_queries.items():
         try:
             cur.execute(query)
             conn.commit()
             print(f"Create table command succeeded for table '{table}'.") 
-        except psycopg2.Error as e:
+        except sinks.Error as e:
             print(f"Create table command failed for table '{table}'.")
             print(e)
             conn.rollback()
             continue
 
 
+def defer_constraints(cur, conn):
+    """
+    drop the foreign keys and secondary indexes of the DWH tables before a large load - their definitions are saved in 
+    load_deferred in the same transaction so restore_constraints can put them back even if the load fails
+    Parameters:
+      cur - cursor
+      conn - database connection (postgres)
+    Returns:
+      number of objects deferred
+    """
+    
+    cur.execute(deferrable_constraint_select, (dwh_tables,))
+    constraints = cur.fetchall()
+    cur.execute(secondary_index_select, (dwh_tables,))
+    indexes = cur.fetchall()
+    
+    for table, name, definition in constraints:
+        cur.execute(deferred_insert, (name, 'constraint', table, definition))
+        cur.execute(constraint_drop.format(table=table, name=name))
+    for table, name, definition in indexes:
+        cur.execute(deferred_insert, (name, 'index', table, definition))
+        cur.execute(index_drop.format(name=name))
+    conn.commit()
+    
+    print(f"Deferred {len(constraints)} foreign keys and {len(indexes)} indexes for the load.")
+    return len(constraints) + len(indexes)
+
+
+def restore_constraints(cur, conn):
+    """
+    restore the objects recorded in load_deferred - indexes are rebuilt with CREATE INDEX CONCURRENTLY and foreign keys 
+    are added NOT VALID and then validated. Each object is removed from load_deferred once restored so the function can 
+    be rerun after a failure (e.g. a foreign key that does not validate because of orphan rows).
+    Parameters:
+      cur - cursor
+      conn - database connection (postgres) - switched to autocommit since concurrent index builds cannot run in a transaction
+    Returns:
+      number of objects that could not be restored
+    """
+    
+    conn.rollback()
+    conn.set_session(autocommit=True)
+    
+    cur.execute(deferred_select)
+    failed = 0
+    for name, object_type, table, definition in cur.fetchall():
+        try:
+            # partitioned tables support neither concurrent index builds nor NOT VALID foreign keys
+            cur.execute(partitioned_table_select, (table,))
+            partitioned = cur.fetchone() is not None
+            if object_type == 'index':
+                # an interrupted concurrent build leaves an invalid index behind - drop it and build again
+                cur.execute(index_valid_select, (name,))
+                result = cur.fetchone()
+                if result and not result[0]:
+                    cur.execute((index_drop if partitioned else index_drop_concurrently).format(name=name))
+                # pg_get_indexdef gives ON ONLY for a partitioned table, which would build an invalid parent-only index
+                # without the indexes of the partitions
+                definition = definition.replace(' ON ONLY ', ' ON ', 1)
+                cur.execute(definition.replace('CREATE INDEX', 'CREATE INDEX IF NOT EXISTS' if partitioned else 
+                                               'CREATE INDEX CONCURRENTLY IF NOT EXISTS', 1))
+            else:
+                cur.execute(constraint_exists_select, (name, table))
+                if cur.fetchone() is None:
+                    add_sql = constraint_add_partitioned if partitioned else constraint_add
+                    cur.execute(add_sql.format(table=table, name=name, definition=definition))
+                cur.execute(constraint_validate.format(table=table, name=name))
+            cur.execute(deferred_delete, (name,))
+            print(f"Restored {object_type} '{name}' on table {table}.")
+        except sinks.Error as e:
+            print(f"Restore failed for {object_type} '{name}' on table {table} - rerun create_tables.py --restore-constraints.")
+            print(e)
+            failed += 1
+            continue
+    return failed
+
+
+def manage_partition(cur, conn, action, date):
+    """
+    truncate or detach the songplays partition holding a date
+    Parameters:
+      cur - cursor
+      conn - database connection (postgres)
+      action - 'truncate' or 'detach'
+      date - date within the partition (e.g. 2018-11 or 2018-11-05)
+    """
+    
+    partitions = SongplayPartitions.load(cur)
+    if partitions is None:
+        print("Table songplays is not partitioned.")
+        return
+    ts = pd.Timestamp(date)
+    name = partition_name(partition_bounds(ts, partitions.grain)[0])
+    if name not in partitions.known:
+        print(f"Partition {name} of songplays does not exist.")
+        return
+    if action == 'truncate':
+        partitions.truncate(cur, ts)
+    else:
+        partitions.detach(cur, ts)
+    conn.commit()
+
+
+def rebuild_rollups(cur, conn, start=None, end=None):
+    """
+    recompute the rollup tables (plays_hourly_level, plays_daily_user) from songplays - e.g. after a backfill
+    Parameters:
+      cur - cursor
+      conn - database connection (postgres)
+      start - optional first date to rebuild (e.g. 2018-11 or 2018-11-05 - None rebuilds from the beginning)
+      end - optional date after the last date to rebuild (None rebuilds to the end)
+    """
+    
+    bounds = {'lower': pd.Timestamp(start).date() if start else '-infinity',
+              'upper': pd.Timestamp(end).date() if end else 'infinity'}
+    cur.execute(rollup_range_delete, bounds)
+    cur.execute(rollup_range_rebuild, bounds)
+    conn.commit()
+    print(f"Rebuilt the rollups from songplays for {bounds['lower']} to {bounds['upper']}.")
+
+
 def main():
     """
     main function performs database initialization
     Parameters: none
     """
     
-    cur, conn = create_database()
+    parser = argparse.ArgumentParser(description='Create the Sparkify database and DWH tables.')
+    parser.add_argument('--sink', choices=sinks.SINKS, default=sinks.DEFAULT_SINK,
+                        help="database to create (default from the SPARKIFY_SINK environment variable, else postgres)")
+    parser.add_argument('--dsn', 
+                        help="Postgres server as a libpq connection string or URI without the database (default from the "
+                             "SPARKIFY_DSN environment variable, else the local student login)")
+    parser.add_argument('--defer-constraints', action='store_true',
+                        help="do not recreate anything - drop the foreign keys and secondary indexes of the existing tables "
+                             "ahead of a large load (postgres only)")
+    parser.add_argument('--restore-constraints', action='store_true',
+                        help="do not recreate anything - restore the foreign keys and indexes dropped by --defer-constraints "
+                             "(postgres only)")
+    parser.add_argument('--partition-grain', choices=PARTITION_GRAINS, default='month',
+                        help="range partition songplays on start_time by this grain - partitions are created by etl.py "
+                             "as log dates appear ('none' creates a single table - postgres only)")
+    parser.add_argument('--natural-key', action='store_true',
+                        help="add a unique index on the songplays natural key (session_id, user_id, start_time, "
+                             "item_in_session) so rerunning a log file skips the songplays already loaded")
+    parser.add_argument('--match-normalization', choices=MATCH_NORMALIZATIONS, default='exact',
+                        help="'exact' matches log events to songs on the exact title and artist name, 'fold' ignores case "
+                             "and extra whitespace in both (postgres only)")
+    parser.add_argument('--user-history', action='store_true',
+                        help="add the user_history table - etl.py then keeps every change of a user's name, gender or level "
+                             "as a version with valid_from/valid_to (postgres only)")
+    parser.add_argument('--rebuild-rollups', nargs='*', metavar='DATE',
+                        help="do not recreate anything - recompute the rollup tables from songplays, completely or from the "
+                             "first DATE up to the second (e.g. --rebuild-rollups 2018-11-01 2018-12-01 after a backfill)")
+    parser.add_argument('--truncate-partition', metavar='DATE',
+                        help="do not recreate anything - truncate the songplays partition holding DATE (e.g. 2018-11)")
+    parser.add_argument('--detach-partition', metavar='DATE',
+                        help="do not recreate anything - detach the songplays partition holding DATE (e.g. 2018-11), "
+                             "leaving it behind as a standalone table")
+    args = parser.parse_args()
+    
+    rebuild = args.rebuild_rollups is not None
+    if rebuild and len(args.rebuild_rollups) > 2:
+        parser.error("--rebuild-rollups takes at most two dates")
+    maintenance = (args.defer_constraints or args.restore_constraints or args.truncate_partition or args.detach_partition or
+                   rebuild)
+    if maintenance:
+        if (args.sink or sinks.DEFAULT_SINK) != 'postgres':
+            parser.error("constraint and partition maintenance require the postgres sink")
+        conn = sinks.connect('postgres', dsn=args.dsn)
+        cur = conn.cursor()
+        if args.defer_constraints:
+            defer_constraints(cur, conn)
+        elif args.restore_constraints:
+            restore_constraints(cur, conn)
+        elif rebuild:
+            rebuild_rollups(cur, conn, *args.rebuild_rollups)
+        elif args.truncate_partition:
+            manage_partition(cur, conn, 'truncate', args.truncate_partition)
+        else:
+            manage_partition(cur, conn, 'detach', args.detach_partition)
+        conn.close()
+        return
+    
+    if args.match_normalization != 'exact' and (args.sink or sinks.DEFAULT_SINK) != 'postgres':
+        parser.error("--match-normalization fold requires the postgres sink")
+    if args.user_history and (args.sink or sinks.DEFAULT_SINK) != 'postgres':
+        parser.error("--user-history requires the postgres sink")
+    
+    cur, conn = create_database(args.sink, args.dsn)
     
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    drop_tables(cur, conn, args.sink)
+    create_tables(cur, conn, args.sink, args.partition_grain, args.natural_key, args.match_normalization, args.user_history)
 
     conn.close()
 
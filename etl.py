@@ -6,150 +6,1383 @@
 #
 # Included functions:
 #     process_song_file   - extract data for song and artist dimensions from source song json files
+#     transform_song_records - transform parsed song records into artist and song row batches
+#     extract_song_rows   - read source song json file into artist and song row batches
+#     read_song_shard     - stream a packed song shard (or a byte range of its blocks) as batches of song records
+#     extract_song_shard  - read a whole packed song shard (or a byte range of its blocks) into artist and song row batches
+#     load_shard_index    - read the offset index written by pack_songs.py
+#     shard_ranges        - split a packed song shard into byte ranges of whole blocks using the offset index
+#     write_song_rows     - insert artist and song row batches
 #     process_song_file2  - extract data for song and artist dimensions from source song json files - using json library instead of pandas
+#     process_song_shard  - extract data for song and artist dimensions from a packed song shard in batches
+#     truncate_timestamp  - truncate a timestamp to the grain of the time dimension
+#     time_dimension_frame - build time dimension rows computing attributes once per distinct timestamp (vectorized)
+#     extract_log_data    - read source log/event json file and derive NextSong events plus time and user subsets
+#     transform_log_data  - derive NextSong events plus time and user subsets from a dataframe of log/events
+#     extract_log_rows    - read source log/event json file into time, user and songplay row batches
+#     new_time_rows       - drop time dimension rows whose key has already been loaded
+#     latest_user_rows    - reduce a batch of user rows to the latest state of each user by event ts
+#     load_time_keys      - get the set of start_time keys already loaded into the time table
+#     write_rollups       - add a batch of inserted songplays to the rollup tables
+#     insert_songplays    - run a set based songplays insert that also updates the rollup tables
+#     backfill_songplays  - resolve the unmatched songplays against the songs loaded since a point in time
+#     write_user_rows     - upsert a batch of user rows reduced to the latest state of each user
+#     write_log_rows      - insert time, user and songplay row batches one row per statement
 #     process log_file    - extract data for user and time dimensions as well as songplay fact from source log/event json files
+#     read_json_lines     - stream a json lines file as fixed size chunks of parsed records
+#     transform_log_events - transform a chunk of log/event records into time, user and songplay row batches
+#     process_log_file_stream - same as process_log_file but streams the file one chunk at a time with constant memory
+#     copy_value          - format a single value for the Postgres COPY text format
+#     copy_rows           - stream rows to Postgres using COPY FROM STDIN via an in-memory buffer
+#     create_stage_tables - create the temporary staging tables used by the bulk load path once per connection
+#     write_log_rows_bulk - load time, user and songplay row batches via COPY into staging tables plus set based merges
+#     process_log_file_bulk - same as process_log_file but loads via COPY into staging tables plus set based merges
+#     open_source_file    - open a json or json lines source file for reading as text (optionally .gz, .bz2 or .zst compressed)
+#     read_source_file    - open a source file reading (and decompressing) ahead in the background (reader stage of the pipelined loader)
+#     stage_json_file     - copy the raw json records of a source file into a staging table
+#     transform_staged_data - fill the DWH tables from the staging tables with set based SQL
+#     get_files           - get all json files found under a directory
+#     file_signature      - get size, modification time and content hash of a source file
+#     manifest_path       - key a source file in the load manifest by its relative path
+#     filter_loaded_files - compare source files against the load manifest and keep only new or changed ones
+#     record_file         - record a source file and its load status in the load manifest
+#     report_progress     - print file progress at most every PROGRESS_INTERVAL seconds
+#     load_file           - load a single source file inside the savepoint of the commit policy and record it in the manifest
 #     process_data        - utility function to handle os file processing for loading data
+#     extract_file_batch  - worker task that parses and transforms a group of files into row batches
+#     write_extracted     - write the row batches of a file parsed in another thread or process, or raise its parse error
+#     process_data_parallel - same as process_data but parses files in a pool of worker processes
+#     pipeline_put        - put an item on a bounded pipeline queue honouring backpressure and shutdown
+#     pipeline_get        - take the next item from a pipeline queue honouring shutdown
+#     pipeline_stage      - run one stage (reader or transform) of the pipelined loader in a thread
+#     process_data_pipelined - same as process_data but reads, parses and writes files concurrently in a threaded pipeline
+#     process_data_writers - same as process_data but writes the files' time, songplay and rollup rows over a pool of connections
 #     quality check       - perform basic quality check by counting rows in DWH tables
 #     main                - main function performs ETL load
 #  
 
 import os
 import glob
-import psycopg2
 import pandas as pd
 import json
+import hashlib
+import io
+import gzip
+import argparse
+from functools import partial
+from collections import deque, Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from queue import Queue, Empty, Full
+from threading import Thread, Event, local
 from time import time  
+from datetime import datetime, date, timedelta
 from sql_queries import *
+from song_lookup import SongLookup, match_normalization, song_match_key, event_length_key
+import sinks
+from metrics import METRICS, InstrumentedConnection
+from prepared import PreparedConnection
+from commit_policy import COMMIT_MODES, CommitPolicy
+from create_tables import defer_constraints, restore_constraints
+from partitions import SongplayPartitions
+from user_history import UserHistory
+from song_cache import SongCache, source_fingerprint
+from compression import open_compressed, source_patterns, compression_suffix, ThreadedReader
 
+EPOCH = datetime(1970, 1, 1)    # log/event ts values are milliseconds since the epoch (UTC)
+TIME_GRAINS = {'millisecond': 'ms', 'second': 's', 'minute': 'min', 'hour': '60min'}   # time dimension grain -> pandas frequency
+PROGRESS_INTERVAL = 10     # seconds between file progress reports
+SONG_SHARD_PATTERN = 'songs-*.jsonl*'    # file names written by pack_songs.py
+SONG_SHARD_INDEX = 'index.json'          # offset index written by pack_songs.py
 
-def process_song_file(cur, filepath):
+
+def process_song_file(cur, filepath, lookup=None):
     """
     Extract data for song and artist dimensions from source song json files
     Parameters:
       cur - cursor
       filepath - filepath to source data files
+      lookup - optional SongLookup to add the song to as it is parsed
     """ 
     
     # open song file and read single record
-    df_song = pd.read_json(filepath, lines=True)    
+    with METRICS.timer('parse'), open_source_file(filepath) as song_file:
+        df_song = pd.read_json(song_file, lines=True)    
 
     # extract and process artist subset from df_song
-    artist_data = pd.DataFrame(df_song, columns = ['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']).values[0].tolist()
+    with METRICS.timer('transform'):
+        artist_data = pd.DataFrame(df_song, columns = ['artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude']).values[0].tolist()
     # insert artist record
-    cur.execute(artist_table_insert, artist_data)  
+    with METRICS.timer('write'):
+        cur.execute(artist_table_insert, artist_data)  
     
     # extract and process song subset from df_song
-    song_data = pd.DataFrame(df_song, columns = ['song_id', 'title', 'artist_id', 'year', 'duration']).values[0].tolist()
+    with METRICS.timer('transform'):
+        song_data = pd.DataFrame(df_song, columns = ['song_id', 'title', 'artist_id', 'year', 'duration']).values[0].tolist()
     # insert song record
-    cur.execute(song_table_insert, song_data)
+    with METRICS.timer('write'):
+        cur.execute(song_table_insert, song_data)
+    
+    if lookup is not None:
+        lookup.add(song_data[1], artist_data[1], song_data[4], song_data[0], song_data[2])
     
     
-def process_song_file2(cur, filepath):
+def transform_song_records(records):
     """
-    Extract data for song and artist dimensions from source song json files - using json library instead of pandas
+    Transform parsed song records into row batches for the artist and song dimensions
     Parameters:
-      cur - cursor
-      filepath - filepath to source data files
+      records - list of song records (dictionaries)
+    Returns:
+      dictionary of table name to list of row tuples (artist, song)
+    """ 
+    
+    rows = {'artist': [], 'song': []}
+    for df_song in records:
+        # extract artist and song subsets from df_song
+        rows['artist'].append(tuple(df_song[k] for k in ('artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude')))
+        rows['song'].append(tuple(df_song[k] for k in ('song_id', 'title', 'artist_id', 'year', 'duration')))
+    
+    return rows
+
+
+def extract_song_rows(filepath):
+    """
+    Read a source song json file into row batches for the artist and song dimensions - using json library instead of pandas
+    Parameters:
+      filepath - filepath to source data file (or the file object streaming it - see read_source_file)
+    Returns:
+      dictionary of table name to list of row tuples (artist, song)
     """ 
     
     # open song file and read single record
-    with open(filepath) as json_file:
-        df_song = json.load(json_file)
+    with METRICS.timer('parse'):
+        with filepath if hasattr(filepath, 'read') else open_source_file(filepath) as json_file:
+            df_song = json.load(json_file)
         
-    # extract and process artist subset from df_song
-    artist_data = list({k: df_song[k] for k in ('artist_id', 'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude')}.values())
-    # insert artist record
-    cur.execute(artist_table_insert, artist_data)      
+    with METRICS.timer('transform'):
+        return transform_song_records([df_song])
+
+
+def read_song_shard(filepath, batch_size=10000, offset=0, end=None):
+    """
+    Stream a packed song shard (json lines, optionally compressed - see pack_songs.py) as batches of song records
+    Parameters:
+      filepath - filepath to shard file
+      batch_size - number of song records per batch
+      offset - byte offset of a block start taken from the offset index (0 reads from the start of the shard)
+      end - byte offset of the block start to stop at (None reads to the end of the shard)
+    """ 
+    
+    if offset == 0 and end is None:
+        text_file = open_source_file(filepath)
+    else:
+        # a range of whole blocks - every block of a compressed shard is a gzip member of its own
+        with open(filepath, 'rb') as raw_file:
+            raw_file.seek(offset)
+            data = raw_file.read() if end is None else raw_file.read(end - offset)
+        if compression_suffix(filepath) == '.gz':
+            data = gzip.decompress(data)
+        text_file = io.StringIO(data.decode('utf-8'))
         
-    # extract and process song subset from df_song
-    song_data = list({k: df_song[k] for k in ('song_id', 'title', 'artist_id', 'year', 'duration')}.values())
-    # insert song record
-    cur.execute(song_table_insert, song_data)
+    with text_file:
+        batch = []
+        for line in text_file:
+            batch.append(json.loads(line))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+            
 
+def extract_song_shard(filepath, offset=0, end=None):
+    """
+    Read a whole packed song shard, or the byte range of its blocks given by shard_ranges, into row batches for the artist 
+    and song dimensions (used by process_data_parallel)
+    Parameters:
+      filepath - filepath to shard file
+      offset - byte offset of the first block to read
+      end - byte offset of the block to stop at (None reads to the end of the shard)
+    """ 
     
-def process_log_file(cur, filepath):
+    rows = {'artist': [], 'song': []}
+    for records in METRICS.timed(read_song_shard(filepath, offset=offset, end=end), 'parse'):
+        with METRICS.timer('transform'):
+            batch = transform_song_records(records)
+        rows['artist'].extend(batch['artist'])
+        rows['song'].extend(batch['song'])
+    return rows
+
+
+def load_shard_index(path):
     """
-    extract data for user and time dimensions as well as songplay fact from source log/event json files
+    Read the offset index pack_songs.py writes next to the song shards
+    Parameters:
+      path - directory of the song shards
+    Returns:
+      dictionary of shard file name to its index entry (size, records and [block start, byte offset] of every block) - 
+      empty when the shards have no index
+    """ 
+    
+    index_path = os.path.join(path, SONG_SHARD_INDEX)
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as index_file:
+        return {shard['file']: shard for shard in json.load(index_file)['shards']}
+
+
+def shard_ranges(filepath, parts, index):
+    """
+    Split a packed song shard into byte ranges of whole blocks so separate workers can parse one shard (see 
+    process_data_parallel)
+    Parameters:
+      filepath - filepath to shard file
+      parts - maximum number of ranges
+      index - offset index of the shards (see load_shard_index)
+    Returns:
+      list of (filepath, offset, end) ranges - the whole shard as one range when it has no index entry or was rewritten 
+      since the index (its size differs)
+    """ 
+    
+    entry = index.get(os.path.basename(filepath))
+    if entry is None or entry.get('size') != os.path.getsize(filepath) or parts < 2:
+        return [(filepath, 0, None)]
+    
+    offsets = [offset for block_start, offset in entry['blocks']]
+    step = -(-len(offsets) // parts)
+    starts = offsets[::step]
+    return [(filepath, start, end) for start, end in zip(starts, starts[1:] + [None])]
+
+
+def write_song_rows(cur, rows, lookup=None):
+    """
+    Insert artist and song row batches produced by extract_song_rows
+    Parameters:
+      cur - cursor
+      rows - dictionary of table name to list of row tuples
+      lookup - optional SongLookup to add the songs to as they are loaded
+    """ 
+    
+    with METRICS.timer('write'):
+        artist_names = {}
+        for artist_data in rows['artist']:
+            cur.execute(artist_table_insert, artist_data)
+            artist_names[artist_data[0]] = artist_data[1]
+
+        for song_data in rows['song']:
+            cur.execute(song_table_insert, song_data)
+            if lookup is not None:
+                lookup.add(song_data[1], artist_names.get(song_data[2]), song_data[4], song_data[0], song_data[2])
+    
+    
+def process_song_file2(cur, filepath, lookup=None):
+    """
+    Extract data for song and artist dimensions from source song json files - using json library instead of pandas
     Parameters:
       cur - cursor
       filepath - filepath to source data files
+      lookup - optional SongLookup to add the song to as it is parsed
+    """ 
+    
+    write_song_rows(cur, extract_song_rows(filepath), lookup)
+
+
+def process_song_shard(cur, filepath, lookup=None, batch_size=10000):
+    """
+    Extract data for song and artist dimensions from a packed song shard one batch of songs at a time
+    Parameters:
+      cur - cursor
+      filepath - filepath to shard file
+      lookup - optional SongLookup to add the songs to as they are parsed
+      batch_size - number of song records per batch
+    """ 
+    
+    for records in METRICS.timed(read_song_shard(filepath, batch_size), 'parse'):
+        with METRICS.timer('transform'):
+            rows = transform_song_records(records)
+        write_song_rows(cur, rows, lookup)
+
+    
+def truncate_timestamp(timestamp, time_grain):
+    """
+    Truncate a timestamp to the grain of the time dimension
+    Parameters:
+      timestamp - datetime of a log/event
+      time_grain - grain of the time dimension (one of TIME_GRAINS)
+    """ 
+    
+    if time_grain == 'second':
+        return timestamp.replace(microsecond=0)
+    if time_grain == 'minute':
+        return timestamp.replace(second=0, microsecond=0)
+    if time_grain == 'hour':
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp
+
+
+def time_dimension_frame(timestamps):
+    """
+    Build time dimension rows computing the attributes once per distinct timestamp (vectorized with pandas)
+    Parameters:
+      timestamps - iterable of timestamps already truncated to the time dimension grain
+    """ 
+    
+    keys = pd.DatetimeIndex(pd.unique(pd.Series(timestamps, dtype='datetime64[ns]')))
+    
+    return pd.DataFrame({'timestamp': keys,
+                         'hour': keys.hour,
+                         'day': keys.day,
+                         'week': keys.isocalendar().week.to_numpy(dtype='int64'),
+                         'month': keys.month,
+                         'year': keys.year,
+                         'weekday': keys.weekday})     # Monday=0, Sunday=6.   
+
+
+def extract_log_data(filepath, time_grain='millisecond'):
+    """
+    Read source log/event json file and derive the NextSong events plus the time and user subsets
+    Parameters:
+      filepath - filepath to source data file (or the file object streaming it - see read_source_file)
+      time_grain - grain of the time dimension - songplay timestamps are truncated to match (one of TIME_GRAINS)
+    Returns:
+      df_log - dataframe of NextSong events augmented with a datetime version of the timestamp
+      time_df - dataframe of time dimension rows (one per distinct timestamp)
+      user_df - dataframe of user dimension rows plus the event ts
     """ 
     
     # open log file    
-    df_log = pd.read_json(filepath, lines=True)
+    with METRICS.timer('parse'):
+        with filepath if hasattr(filepath, 'read') else open_source_file(filepath) as log_file:
+            df_log = pd.read_json(log_file, lines=True)
+    
+    with METRICS.timer('transform'):
+        return transform_log_data(df_log, time_grain)
+
+
+def transform_log_data(df_log, time_grain='millisecond'):
+    """
+    Derive the NextSong events plus the time and user subsets from a dataframe of log/events (see extract_log_data)
+    Parameters:
+      df_log - dataframe of log/events as read from a source file
+      time_grain - grain of the time dimension (one of TIME_GRAINS)
+    """ 
     
     df_log = df_log.loc[df_log['page'] == 'NextSong']    # filter dataframe to only include rows with page == 'NextSong'
     
     df_log['timestamp'] = pd.to_datetime(df_log['ts'], unit = 'ms')   # augment dataframe with a datetime version of the timestamp
+    if time_grain != 'millisecond':
+        df_log['timestamp'] = df_log['timestamp'].dt.floor(TIME_GRAINS[time_grain])
     
     # extract and process time subset from log data
-    time_df = pd.DataFrame(df_log['timestamp'])   # just extract timestamp into a new dataframe
-    time_df['hour'] = time_df['timestamp'].dt.hour
-    time_df['day'] = time_df['timestamp'].dt.day
-    time_df['week'] = time_df['timestamp'].dt.week
-    time_df['month'] = time_df['timestamp'].dt.month
-    time_df['year'] = time_df['timestamp'].dt.year
-    time_df['weekday'] = time_df['timestamp'].dt.weekday     # Monday=0, Sunday=6.   
+    time_df = time_dimension_frame(df_log['timestamp'])
     
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
-
     # extract and process user subset from log data
-    user_df = pd.DataFrame(df_log, columns = ['userId', 'firstName', 'lastName', 'gender', 'level'])
+    user_df = pd.DataFrame(df_log, columns = ['userId', 'firstName', 'lastName', 'gender', 'level', 'ts'])
+    
+    return df_log, time_df, user_df
+
+    
+def extract_log_rows(filepath, time_grain='millisecond'):
+    """
+    Read a source log/event json file into row batches for the time and user dimensions and the (unresolved) songplay fact
+    Parameters:
+      filepath - filepath to source data file (or the file object streaming it - see read_source_file)
+      time_grain - grain of the time dimension (one of TIME_GRAINS)
+    Returns:
+      dictionary of table name to list of row tuples (time, user, songplay) - songplay rows carry song, artist and length
+      in place of song_id and artist_id which are resolved when the rows are written, user rows end with the event ts
+    """ 
+    
+    df_log, time_df, user_df = extract_log_data(filepath, time_grain)
+    
+    with METRICS.timer('transform'):
+        songplay_df = pd.DataFrame(df_log, columns = ['timestamp', 'userId', 'level', 'song', 'artist', 'length', 
+                                                      'sessionId', 'itemInSession', 'location', 'userAgent'])
+
+        return {'time': list(time_df.itertuples(index=False, name=None)),
+                'user': list(user_df.itertuples(index=False, name=None)),
+                'songplay': list(songplay_df.itertuples(index=False, name=None))}
 
-    for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
 
-    # extract and process songplay subset from logs 
-    for index, row in df_log.iterrows():
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
+def new_time_rows(time_rows, time_keys):
+    """
+    Drop time dimension rows whose key has already been loaded and remember the keys of the remaining ones
+    Parameters:
+      time_rows - list of time dimension row tuples
+      time_keys - set of start_time keys already in the time table (None loads every row)
+    """ 
+    
+    if time_keys is None:
+        return time_rows
+    time_rows = [time_data for time_data in time_rows if time_data[0] not in time_keys]
+    time_keys.update(time_data[0] for time_data in time_rows)
+    return time_rows
+
+
+def latest_user_rows(user_rows):
+    """
+    Reduce a batch of user rows (one per event) to the latest state of each user by event ts - so every user is upserted
+    once per batch instead of once per event
+    Parameters:
+      user_rows - list of user row tuples ending with the event ts
+    Returns:
+      list of users dimension row tuples (without ts) in user_id order - concurrent writers lock the users in the same order
+    """ 
+    
+    latest = {}
+    for user_data in user_rows:
+        current = latest.get(user_data[0])
+        if current is None or user_data[5] >= current[5]:        # on equal ts the later event in the file wins
+            latest[user_data[0]] = user_data
+    return [latest[user_id][:5] for user_id in sorted(latest)]
+
+
+def load_time_keys(cur):
+    """
+    Get the set of start_time keys already loaded into the time table
+    Parameters:
+      cur - cursor
+    """ 
+    
+    cur.execute(time_key_select)
+    return {start_time for start_time, in cur.fetchall()}
+
+
+def write_rollups(cur, songplays):
+    """
+    Add a batch of inserted songplays to the rollup tables - one upsert per hour and level and per day and user
+    Parameters:
+      cur - cursor
+      songplays - list of (start_time, user_id, level) of the songplays inserted
+    """ 
+    
+    hourly, daily = Counter(), Counter()
+    for start_time, user_id, level in songplays:
+        hourly[(datetime(start_time.year, start_time.month, start_time.day, start_time.hour), level or 'unknown')] += 1
+        daily[(date(start_time.year, start_time.month, start_time.day), user_id)] += 1
+    
+    # in key order so concurrent writers lock the rollup rows in the same order
+    with METRICS.timer('write'):
+        cur.executemany(hourly_level_upsert, [key + (plays,) for key, plays in sorted(hourly.items())])
+        cur.executemany(daily_user_upsert, [key + (plays,) for key, plays in sorted(daily.items())])
+
+
+def insert_songplays(cur, insert_sql, params=None):
+    """
+    Run a set based songplays insert (merge or ELT transform) wrapped so the rollup tables are updated from the rows it
+    inserted in the same statement
+    Parameters:
+      cur - cursor
+      insert_sql - INSERT INTO songplays ... SELECT statement
+      params - optional statement parameters
+    Returns:
+      number of songplays inserted
+    """ 
+    
+    cur.execute(songplay_rollup_insert.format(insert=insert_sql.strip()), params)
+    inserted = (cur.fetchone() or [0])[0]
+    if inserted:
+        METRICS.add_rows('songplays', inserted)
+    return inserted
+
+
+def backfill_songplays(cur, since, start=None, end=None):
+    """
+    Resolve the songplays that matched no song when they were loaded against the songs loaded since a point in time - one
+    set based UPDATE ... FROM join probing only the unmatched songplays (postgres)
+    Parameters:
+      cur - cursor
+      since - songs with a loaded_at at or after this timestamp count as new
+      start - optional first date of the songplays to resolve (e.g. 2018-11 or 2018-11-05 - None starts at the beginning)
+      end - optional date after the last date to resolve (None resolves to the end)
+    Returns:
+      number of songplays resolved
+    """ 
+    
+    bounds = {'since': since,
+              'lower': pd.Timestamp(start).to_pydatetime() if start else '-infinity',
+              'upper': pd.Timestamp(end).to_pydatetime() if end else 'infinity'}
+    with METRICS.timer('lookup'):
+        cur.execute(songplay_backfill_update, bounds)
+        resolved = cur.fetchall()
+    
+    for partition, rows in resolved:
+        print(f"Backfill resolved {rows} songplays in {partition}.")
+    total = sum(rows for partition, rows in resolved)
+    METRICS.count('songplays_backfilled', total)
+    if total:
+        METRICS.add_rows('songplays', total)
+    return total
+
+
+def write_user_rows(cur, user_rows, user_history=None):
+    """
+    Upsert a batch of user rows reduced to the latest state of each user with one multi-row statement (see 
+    sinks.execute_values)
+    Parameters:
+      cur - cursor
+      user_rows - list of user row tuples ending with the event ts
+      user_history - optional UserHistory - writes the changes of the users' state to user_history
+    """ 
+    
+    with METRICS.timer('write'):
+        sinks.execute_values(cur, user_table_upsert, user_table_insert, latest_user_rows(user_rows))
+        if user_history is not None:
+            user_history.write(cur, user_rows)
+
+
+def write_log_rows(cur, rows, lookup=None, time_keys=None, partitions=None, user_history=None):
+    """
+    Insert time, user and songplay row batches produced by extract_log_rows one row per statement - users are reduced to
+    their latest state and upserted once per batch
+    Parameters:
+      cur - cursor
+      rows - dictionary of table name to list of row tuples
+      lookup - optional SongLookup used to resolve song_id/artist_id in memory instead of querying song_select per event
+      time_keys - optional set of time keys already loaded - rows for those keys are skipped instead of conflicting
+      partitions - optional SongplayPartitions - creates missing songplays partitions and applies a target partition
+      user_history - optional UserHistory - writes the changes of the users' state to user_history
+    """ 
+    
+    if partitions is not None:
+        rows = partitions.prepare(cur, rows)
+    inserted = []
+    
+    # time keys in order so concurrent writers lock them in the same order
+    with METRICS.timer('write'):
+        for time_data in sorted(new_time_rows(rows['time'], time_keys), key=lambda time_data: time_data[0]):
+            cur.execute(time_table_insert, time_data)
+
+    write_user_rows(cur, rows['user'], user_history)
+
+    for start_time, user_id, level, song, artist, length, session_id, item_in_session, location, user_agent in rows['songplay']:
+        # get songid and artistid from the in-memory lookup or from song and artist tables
+        with METRICS.timer('lookup'):
+            if lookup is not None:
+                songid, artistid = lookup.lookup(cur, song, artist, length)
+                results = (songid, artistid) if songid else None
+            else:
+                cur.execute(song_select, (song, artist, length))
+                results = cur.fetchone()
     
         if results:
             songid, artistid = results
-            # would not include this in production code but this is helpful since the test data has so few matches!
-            print(f"Found match: song_id='{results[0]}', artist_id='{results[1]}' " +
-                  f"- using criteria: song='{row.song}', artist='{row.artist}', length='{row.length}'.")
+            METRICS.count('songplays_matched')       # summarised at the end of the run
         else:
             songid, artistid = None, None
+        METRICS.count('songplays')
         
         # insert songplay record
-        songplay_data = (row.timestamp, row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent)
-        cur.execute(songplay_table_insert, songplay_data)
+        # an unmatched songplay keeps its match key for backfill_songplays
+        songplay_data = (start_time, user_id, level, songid, artistid, session_id, item_in_session, location, user_agent,
+                         songid, song, artist, length)
+        with METRICS.timer('write'):
+            cur.execute(songplay_table_insert, songplay_data)
+        if cur.rowcount > 0:                       # not skipped by the natural key
+            inserted.append((start_time, user_id, level))
+    
+    write_rollups(cur, inserted)
+
+    
+def process_log_file(cur, filepath, lookup=None, time_grain='millisecond', time_keys=None, partitions=None, user_history=None):
+    """
+    extract data for user and time dimensions as well as songplay fact from source log/event json files
+    Parameters:
+      cur - cursor
+      filepath - filepath to source data files
+      lookup - optional SongLookup used to resolve song_id/artist_id in memory instead of querying song_select per event
+      time_grain - grain of the time dimension (one of TIME_GRAINS)
+      time_keys - optional set of time keys already loaded
+      partitions - optional SongplayPartitions - creates missing songplays partitions and applies a target partition
+      user_history - optional UserHistory - writes the changes of the users' state to user_history
+    """ 
+    
+    write_log_rows(cur, extract_log_rows(filepath, time_grain), lookup, time_keys, partitions, user_history)
 
 
-def process_data(cur, conn, filepath, func):
+def read_json_lines(filepath, chunk_size=10000):
     """
-    utility function to handle os file processing for loading data
+    Stream a json lines file as fixed size chunks of parsed records so memory use does not grow with the file size - a
+    compressed file is decompressed ahead of the parser in a background thread
+    Parameters:
+      filepath - filepath to source data file
+      chunk_size - number of records per chunk
+    """ 
+    
+    chunk = []
+    with open_source_file(filepath, threaded=True) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            chunk.append(json.loads(line))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def transform_log_events(events, time_grain='millisecond'):
+    """
+    Transform a chunk of parsed log/event records into time, user and songplay row batches - same rows as extract_log_rows
+    but built without reading the file into pandas
+    Parameters:
+      events - list of log/event records (dictionaries)
+      time_grain - grain of the time dimension (one of TIME_GRAINS)
+    """ 
+    
+    with METRICS.timer('transform'):
+        return _transform_log_events(events, time_grain)
+
+
+def _transform_log_events(events, time_grain):
+    """transform_log_events without the stage timer"""
+    
+    rows = {'time': [], 'user': [], 'songplay': []}
+    
+    for event in events:
+        if event['page'] != 'NextSong':           # only include rows with page == 'NextSong'
+            continue
+            
+        timestamp = truncate_timestamp(EPOCH + timedelta(milliseconds=event['ts']), time_grain)
+        rows['time'].append(timestamp)
+        rows['user'].append((event['userId'], event['firstName'], event['lastName'], event['gender'], event['level'], 
+                             event['ts']))
+        rows['songplay'].append((timestamp, event['userId'], event['level'], event['song'], event['artist'], event['length'], 
+                                 event['sessionId'], event['itemInSession'], event['location'], event['userAgent']))
+        
+    # time attributes are computed once per distinct timestamp in the chunk
+    rows['time'] = list(time_dimension_frame(rows['time']).itertuples(index=False, name=None))
+        
+    return rows
+
+
+def process_log_file_stream(cur, filepath, lookup=None, chunk_size=10000, write_func=None, time_grain='millisecond', 
+                            time_keys=None, partitions=None, user_history=None):
+    """
+    extract data for user and time dimensions as well as songplay fact from source log/event json files - streaming the file
+    through a read -> filter/transform -> load pipeline one chunk at a time so peak memory is flat whatever the file size
+    Parameters:
+      cur - cursor
+      filepath - filepath to source data files
+      lookup - optional SongLookup used to resolve song_id/artist_id in memory
+      chunk_size - number of log/event records read and loaded per chunk
+      write_func - function to load each chunk of row batches (write_log_rows - the default - or write_log_rows_bulk)
+      time_grain - grain of the time dimension (one of TIME_GRAINS)
+      time_keys - optional set of time keys already loaded
+      partitions - optional SongplayPartitions - creates missing songplays partitions and applies a target partition
+      user_history - optional UserHistory - writes the changes of the users' state to user_history
+    """ 
+    
+    write_func = write_func or write_log_rows
+    for events in METRICS.timed(read_json_lines(filepath, chunk_size), 'parse'):
+        write_func(cur, transform_log_events(events, time_grain), lookup, time_keys, partitions, user_history)
+
+
+def copy_value(value):
+    """
+    Format a single value for the Postgres COPY text format (tab delimited, \\N for null)
+    Parameters:
+      value - python/pandas value to format
+    """ 
+    
+    if value is None or value != value:          # None or NaN both map to null
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(cur, copy_sql, rows):
+    """
+    Stream rows to Postgres using COPY FROM STDIN via an in-memory buffer
+    Parameters:
+      cur - cursor
+      copy_sql - COPY ... FROM STDIN statement naming the target table and columns
+      rows - iterable of row tuples in the same column order as copy_sql
+    """ 
+    
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(copy_value(value) for value in row) + '\n')
+    buffer.seek(0)
+    cur.copy_expert(copy_sql, buffer)
+    
+    
+def create_stage_tables(cur, conn):
+    """
+    Create the temporary staging tables used by the bulk (COPY) load path - once per connection before the load. They are
+    committed right away so the rollback of a failed file cannot drop them, and write_log_rows_bulk only truncates them.
     Parameters:
       cur - cursor
       conn - database connection
+    """ 
+    
+    for table, query in stage_table_queries.items():
+        cur.execute(query)
+    conn.commit()
+
+
+def write_log_rows_bulk(cur, rows, lookup=None, time_keys=None, partitions=None, user_history=None):
+    """
+    Load time, user and songplay row batches produced by extract_log_rows using COPY into staging tables and set based merges
+    - the staging tables must have been created on the connection (see create_stage_tables)
+    Parameters:
+      cur - cursor
+      rows - dictionary of table name to list of row tuples
+      lookup - optional SongLookup; when given songplays are resolved in memory and merged without the song join
+      time_keys - optional set of time keys already loaded - rows for those keys are not copied at all
+      partitions - optional SongplayPartitions - creates missing songplays partitions and applies a target partition
+      user_history - optional UserHistory - writes the changes of the users' state to user_history
+    """ 
+    
+    if partitions is not None:
+        rows = partitions.prepare(cur, rows)
+    
+    cur.execute(stage_table_truncate)
+    
+    # time rows are identical for a given timestamp so any duplicate can be dropped
+    time_rows = {time_data[0]: time_data for time_data in new_time_rows(rows['time'], time_keys)}
+    with METRICS.timer('write'):
+        copy_rows(cur, time_stage_copy, time_rows.values())
+        cur.execute(time_table_merge)
+    
+    # the merge can only update a user once so keep the latest row per user
+    if rows['user']:
+        with METRICS.timer('write'):
+            copy_rows(cur, user_stage_copy, latest_user_rows(rows['user']))
+            cur.execute(user_table_merge)
+            if user_history is not None:
+                user_history.write(cur, rows['user'])
+    
+    if lookup is not None:
+        with METRICS.timer('lookup'):
+            songplay_rows = []
+            for seq, (start_time, user_id, level, song, artist, length, session_id, item_in_session, location, 
+                      user_agent) in enumerate(rows['songplay']):
+                songid, artistid = lookup.lookup(cur, song, artist, length)
+                match_key = None if songid else song_match_key(song, artist, event_length_key(length), lookup.normalization)
+                songplay_rows.append((seq, start_time, user_id, level, songid, artistid, session_id, item_in_session, location, 
+                                      user_agent, match_key))
+        METRICS.count('songplays', len(songplay_rows))
+        METRICS.count('songplays_matched', sum(1 for songplay_data in songplay_rows if songplay_data[4]))
+        with METRICS.timer('write'):
+            copy_rows(cur, songplay_resolved_stage_copy, songplay_rows)
+            insert_songplays(cur, songplay_resolved_merge)
+        return
+    
+    # seq preserves the file order of the events so songplay_id is assigned as in the single row path
+    with METRICS.timer('write'):
+        copy_rows(cur, songplay_stage_copy, ((seq,) + songplay_data for seq, songplay_data in enumerate(rows['songplay'])))
+    with METRICS.timer('lookup'):              # the merge resolves the songs with a join
+        insert_songplays(cur, songplay_table_merge)
+
+
+def process_log_file_bulk(cur, filepath, lookup=None, time_grain='millisecond', time_keys=None, partitions=None, 
+                          user_history=None):
+    """
+    extract data for user and time dimensions as well as songplay fact from source log/event json files - using COPY into 
+    staging tables and set based merges instead of single row inserts
+    Parameters:
+      cur - cursor
       filepath - filepath to source data files
-      func - function to invoke to process data (i.e. process_log_file or process_song_file)
+      lookup - optional SongLookup; when given songplays are resolved in memory and merged without the song join
+      time_grain - grain of the time dimension (one of TIME_GRAINS)
+      time_keys - optional set of time keys already loaded
+      partitions - optional SongplayPartitions - creates missing songplays partitions and applies a target partition
+      user_history - optional UserHistory - writes the changes of the users' state to user_history
+    """ 
+    
+    write_log_rows_bulk(cur, extract_log_rows(filepath, time_grain), lookup, time_keys, partitions, user_history)
+
+
+def open_source_file(filepath, threaded=False):
+    """
+    Open a json or json lines source file for reading as text - files ending with .gz, .bz2 or .zst are decompressed as 
+    they are read (see compression.py)
+    Parameters:
+      filepath - filepath to source data file
+      threaded - decompress ahead of the reader in a background thread
+    """ 
+    
+    return open_compressed(filepath, threaded=threaded)
+
+
+def read_source_file(filepath):
+    """
+    Open a source file for the parse stage of process_data_pipelined - the reader stage. Every file starts being read ahead 
+    in a background thread right away, a bounded number of chunks at a time, and compressed files (.gz, .bz2 or .zst) are 
+    decompressed there too, so the parse stage rarely waits on the disk or the decompression and no file is ever inflated 
+    in memory as a whole
+    Parameters:
+      filepath - filepath to source data file
+    Returns:
+      binary file object streaming the content of the file - closed by the parse stage
+    """ 
+    
+    with METRICS.timer('read'):
+        if compression_suffix(filepath):
+            return open_compressed(filepath, text=False, threaded=True)
+        return io.BufferedReader(ThreadedReader(open(filepath, 'rb')), buffer_size=1 << 16)
+
+
+def stage_json_file(cur, filepath, copy_sql, chunk_size=10000):
+    """
+    Copy the raw json records of a source file (one record per line) into a staging table without parsing them in Python
+    Parameters:
+      cur - cursor
+      filepath - filepath to source data file (song file, song shard or log file)
+      copy_sql - COPY ... FROM STDIN statement for the staging table (i.e. staging_songs_copy or staging_events_copy)
+      chunk_size - number of records sent per COPY so memory use stays flat for large files
+    """ 
+    
+    chunk = []
+    with open_source_file(filepath, threaded=True) as f:
+        for line in METRICS.timed(f, 'read'):
+            line = line.strip()
+            if not line:
+                continue
+            chunk.append((line,))
+            if len(chunk) >= chunk_size:
+                with METRICS.timer('write'):
+                    copy_rows(cur, copy_sql, chunk)
+                chunk = []
+    if chunk:
+        with METRICS.timer('write'):
+            copy_rows(cur, copy_sql, chunk)
+
+
+def transform_staged_data(cur, time_grain='millisecond', partitions=None, user_history=None):
+    """
+    Fill the DWH tables from the staging tables with one set based INSERT ... SELECT per table
+    Parameters:
+      cur - cursor
+      time_grain - grain of the time dimension (one of TIME_GRAINS)
+      partitions - optional SongplayPartitions - the songplays partitions for the staged events are created first
+      user_history - optional UserHistory - written from the staged events that change a user's state
+    """ 
+    
+    if partitions is not None:
+        cur.execute(staging_event_time_select, {'partition_grain': partitions.grain})
+        partitions.ensure(cur, [partition_start for partition_start, in cur.fetchall()])
+    
+    for table, query in elt_transform_queries.items():
+        with METRICS.timer('transform'):
+            if table == 'songplay':
+                rows = insert_songplays(cur, query, {'time_grain': time_grain})      # also updates the rollups
+            else:
+                cur.execute(query, {'time_grain': time_grain})
+                rows = cur.rowcount
+        print(f"Transform succeeded for table '{table}'. Rows inserted or updated: {rows}.")
+    
+    if user_history is not None:
+        with METRICS.timer('transform'):
+            cur.execute(user_history_transform_select)
+            versions = user_history.write(cur, cur.fetchall())
+        print(f"Transform succeeded for table 'user_history'. Versions inserted: {versions}.")
+
+
+def get_files(filepath, pattern='*.json'):
+    """
+    Get all json files found under a directory - including their compressed variants (e.g. *.json.gz for *.json)
+    Parameters:
+      filepath - filepath to source data files
+      pattern - glob pattern of the files to include
+    Returns:
+      list of the files in path order - the log files are named by date, so their events load in date order and the last
+      state of a user written is the latest one
     """ 
     
-    # get all files matching extension from directory
     all_files = []
     for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root,'*.json'))
+        files = [f for source_pattern in source_patterns(pattern) for f in glob.glob(os.path.join(root, source_pattern))]
         for f in files :
             if '-checkpoint' in f: 
                 continue                          # filter out garbage files located in test data directory
             all_files.append(os.path.abspath(f))           
+            
+    return sorted(all_files)
+
+
+def file_signature(filepath):
+    """
+    Get the size, modification time and sha256 content hash of a source file as recorded in the load manifest
+    Parameters:
+      filepath - filepath to source data file
+    """ 
+    
+    stat = os.stat(filepath)
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return stat.st_size, stat.st_mtime, sha256.hexdigest()
+
+
+def manifest_path(filepath):
+    """
+    Key a source file in the load manifest by its path relative to the working directory
+    Parameters:
+      filepath - filepath to source data file
+    """ 
+    
+    return os.path.relpath(filepath).replace(os.sep, '/')
+
+
+def filter_loaded_files(cur, all_files):
+    """
+    Compare source files against the load manifest and return only the ones that are new or changed
+    Parameters:
+      cur - cursor
+      all_files - list of filepaths to source data files
+    """ 
+    
+    cur.execute(manifest_select)
+    manifest = {file_path: (file_size, file_mtime, content_hash) for file_path, file_size, file_mtime, content_hash in cur.fetchall()}
+    
+    new_files = []
+    for f in all_files:
+        path = manifest_path(f)
+        if path not in manifest:
+            new_files.append(f)
+            continue
+        file_size, file_mtime, content_hash = manifest[path]
+        stat = os.stat(f)
+        if stat.st_size == file_size and stat.st_mtime == file_mtime:
+            continue                              # unchanged since it was loaded - no need to read it
+        signature = file_signature(f)
+        if signature[2] == content_hash:
+            cur.execute(manifest_table_upsert, (path,) + signature + ('loaded',))   # touched but identical content
+            continue
+        new_files.append(f)
+        
+    print(f'{len(all_files) - len(new_files)} files already loaded according to the load manifest')
+    return new_files
+
+
+def record_file(cur, filepath, status):
+    """
+    Record a source file in the load manifest with its load status
+    Parameters:
+      cur - cursor
+      filepath - filepath to source data file
+      status - load status ('loaded' or 'failed')
+    """ 
+    
+    cur.execute(manifest_table_upsert, (manifest_path(filepath),) + file_signature(filepath) + (status,))
+
+
+def report_progress(i, num_files, last_report):
+    """
+    Print file progress at most every PROGRESS_INTERVAL seconds and after the last file
+    Parameters:
+      i - number of files processed so far
+      num_files - total number of files to process
+      last_report - time of the previous progress report
+    Returns:
+      time of the latest progress report
+    """ 
+    
+    now = time()
+    if i == num_files or now - last_report >= PROGRESS_INTERVAL:
+        print('{}/{} files processed.'.format(i, num_files))
+        return now
+    return last_report
+
+
+def load_file(cur, datafile, func, manifest, policy):
+    """
+    load a single source file inside the savepoint of the commit policy and record it in the load manifest
+    Parameters:
+      cur - cursor
+      datafile - source file
+      func - function to invoke to load the file - called with the cursor and datafile
+      manifest - record the file and its load status in the load manifest
+      policy - CommitPolicy of the load
+    Returns:
+      True when the file was loaded, False when it failed and was rolled back
+    """
+    
+    policy.begin_file(cur)
+    try:
+        func(cur, datafile)
+    except Exception as error:
+        recovered = policy.rollback_file(cur, datafile, error)
+        if manifest:
+            record_file(cur, datafile, 'failed')
+        policy.end_file(cur)
+        if not recovered:
+            raise
+        return False
+    if manifest:
+        record_file(cur, datafile, 'loaded')
+    policy.end_file(cur)
+    return True
+
+
+def process_data(cur, conn, filepath, func, manifest=False, pattern='*.json', policy=None, record=True):
+    """
+    utility function to handle os file processing for loading data
+    Parameters:
+      cur - cursor
+      conn - database connection
+      filepath - filepath to source data files
+      func - function to invoke to process data (i.e. process_log_file or process_song_file)
+      manifest - skip files already recorded in the load manifest and record each file loaded
+      pattern - glob pattern of the files to load
+      policy - CommitPolicy deciding when to commit (default commits every file, or autocommits if the session does)
+      record - with manifest, record each file in the load manifest as soon as it is loaded - False leaves recording the
+               returned files to the caller
+    Returns:
+      list of the files loaded
+    """ 
+    
+    policy = policy or CommitPolicy.for_connection(conn)
+    
+    # get all files matching extension from directory
+    with METRICS.timer('discover'):
+        all_files = get_files(filepath, pattern)
 
     # get total number of files found
     num_files = len(all_files)
     #print('{} files found in {}'.format(num_files, filepath))
     print(f'{num_files} files found in {filepath}')
     
+    # skip files already loaded by a previous run
+    if manifest:
+        with METRICS.timer('discover'):
+            all_files = filter_loaded_files(cur, all_files)
+        num_files = len(all_files)
+    
     # iterate over files and process
+    last_report = time()
+    loaded = []
     for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
-        conn.commit()
-        print('{}/{} files processed.'.format(i, num_files))
+        if load_file(cur, datafile, func, manifest and record, policy):
+            loaded.append(datafile)
+        last_report = report_progress(i, num_files, last_report)
+    
+    return loaded
+
+
+def extract_file_batch(extract_func, parts):
+    """
+    Worker task for process_data_parallel - parse and transform a group of files (or parts of files) into row batches
+    Parameters:
+      extract_func - function returning the row batches for one file (i.e. extract_log_rows or extract_song_rows)
+      parts - list of argument tuples for extract_func - (filepath,) for a whole file, (filepath, offset, end) for a byte 
+              range of a song shard
+    Returns:
+      list of (row batches, error) - one per part, error being None or the exception that failed the part - and the stage
+      timings measured in the worker
+    """ 
+    
+    METRICS.reset()
+    batches = []
+    for part in parts:
+        try:
+            batches.append((extract_func(*part), None))
+        except Exception as error:
+            batches.append((None, error))
+    return batches, dict(METRICS.stage_seconds)
+
+
+def write_extracted(cur, datafile, write_func, parts):
+    """
+    Write the row batches of a file parsed in another thread or process (called by load_file) - a parse error is raised
+    here so the file is rolled back and recorded as failed like an error while writing it
+    Parameters:
+      cur - cursor
+      datafile - source file
+      write_func - function writing the row batches (i.e. write_log_rows or write_song_rows)
+      parts - list of (row batches, error) of the parts of the file in order (one for a file parsed as a whole), error 
+              being the exception raised while the part was parsed, or None
+    """ 
+    
+    for rows, error in parts:
+        if error is not None:
+            raise error
+    for rows, error in parts:
+        write_func(cur, rows)
+
+
+def process_data_parallel(cur, conn, filepath, extract_func, write_func, workers=None, files_per_task=1, manifest=False,
+                          pattern='*.json', policy=None, split_func=None):
+    """
+    utility function to handle os file processing for loading data - parsing and transforming files in a pool of worker
+    processes while this process writes the resulting row batches to the database in file order
+    Parameters:
+      cur - cursor
+      conn - database connection
+      filepath - filepath to source data files
+      extract_func - function invoked in the workers to parse a file (i.e. extract_log_rows or extract_song_rows)
+      write_func - function invoked in this process to write the row batches (i.e. write_log_rows or write_song_rows)
+      workers - number of worker processes (None means one per cpu)
+      files_per_task - number of files handed to a worker at a time (use more for many small files)
+      manifest - skip files already recorded in the load manifest and record each file loaded
+      pattern - glob pattern of the files to load
+      policy - CommitPolicy deciding when to commit (default commits every file, or autocommits if the session does)
+      split_func - optional function splitting a file into parts parsed by separate tasks (e.g. shard_ranges) - called with
+                   the file and the number of workers, it returns the argument tuples for extract_func. The parts of a 
+                   file are written together in one load_file.
+    """ 
+    
+    policy = policy or CommitPolicy.for_connection(conn)
+    workers = workers or os.cpu_count()
+    
+    with METRICS.timer('discover'):
+        all_files = get_files(filepath, pattern)
+    num_files = len(all_files)
+    print(f'{num_files} files found in {filepath}')
+    
+    # skip files already loaded by a previous run
+    if manifest:
+        with METRICS.timer('discover'):
+            all_files = filter_loaded_files(cur, all_files)
+        num_files = len(all_files)
+    
+    parts = [(datafile, part) for datafile in all_files 
+             for part in (split_func(datafile, workers) if split_func else [(datafile,)])]
+    part_counts = Counter(datafile for datafile, part in parts)
+    tasks = [parts[i:i + files_per_task] for i in range(0, len(parts), files_per_task)]
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # keep a bounded window of tasks in flight so parsed batches cannot pile up in memory faster than they are written
+        max_pending = 2 * workers
+        pending = deque()
+        next_task = 0
+        i = 0
+        file_parts = []
+        last_report = time()
+        while pending or next_task < len(tasks):
+            while next_task < len(tasks) and len(pending) < max_pending:
+                pending.append(executor.submit(extract_file_batch, extract_func, [part for datafile, part in tasks[next_task]]))
+                next_task += 1
+            task = tasks[next_task - len(pending)]
+            try:
+                batches, stage_seconds = pending.popleft().result()
+            except Exception as error:          # the task failed as a whole (e.g. a worker died) - so do all its files
+                batches, stage_seconds = [(None, error)] * len(task), {}
+            METRICS.add_stage_seconds(stage_seconds)
+            for (datafile, part), batch in zip(task, batches):
+                # a file is written once all of its parts are parsed - they arrive in order
+                file_parts.append(batch)
+                if len(file_parts) < part_counts[datafile]:
+                    continue
+                load_file(cur, datafile, partial(write_extracted, write_func=write_func, parts=file_parts), manifest, policy)
+                file_parts = []
+                i += 1
+                last_report = report_progress(i, num_files, last_report)
+
+        
+def pipeline_put(queue, item, stop):
+    """
+    Put an item on a bounded pipeline queue - blocks while the queue is full (backpressure) unless the pipeline is stopped
+    Parameters:
+      queue - bounded queue to the next stage
+      item - item to put
+      stop - event set when the pipeline is shut down
+    Returns:
+      True when the item was queued, False when the pipeline was stopped
+    """ 
+    
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def pipeline_get(queue, stop):
+    """
+    Take the next item from a pipeline queue - waits until an item arrives unless the pipeline is stopped
+    Parameters:
+      queue - queue from the previous stage
+      stop - event set when the pipeline is shut down
+    Returns:
+      the item, or None when the pipeline was stopped
+    """ 
+    
+    while not stop.is_set():
+        try:
+            return queue.get(timeout=0.1)
+        except Empty:
+            continue
+    return None
+
+
+def pipeline_stage(func, inbox, outbox, stop):
+    """
+    Run one stage of process_data_pipelined in a thread - apply func to the payload of every (datafile, payload, error) 
+    item taken from the inbox and pass the result on. Errors travel with their file down to the writer stage which records 
+    them. None marks the end of the stream.
+    Parameters:
+      func - function applied to the payload of each item
+      inbox - iterable of items (e.g. a list of files) or queue from the previous stage
+      outbox - bounded queue to the next stage
+      stop - event set when the pipeline is shut down
+    """ 
+    
+    items = iter(partial(pipeline_get, inbox, stop), None) if isinstance(inbox, Queue) else inbox
+    for datafile, payload, error in items:
+        if error is None:
+            try:
+                payload = func(payload)
+            except Exception as e:
+                payload, error = None, e
+        if not pipeline_put(outbox, (datafile, payload, error), stop):
+            if hasattr(payload, 'close'):         # a file opened ahead that no stage will read
+                payload.close()
+            return
+    pipeline_put(outbox, None, stop)
+
 
+def process_data_pipelined(cur, conn, filepath, extract_func, write_func, read_func=read_source_file, queue_size=4, 
+                           manifest=False, pattern='*.json', policy=None):
+    """
+    utility function to handle os file processing for loading data - as a pipeline of three stages connected by bounded
+    queues: a reader thread opens files and starts reading them ahead, a transform thread parses them into row batches 
+    and this thread writes the batches to the database in file order. Reading and parsing overlap with the database round trips of the writer.
+    Parameters:
+      cur - cursor
+      conn - database connection
+      filepath - filepath to source data files
+      extract_func - function invoked in the transform stage to parse a file (i.e. extract_log_rows or extract_song_rows)
+      write_func - function invoked in the writer stage to write the row batches (i.e. write_log_rows or write_song_rows)
+      read_func - function invoked in the reader stage to open a file (read_source_file - None passes the filepath on)
+      queue_size - number of files held in each queue between two stages
+      manifest - skip files already recorded in the load manifest and record each file loaded
+      pattern - glob pattern of the files to load
+      policy - CommitPolicy deciding when to commit (default commits every file, or autocommits if the session does)
+    """ 
+    
+    policy = policy or CommitPolicy.for_connection(conn)
+    
+    with METRICS.timer('discover'):
+        all_files = get_files(filepath, pattern)
+    num_files = len(all_files)
+    print(f'{num_files} files found in {filepath}')
+    
+    # skip files already loaded by a previous run
+    if manifest:
+        with METRICS.timer('discover'):
+            all_files = filter_loaded_files(cur, all_files)
+        num_files = len(all_files)
+    
+    read_queue, write_queue = Queue(maxsize=queue_size), Queue(maxsize=queue_size)
+    stop = Event()
+    stages = [Thread(target=pipeline_stage, args=(read_func or (lambda datafile: datafile), 
+                                                  [(datafile, datafile, None) for datafile in all_files], read_queue, stop)),
+              Thread(target=pipeline_stage, args=(extract_func, read_queue, write_queue, stop))]
+    for stage in stages:
+        stage.daemon = True
+        stage.start()
         
+    try:
+        last_report = time()
+        for i, (datafile, rows, error) in enumerate(iter(write_queue.get, None), 1):
+            load_file(cur, datafile, partial(write_extracted, write_func=write_func, parts=[(rows, error)]), manifest, policy)
+            last_report = report_progress(i, num_files, last_report)
+    finally:
+        stop.set()
+        for stage in stages:
+            stage.join()
+        # files the reader stage opened ahead but the transform stage never took (the load stopped on an error)
+        while not read_queue.empty():
+            item = read_queue.get_nowait()
+            if item is not None and hasattr(item[1], 'close'):
+                item[1].close()
+
+
+def process_data_writers(cur, conn, filepath, extract_func, write_func, pool, writers, connect=None, manifest=False,
+                         pattern='*.json', policy=None, partitions=None, user_history=None):
+    """
+    utility function to handle os file processing for loading log data - over several database connections. This thread
+    parses each file and upserts its users on its own connection in file order (so the latest state of a user does not
+    depend on which writer finishes first), then hands the time, songplay and rollup rows of the file to one of the writer
+    threads. Every writer has its own connection from the pool and commits each file with its manifest entry. All writers
+    take their row locks in key order (time, then songplays, then rollups, each sorted) so they cannot deadlock.
+    Parameters:
+      cur - cursor
+      conn - database connection - committed after the users of every file
+      filepath - filepath to source data files
+      extract_func - function to parse a file (i.e. extract_log_rows)
+      write_func - function invoked in the writer threads to write the row batches (i.e. write_log_rows or write_log_rows_bulk)
+      pool - connection pool (see sinks.connection_pool) with at least writers connections
+      writers - number of writer threads and connections
+      connect - optional function wrapping a pooled connection (e.g. in an InstrumentedConnection)
+      manifest - skip files already recorded in the load manifest and record each file loaded
+      pattern - glob pattern of the files to load
+      policy - CommitPolicy of this connection - must commit every file
+      partitions - optional SongplayPartitions - the partitions the songplays need are created in this thread
+      user_history - optional UserHistory - writes the changes of the users' state to user_history in this thread
+    """
+    
+    policy = policy or CommitPolicy.for_connection(conn)
+    
+    with METRICS.timer('discover'):
+        all_files = get_files(filepath, pattern)
+    num_files = len(all_files)
+    print(f'{num_files} files found in {filepath}')
+    
+    # skip files already loaded by a previous run
+    if manifest:
+        with METRICS.timer('discover'):
+            all_files = filter_loaded_files(cur, all_files)
+        num_files = len(all_files)
+    
+    # every writer thread keeps one pooled connection and its own commit policy for the whole load
+    writer, writer_conns, writer_policies = local(), [], []
+    
+    def write_file(datafile, rows):
+        if not hasattr(writer, 'cur'):
+            raw_conn = pool.getconn()
+            writer_conns.append(raw_conn)
+            writer.policy = CommitPolicy((connect or (lambda conn: conn))(raw_conn), 'file')
+            writer.policy.start()
+            writer.cur = writer.policy.conn.cursor()
+            writer_policies.append(writer.policy)
+        load_file(writer.cur, datafile, lambda cur, datafile: write_func(cur, rows), manifest, writer.policy)
+    
+    def write_dimensions(cur, datafile, batch):
+        rows = extract_func(datafile)
+        if partitions is not None:
+            rows = partitions.prepare(cur, rows)
+        write_user_rows(cur, rows['user'], user_history)
+        batch.update(rows, user=[])
+    
+    try:
+        with ThreadPoolExecutor(max_workers=writers) as executor:
+            # a bounded window of files in flight keeps the parsed batches from piling up in memory
+            pending = deque()
+            last_report = time()
+            for i, datafile in enumerate(all_files, 1):
+                batch = {}
+                policy.begin_file(cur)
+                try:
+                    write_dimensions(cur, datafile, batch)
+                except Exception as error:
+                    recovered = policy.rollback_file(cur, datafile, error)
+                    if manifest:
+                        record_file(cur, datafile, 'failed')
+                    policy.end_file(cur)
+                    if not recovered:
+                        raise
+                    continue
+                policy.end_file(cur)           # the users are committed before their songplays reference them
+                
+                pending.append(executor.submit(write_file, datafile, batch))
+                while len(pending) >= 2 * writers:
+                    pending.popleft().result()
+                last_report = report_progress(i, num_files, last_report)
+            while pending:
+                pending.popleft().result()
+    finally:
+        for writer_policy in writer_policies:
+            policy.failed_files.extend(writer_policy.failed_files)
+        for raw_conn in writer_conns:
+            pool.putconn(raw_conn)
+
+
 def quality_check(cur, conn):
     """
     Perform basic quality check by counting rows in DWH tables
@@ -164,7 +1397,7 @@ def quality_check(cur, conn):
             cur.execute(query)
             result = cur.fetchone()
             print(f"Count table query succeeded for table '{table}'. Total records: {result[0]}.") 
-        except psycopg2.Error as e:
+        except sinks.Error as e:
             print(f"Count table query failed for table '{table}'.")
             print(e)
             continue    
@@ -176,23 +1409,311 @@ def main():
     Parameters: none
     """  
     
+    parser = argparse.ArgumentParser(description='Load song and log json files into the Sparkify DWH tables.')
+    parser.add_argument('--sink', choices=sinks.SINKS, default=sinks.DEFAULT_SINK,
+                        help="database to load into - 'null' only counts rows to measure parse/transform throughput "
+                             "(default from the SPARKIFY_SINK environment variable, else postgres)")
+    parser.add_argument('--dsn', 
+                        help="Postgres server as a libpq connection string or URI without the database (default from the "
+                             "SPARKIFY_DSN environment variable, else the local student login)")
+    parser.add_argument('--load-mode', choices=['row', 'bulk', 'elt'], default='row',
+                        help="'row' inserts one row per statement, 'bulk' streams each file via COPY and set based merges, "
+                             "'elt' copies the raw json into staging tables and transforms them with set based SQL")
+    parser.add_argument('--song-lookup', choices=['query', 'memory', 'bounded'], default='query',
+                        help="'query' runs song_select per event, 'memory' holds the song catalog in a hash index, "
+                             "'bounded' holds at most --lookup-max-entries keys and queries the database on a miss")
+    parser.add_argument('--lookup-max-entries', type=int, default=100000,
+                        help="maximum number of keys held in memory by the bounded song lookup")
+    parser.add_argument('--chunk-size', type=int, default=0,
+                        help="stream log files through the loader this many events at a time with constant memory "
+                             "(0 reads each log file whole with pandas)")
+    parser.add_argument('--song-shards', metavar='DIR',
+                        help="load songs from packed song shards in DIR (see pack_songs.py) instead of data/song_data")
+    parser.add_argument('--song-cache', metavar='DIR',
+                        help="keep a columnar cache of the song catalog in DIR - while the song files are unchanged the song "
+                             "load is skipped and --song-lookup memory is built from the cache")
+    parser.add_argument('--time-grain', choices=list(TIME_GRAINS), default='millisecond',
+                        help="grain of the time dimension - songplays.start_time is truncated to match")
+    parser.add_argument('--full-reload', action='store_true',
+                        help="clear the load manifest and load every file instead of only new or changed files")
+    parser.add_argument('--metrics-file', 
+                        help="write run metrics (stage times, rows per table, round trips, lookup hit rate) to this file")
+    parser.add_argument('--metrics-format', choices=['json', 'prometheus'], default='json',
+                        help="format of --metrics-file - 'prometheus' writes a node exporter textfile")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="parse and transform files in this many worker processes (0 parses serially in this process)")
+    parser.add_argument('--files-per-task', type=int, default=16,
+                        help="number of song files handed to a worker at a time in parallel mode")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="read, parse and write files concurrently in a pipeline of threads connected by bounded queues")
+    parser.add_argument('--queue-size', type=int, default=4,
+                        help="number of files held between two stages of the --pipeline loader")
+    parser.add_argument('--commit-policy', choices=COMMIT_MODES, default='file',
+                        help="when to commit - 'rows' commits after every --commit-rows rows written (at a file boundary), "
+                             "'file' after every file, 'run' once at the end, 'autocommit' every statement; "
+                             "except in autocommit mode a failing file is rolled back to a savepoint, logged and skipped")
+    parser.add_argument('--commit-rows', type=int, default=10000,
+                        help="number of rows written between commits with --commit-policy rows")
+    parser.add_argument('--defer-constraints', action='store_true',
+                        help="drop foreign keys and secondary indexes before the load and restore them afterwards, "
+                             "also when the load fails (postgres only - see create_tables.py --restore-constraints)")
+    parser.add_argument('--reload-partition', metavar='DATE',
+                        help="truncate the songplays partition holding DATE (e.g. 2018-11) and reload it from all log files, "
+                             "writing only the time and songplay rows that fall into it (row and bulk load modes)")
+    parser.add_argument('--writers', type=int, default=0,
+                        help="write the log files over this many pooled database connections in parallel - users are "
+                             "upserted in file order on the main connection (postgres, --load-mode row or bulk, "
+                             "--commit-policy file)")
+    parser.add_argument('--statement-cache', type=int, default=32,
+                        help="number of hot statements (song_select and the row inserts) kept prepared on the server per "
+                             "connection - 0 sends the full SQL text with every row (postgres only)")
+    parser.add_argument('--no-backfill', action='store_true',
+                        help="do not resolve the unmatched songplays already loaded against the songs added by this run")
+    parser.add_argument('--backfill-since', metavar='TIMESTAMP',
+                        help="resolve the unmatched songplays against all songs loaded since TIMESTAMP (e.g. 2026-10-01) "
+                             "instead of only the songs added by this run")
+    parser.add_argument('--backfill-range', nargs='+', metavar='DATE',
+                        help="only resolve the unmatched songplays from the first DATE up to the second (e.g. "
+                             "--backfill-range 2018-11-01 2018-12-01) - only the partitions of that range are touched")
+    args = parser.parse_args()
+    if args.sink == 'sqlite' and args.load_mode != 'row':
+        parser.error("the sqlite sink only supports --load-mode row (COPY and the ELT transforms are Postgres specific)")
+    if args.song_cache and args.sink == 'null':
+        parser.error("--song-cache needs a sink that stores the songs")
+    if args.pipeline and (args.workers or args.load_mode == 'elt'):
+        parser.error("--pipeline cannot be combined with --workers or --load-mode elt")
+    if args.defer_constraints and args.sink != 'postgres':
+        parser.error("--defer-constraints requires the postgres sink")
+    if args.reload_partition and (args.sink != 'postgres' or args.load_mode == 'elt'):
+        parser.error("--reload-partition requires the postgres sink and --load-mode row or bulk")
+    if args.writers and (args.sink != 'postgres' or args.load_mode == 'elt' or args.commit_policy != 'file'):
+        parser.error("--writers requires the postgres sink, --load-mode row or bulk and --commit-policy file")
+    if args.writers and (args.workers or args.pipeline or args.chunk_size or args.song_lookup == 'bounded'):
+        parser.error("--writers cannot be combined with --workers, --pipeline, --chunk-size or --song-lookup bounded")
+    if args.backfill_range and len(args.backfill_range) > 2:
+        parser.error("--backfill-range takes at most two dates")
+    backfill = args.sink == 'postgres' and not args.no_backfill
+    
     start_time = time()
     
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
-    conn.set_session(autocommit=True)
+    METRICS.reset()
+    conn = sinks.connect(args.sink, dsn=args.dsn)
+    prepared = None
+    if args.sink == 'postgres' and args.statement_cache > 0:
+        # the hot statements are parsed and planned once per connection instead of once per row
+        conn = prepared = PreparedConnection(conn, args.statement_cache)
+    conn = InstrumentedConnection(conn)
+    
+    # connections of the parallel writers are wrapped like the main connection
+    writer_statements = []
+    def writer_connection(conn):
+        if args.statement_cache > 0:
+            conn = PreparedConnection(conn, args.statement_cache)
+            writer_statements.append(conn.statements)
+        conn = InstrumentedConnection(conn)
+        if args.load_mode == 'bulk':
+            create_stage_tables(conn.cursor(), conn)
+        return conn
+    pool = sinks.connection_pool(args.writers, args.sink, args.dsn) if args.writers else None
+    policy = CommitPolicy(conn, args.commit_policy, args.commit_rows)
+    policy.start()
     cur = conn.cursor()
+    
+    # the bulk load path copies every batch into the same temporary staging tables
+    if args.load_mode == 'bulk':
+        create_stage_tables(cur, conn)
+    
+    # songs loaded from here on are new to the songplays backfill
+    if backfill:
+        cur.execute(load_start_select)
+        load_start = cur.fetchone()[0]
+
+    # songs come either from the raw song tree (one file per song) or from packed song shards
+    if args.song_shards:
+        song_path, song_pattern, files_per_task = args.song_shards, SONG_SHARD_PATTERN, 1
+        song_extract, song_func = extract_song_shard, process_song_shard
+        song_split = partial(shard_ranges, index=load_shard_index(song_path))      # --workers parse byte ranges of a shard
+    else:
+        song_path, song_pattern, files_per_task = 'data/song_data', '*.json', args.files_per_task
+        song_extract, song_func, song_split = extract_song_rows, process_song_file2, None
+
+    # the load manifest makes reruns load only new or changed files
+    if args.full_reload:
+        cur.execute(manifest_table_clear)
+
+    # with a valid song catalog cache the song files are not even checked against the manifest
+    song_cache, load_songs = None, True
+    if args.song_cache:
+        song_cache = SongCache(args.song_cache)
+        with METRICS.timer('discover'):
+            song_fingerprint = source_fingerprint(get_files(song_path, song_pattern))
+        if song_cache.valid(song_fingerprint) and not args.full_reload:
+            cur.execute(song_table_count)
+            load_songs = cur.fetchone()[0] < song_cache.read()['songs']     # the database was recreated since
+        if not load_songs:
+            print(f"Song catalog cache {args.song_cache} is current - skipping {song_path}.")
+
+    # optionally resolve songs in memory - the catalog is loaded once and extended as song files are parsed
+    lookup = None
+    normalization = match_normalization(cur) if args.sink == 'postgres' else 'exact'
+    if args.song_lookup == 'memory':
+        lookup = SongLookup(normalization=normalization)
+        with METRICS.timer('lookup'):
+            if load_songs:
+                lookup.load(cur)
+            else:
+                lookup.load_cache(song_cache)
+    elif args.song_lookup == 'bounded':
+        lookup = SongLookup(max_entries=args.lookup_max_entries, normalization=normalization)
+
+    # at a coarse time grain remember the time keys already loaded so repeated keys are never sent to the database
+    time_keys = load_time_keys(cur) if args.time_grain != 'millisecond' else None
+    
+    # songplays partitions are created as new log dates appear - a partition reload only writes rows for that partition
+    partitions = None
+    if args.sink == 'postgres':
+        partitions = SongplayPartitions.load(cur, pd.Timestamp(args.reload_partition) if args.reload_partition else None)
+    if args.reload_partition:
+        if partitions is None:
+            parser.error("--reload-partition requires a partitioned songplays table (see create_tables.py --partition-grain)")
+        partitions.truncate(cur, partitions.target[0])
+    
+    # with a user_history table the changes of every user's state are kept as type 2 versions
+    user_history = UserHistory.load(cur) if args.sink == 'postgres' else None
+    log_options = {'time_grain': args.time_grain, 'time_keys': time_keys, 'partitions': partitions, 'user_history': user_history}
 
-    # process the dimensions that can be derived from the song json files
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file2)
+    # a file rolled back to its savepoint may have added keys to the in-memory caches that are no longer in the database
+    if time_keys is not None:
+        def reload_time_keys():
+            time_keys.clear()
+            time_keys.update(load_time_keys(cur))
+        policy.add_rollback_hook(reload_time_keys)
+    if lookup is not None:
+        policy.add_rollback_hook(lambda: lookup.reload(cur))
+    if partitions is not None:
+        policy.add_rollback_hook(lambda: partitions.reload(cur))
+
+    # without foreign keys and secondary indexes every insert is cheaper - they are restored (and validated) even if the load fails
+    if args.defer_constraints:
+        defer_constraints(cur, conn)
     
-    # process the fact and dimensions that can be derived from the log json files
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    try:
+        if args.load_mode == 'elt':
+            # copy the raw records of both sources into staging tables then let Postgres do all of the transformation
+            for table, query in elt_table_queries.items():
+                cur.execute(query)
+            cur.execute(staging_table_truncate)
+            staged = []
+            if load_songs:
+                staged += process_data(cur, conn, filepath=song_path, func=partial(stage_json_file, copy_sql=staging_songs_copy), 
+                                       manifest=True, pattern=song_pattern, policy=policy, record=False)
+            staged += process_data(cur, conn, filepath='data/log_data', func=partial(stage_json_file, copy_sql=staging_events_copy), 
+                                   manifest=True, policy=policy, record=False)
+            transform_staged_data(cur, args.time_grain, partitions, user_history)
+            
+            # the staged files only reach the warehouse tables with the transform - record them in the manifest after it
+            # succeeded, in the transaction policy.finish() commits it with
+            for datafile in staged:
+                record_file(cur, datafile, 'loaded')
+            for datafile in policy.failed_files:
+                record_file(cur, datafile, 'failed')
+            
+        elif args.writers:
+            # songs are loaded on this connection - songplays are matched against them
+            if load_songs:
+                process_data(cur, conn, filepath=song_path, func=partial(song_func, lookup=lookup), manifest=True, 
+                             pattern=song_pattern, policy=policy)
+            
+            write_func = write_log_rows_bulk if args.load_mode == 'bulk' else write_log_rows
+            process_data_writers(cur, conn, filepath='data/log_data', extract_func=partial(extract_log_rows, time_grain=args.time_grain), 
+                                 write_func=partial(write_func, lookup=lookup), pool=pool, writers=args.writers, 
+                                 connect=writer_connection, manifest=not args.reload_partition, policy=policy, 
+                                 partitions=partitions, user_history=user_history)
+        elif args.workers:
+            # songs are loaded completely before the log files are started since songplays are matched against them
+            if load_songs:
+                process_data_parallel(cur, conn, filepath=song_path, extract_func=song_extract, 
+                                      write_func=partial(write_song_rows, lookup=lookup), 
+                                      workers=args.workers, files_per_task=files_per_task, manifest=True, pattern=song_pattern, 
+                                      policy=policy, split_func=song_split)
+            
+            write_func = write_log_rows_bulk if args.load_mode == 'bulk' else write_log_rows
+            process_data_parallel(cur, conn, filepath='data/log_data', extract_func=partial(extract_log_rows, time_grain=args.time_grain), 
+                                  write_func=partial(write_func, lookup=lookup, time_keys=time_keys, partitions=partitions, 
+                                                     user_history=user_history), 
+                                  workers=args.workers, manifest=not args.reload_partition, policy=policy)
+        elif args.pipeline:
+            # the reader and transform threads overlap file I/O and parsing with the database round trips of this thread
+            if load_songs:
+                process_data_pipelined(cur, conn, filepath=song_path, extract_func=song_extract, 
+                                       write_func=partial(write_song_rows, lookup=lookup), 
+                                       read_func=None if args.song_shards else read_source_file, queue_size=args.queue_size,
+                                       manifest=True, pattern=song_pattern, policy=policy)
+            
+            write_func = write_log_rows_bulk if args.load_mode == 'bulk' else write_log_rows
+            process_data_pipelined(cur, conn, filepath='data/log_data', extract_func=partial(extract_log_rows, time_grain=args.time_grain), 
+                                   write_func=partial(write_func, lookup=lookup, time_keys=time_keys, partitions=partitions, 
+                                                      user_history=user_history), 
+                                   queue_size=args.queue_size, manifest=not args.reload_partition, policy=policy)
+        else:
+            # process the dimensions that can be derived from the song json files
+            if load_songs:
+                process_data(cur, conn, filepath=song_path, func=partial(song_func, lookup=lookup), manifest=True, 
+                             pattern=song_pattern, policy=policy)
+
+            # process the fact and dimensions that can be derived from the log json files
+            log_func = process_log_file_bulk if args.load_mode == 'bulk' else process_log_file
+            if args.chunk_size:
+                log_func = partial(process_log_file_stream, chunk_size=args.chunk_size, 
+                                   write_func=write_log_rows_bulk if args.load_mode == 'bulk' else write_log_rows)
+            process_data(cur, conn, filepath='data/log_data', func=partial(log_func, lookup=lookup, **log_options), 
+                         manifest=not args.reload_partition, policy=policy)
+        
+        policy.finish()
+    finally:
+        if pool is not None:
+            pool.closeall()
+        if args.defer_constraints:
+            restore_constraints(cur, conn)
+    
+    # songplays loaded before their songs are resolved once the songs arrive - after the restore so the partial index is used
+    if backfill and (args.backfill_since or METRICS.table_rows.get('songs')):
+        resolved = backfill_songplays(cur, args.backfill_since or load_start, *(args.backfill_range or []))
+        conn.commit()
+        print(f"** Songplays resolved against late arriving songs: {resolved}.")
+    
+    if policy.failed_files:
+        print(f"** {len(policy.failed_files)} files failed to load and were rolled back - see the load manifest.")
+    
+    # the cache is only written once every song file has been loaded
+    song_failures = [datafile for datafile in policy.failed_files if datafile.startswith(os.path.abspath(song_path))]
+    if song_cache is not None and load_songs and not song_failures:
+        songs = song_cache.write(cur, song_fingerprint)
+        print(f"Song catalog cache {args.song_cache} written with {songs} songs.")
+    
+    if lookup is not None:
+        METRICS.lookup_stats = lookup.stats()
+    for statements in ([prepared.statements] if prepared is not None else []) + writer_statements:
+        for name, value in statements.stats().items():
+            METRICS.count(name, value)
+    if user_history is not None:
+        print(f"** User history versions written: {user_history.versions}.")
     
     # perform a rudimentary quality check by counting rows loaded into tables
     quality_check(cur, conn)
     
     conn.close()
     
+    # summarise where the load time went
+    METRICS.print_summary()
+    if 'songplays' in METRICS.counters:
+        print(f"** Songplays matched to a song: {METRICS.counters['songplays_matched']} of {METRICS.counters['songplays']}.")
+    if args.metrics_file:
+        if args.metrics_format == 'prometheus':
+            METRICS.write_prometheus(args.metrics_file)
+        else:
+            METRICS.write_json(args.metrics_file)
+    
     tot_time = time() - start_time # calculate difference between end time and start time
     print("** Total Elapsed Runtime:",
           f"{str(int((tot_time/3600)))}:{str(int((tot_time%3600)/60))}:{str(round((tot_time%3600)%60))}")  
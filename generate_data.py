@@ -0,0 +1,171 @@
+# generate_data.py
+#
+# PURPOSE: Generate synthetic song and log/event data in the same json formats and directory layout as the Udacity sample
+#          data so the ETL can be measured at realistic scale (see benchmark.py).
+#
+# Output (under the target directory):
+#     song_data/<A>/<B>/<C>/TR....json       - one single record json file per song (as data/song_data)
+#     log_data/<yyyy>/<mm>/<yyyy-mm-dd>-events.json - one json lines file of events per day (as data/log_data)
+#
+# Included functions:
+#     generate_songs      - write the song tree and return the catalog used to generate matching events
+#     generate_events     - write the daily event logs
+#     main                - main function parses arguments and generates the data
+#
+
+import os
+import json
+import random
+import string
+import argparse
+from datetime import datetime, timedelta
+
+FIRST_NAMES = ['Walter', 'Kaylee', 'Ryan', 'Tegan', 'Jacob', 'Lily', 'Chloe', 'Aleena', 'Jayden', 'Sara', 'Mohammad', 'Kate']
+LAST_NAMES = ['Frye', 'Summers', 'Smith', 'Levine', 'Klein', 'Koch', 'Cuevas', 'Kirby', 'Bell', 'Johnson', 'Rodriguez', 'Harrell']
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Phoenix-Mesa-Scottsdale, AZ', 'New York-Newark-Jersey City, NY-NJ-PA',
+             'Chicago-Naperville-Elgin, IL-IN-WI', 'Atlanta-Sandy Springs-Roswell, GA', 'Portland-South Portland, ME']
+USER_AGENTS = ['"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+               '"Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0"',
+               'Mozilla/5.0 (compatible; MSIE 10.0; Windows NT 6.1; WOW64; Trident/6.0)']
+OTHER_PAGES = ['Home', 'Home', 'Logout', 'Settings', 'Help', 'Upgrade', 'Downgrade', 'About', 'Thumbs Up', 'Add to Playlist']
+WORDS = ['Love', 'Night', 'Heart', 'Fire', 'Dream', 'Blue', 'Rain', 'City', 'Gold', 'Light', 'Road', 'Song', 'Wild', 'Home',
+         'Summer', 'River', 'Stone', 'Shadow', 'Angel', 'Thunder', 'Paradise', 'Ghost', 'Silver', 'Midnight']
+
+
+def random_id(rng, prefix, length=16):
+    return prefix + ''.join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(length))
+
+
+def generate_songs(target_path, num_songs, rng):
+    """
+    Write the song tree - one json file per song in a three level A/B/C directory layout
+    Parameters:
+      target_path - directory to write song_data to
+      num_songs - number of songs to generate
+      rng - random number generator
+    Returns:
+      catalog - list of (title, artist name, duration) of the generated songs
+    """
+    
+    num_artists = max(1, num_songs // 4)
+    artists = []
+    for i in range(num_artists):
+        has_location = rng.random() < 0.6
+        artists.append({'artist_id': random_id(rng, 'AR'),
+                        'artist_name': f"{rng.choice(WORDS)} {rng.choice(WORDS)} {i}",
+                        'artist_location': rng.choice(LOCATIONS) if has_location else '',
+                        'artist_latitude': round(rng.uniform(-60, 60), 5) if has_location else None,
+                        'artist_longitude': round(rng.uniform(-120, 120), 5) if has_location else None})
+    
+    catalog = []
+    for i in range(num_songs):
+        artist = rng.choice(artists)
+        track_id = random_id(rng, 'TR', 16)
+        record = {'num_songs': 1}
+        record.update(artist)
+        record.update({'song_id': random_id(rng, 'SO'),
+                       'title': f"{rng.choice(WORDS)} {rng.choice(WORDS)} {i}",
+                       'duration': round(rng.uniform(60, 600), 5),
+                       'year': rng.choice([0, rng.randint(1960, 2018)])})
+        
+        song_dir = os.path.join(target_path, 'song_data', track_id[2], track_id[3], track_id[4])
+        os.makedirs(song_dir, exist_ok=True)
+        with open(os.path.join(song_dir, track_id + '.json'), 'w') as song_file:
+            json.dump(record, song_file)
+        catalog.append((record['title'], record['artist_name'], record['duration']))
+        
+    return catalog
+
+
+def generate_events(target_path, catalog, num_events, num_days, num_users, match_rate, rng, start_date=datetime(2018, 11, 1)):
+    """
+    Write the daily event logs in json lines format
+    Parameters:
+      target_path - directory to write log_data to
+      catalog - list of (title, artist name, duration) songs that events can match
+      num_events - total number of events over all days
+      num_days - number of daily log files
+      num_users - number of distinct users
+      match_rate - fraction of NextSong events that play a song from the catalog (the rest play unknown songs)
+      rng - random number generator
+      start_date - date of the first log file
+    """
+    
+    users = []
+    for user_id in range(1, num_users + 1):
+        users.append({'userId': str(user_id), 'firstName': rng.choice(FIRST_NAMES), 'lastName': rng.choice(LAST_NAMES),
+                      'gender': rng.choice(['M', 'F']), 'level': rng.choice(['free', 'paid']),
+                      'location': rng.choice(LOCATIONS), 'userAgent': rng.choice(USER_AGENTS),
+                      'registration': float(rng.randint(1535000000000, 1540000000000))})
+    
+    events_per_day = num_events // num_days
+    session_id = 0
+    for day in range(num_days):
+        date = start_date + timedelta(days=day)
+        log_dir = os.path.join(target_path, 'log_data', f'{date:%Y}', f'{date:%m}')
+        os.makedirs(log_dir, exist_ok=True)
+        
+        count = events_per_day + (num_events % num_days if day == num_days - 1 else 0)
+        day_ms = int((date - datetime(1970, 1, 1)).total_seconds() * 1000)
+        timestamps = sorted(rng.randrange(day_ms, day_ms + 86400000) for _ in range(count))
+        
+        with open(os.path.join(log_dir, f'{date:%Y-%m-%d}-events.json'), 'w') as log_file:
+            item_in_session = 0
+            user = rng.choice(users)
+            for ts in timestamps:
+                # start a new session now and then
+                if item_in_session == 0 or rng.random() < 0.05:
+                    session_id += 1
+                    item_in_session = 0
+                    user = rng.choice(users)
+                    if rng.random() < 0.02:
+                        user['level'] = 'paid' if user['level'] == 'free' else 'free'
+                
+                page = 'NextSong' if rng.random() < 0.8 else rng.choice(OTHER_PAGES)
+                logged_in = page == 'NextSong' or rng.random() < 0.9
+                event = {'artist': None, 'auth': 'Logged In' if logged_in else 'Logged Out',
+                         'firstName': user['firstName'] if logged_in else None, 'gender': user['gender'] if logged_in else None,
+                         'itemInSession': item_in_session, 'lastName': user['lastName'] if logged_in else None,
+                         'length': None, 'level': user['level'], 'location': user['location'] if logged_in else None,
+                         'method': 'PUT' if page == 'NextSong' else 'GET', 'page': page,
+                         'registration': user['registration'] if logged_in else None, 'sessionId': session_id, 'song': None,
+                         'status': 200, 'ts': ts, 'userAgent': user['userAgent'] if logged_in else None,
+                         'userId': user['userId'] if logged_in else ''}
+                if page == 'NextSong':
+                    if catalog and rng.random() < match_rate:
+                        title, artist_name, duration = rng.choice(catalog)
+                    else:
+                        title, artist_name, duration = f"Unknown {rng.randint(1, 10**6)}", f"Nobody {rng.randint(1, 10**5)}", \
+                                                       round(rng.uniform(60, 600), 5)
+                    event.update({'artist': artist_name, 'song': title, 'length': duration})
+                    
+                log_file.write(json.dumps(event) + '\n')
+                item_in_session += 1
+                
+        print(f'Generated {count} events for {date:%Y-%m-%d}')
+
+
+def main():
+    """
+    main function parses arguments and generates the data
+    Parameters: none
+    """
+    
+    parser = argparse.ArgumentParser(description='Generate synthetic Sparkify song and log data.')
+    parser.add_argument('target', help='directory to write song_data and log_data to')
+    parser.add_argument('--songs', type=int, default=1000, help='number of songs in the catalog')
+    parser.add_argument('--events', type=int, default=10000, help='total number of log events')
+    parser.add_argument('--days', type=int, default=30, help='number of daily log files')
+    parser.add_argument('--users', type=int, default=100, help='number of distinct users')
+    parser.add_argument('--match-rate', type=float, default=0.5, help='fraction of songplays that match a catalog song')
+    parser.add_argument('--seed', type=int, default=42, help='random seed so generated data sets are reproducible')
+    args = parser.parse_args()
+    
+    rng = random.Random(args.seed)
+    catalog = generate_songs(args.target, args.songs, rng)
+    print(f'Generated {len(catalog)} songs')
+    generate_events(args.target, catalog, args.events, args.days, args.users, args.match_rate, rng)
+
+
+if __name__ == "__main__":
+    main()
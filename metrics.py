@@ -0,0 +1,233 @@
+# metrics.py
+#
+# PURPOSE: Instrumentation for the Sparkify ETL - per-stage timers, rows per target table, database round trips and
+#          song lookup hit rates - written as a json metrics file or a Prometheus textfile at the end of a run.
+#
+# Stages timed by etl.py:
+#     discover   - finding source files and checking them against the load manifest
+#     read       - reading raw lines from source files
+#     parse      - json decoding (including pandas.read_json which reads and parses in one step)
+#     transform  - deriving the dimension and fact rows
+#     lookup     - resolving song_id/artist_id for songplays
+#     write      - sending rows to the database
+#     commit     - committing transactions
+#
+# Included functions:
+#     Metrics              - class: registry of stage timers and counters
+#     InstrumentedCursor   - class: cursor wrapper counting round trips and rows written per table
+#     InstrumentedConnection - class: connection wrapper returning instrumented cursors and timing commits
+#
+
+import os
+import re
+import json
+import threading
+from time import perf_counter
+from contextlib import contextmanager
+from collections import defaultdict
+
+STAGES = ('discover', 'read', 'parse', 'transform', 'lookup', 'write', 'commit')
+
+
+class Metrics:
+    """
+    Registry of stage timers and counters for one ETL run. Timers and counters may be updated from several threads (see 
+    etl.process_data_pipelined and etl.process_data_writers) - overlapping stages then add up to more than the elapsed time.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+        
+    def reset(self):
+        """start a new run"""
+        
+        self.started = perf_counter()
+        self.stage_seconds = defaultdict(float)
+        self.table_rows = defaultdict(int)
+        self.round_trips = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.lookup_stats = {}
+        
+    @contextmanager
+    def timer(self, stage):
+        """time the enclosed block and add it to a stage"""
+        
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_seconds({stage: perf_counter() - start})
+            
+    def timed(self, iterable, stage):
+        """yield the items of an iterable adding the time spent producing each item to a stage"""
+        
+        iterator = iter(iterable)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_stage_seconds({stage: perf_counter() - start})
+                return
+            self.add_stage_seconds({stage: perf_counter() - start})
+            yield item
+            
+    def add_stage_seconds(self, stage_seconds):
+        """add stage timings measured elsewhere (e.g. in a worker process)"""
+        
+        with self._lock:
+            for stage, seconds in stage_seconds.items():
+                self.stage_seconds[stage] += seconds
+            
+    def count(self, name, value=1):
+        """add to a named counter"""
+        
+        with self._lock:
+            self.counters[name] += value
+        
+    def add_round_trip(self, kind):
+        """count a database round trip"""
+        
+        with self._lock:
+            self.round_trips[kind] += 1
+        
+    def add_rows(self, table, rows):
+        """add rows written to a table by a statement the cursor cannot attribute (e.g. an INSERT inside a WITH query)"""
+        
+        with self._lock:
+            self.table_rows[table] += rows
+        
+    def summary(self):
+        """return all metrics of the run as a dictionary"""
+        
+        elapsed = perf_counter() - self.started
+        return {'elapsed_seconds': round(elapsed, 3),
+                'stage_seconds': {stage: round(self.stage_seconds.get(stage, 0.0), 3) 
+                                  for stage in STAGES + tuple(sorted(set(self.stage_seconds) - set(STAGES)))},
+                'table_rows': dict(self.table_rows),
+                'table_rows_per_second': {table: round(rows / elapsed, 1) if elapsed else 0.0 
+                                          for table, rows in self.table_rows.items()},
+                'db_round_trips': dict(self.round_trips),
+                'counters': dict(self.counters),
+                'song_lookup': self.lookup_stats}
+    
+    def write_json(self, path):
+        """write the metrics of the run to a json file"""
+        
+        with open(path, 'w') as metrics_file:
+            json.dump(self.summary(), metrics_file, indent=1)
+            
+    def write_prometheus(self, path, prefix='sparkify_etl'):
+        """write the metrics of the run as a Prometheus textfile (written atomically for the node exporter textfile collector)"""
+        
+        summary = self.summary()
+        lines = []
+        
+        def metric(name, help_text, samples):
+            lines.append(f'# HELP {prefix}_{name} {help_text}')
+            lines.append(f'# TYPE {prefix}_{name} gauge')
+            for labels, value in samples:
+                label_text = '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}' if labels else ''
+                lines.append(f'{prefix}_{name}{label_text} {value}')
+                
+        metric('elapsed_seconds', 'Wall time of the ETL run.', [({}, summary['elapsed_seconds'])])
+        metric('stage_seconds', 'Time spent per ETL stage.', 
+               [({'stage': stage}, seconds) for stage, seconds in summary['stage_seconds'].items()])
+        metric('table_rows', 'Rows written per target table.', 
+               [({'table': table}, rows) for table, rows in summary['table_rows'].items()])
+        metric('table_rows_per_second', 'Rows written per target table per second of the run.', 
+               [({'table': table}, rate) for table, rate in summary['table_rows_per_second'].items()])
+        metric('db_round_trips', 'Database round trips per kind of call.', 
+               [({'kind': kind}, count) for kind, count in summary['db_round_trips'].items()])
+        metric('events', 'ETL event counters.', 
+               [({'counter': name}, count) for name, count in summary['counters'].items()])
+        metric('song_lookup', 'Song lookup cache statistics.', 
+               [({'stat': name}, value) for name, value in summary['song_lookup'].items()])
+        
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, path)
+        
+    def print_summary(self):
+        """print a short summary of the run"""
+        
+        summary = self.summary()
+        print('** Stage times (s): ' + ', '.join(f'{stage}={seconds}' for stage, seconds in summary['stage_seconds'].items()))
+        print('** Rows written: ' + ', '.join(f'{table}={rows} ({summary["table_rows_per_second"][table]}/s)' 
+                                              for table, rows in summary['table_rows'].items()))
+        print('** Database round trips: ' + ', '.join(f'{kind}={count}' for kind, count in summary['db_round_trips'].items()))
+        if summary['counters']:
+            print('** Counters: ' + ', '.join(f'{name}={count}' for name, count in summary['counters'].items()))
+        if summary['song_lookup']:
+            print('** Song lookup: ' + ', '.join(f'{name}={value}' for name, value in summary['song_lookup'].items()))
+        
+
+# module level registry used by the ETL
+METRICS = Metrics()
+
+
+class InstrumentedCursor:
+    """
+    Cursor wrapper counting database round trips and the rows written to each table
+    """
+    
+    _table_re = re.compile(r'^\s*(?:INSERT\s+INTO|COPY|UPDATE|DELETE\s+FROM)\s+(\w+)', re.IGNORECASE)
+    
+    def __init__(self, cursor, metrics=METRICS):
+        self._cursor = cursor
+        self._metrics = metrics
+        
+    def _record(self, kind, query):
+        self._metrics.add_round_trip(kind)
+        if isinstance(query, bytes):             # composed by psycopg2.extras.execute_values
+            query = query[:256].decode('utf-8', 'replace')
+        match = self._table_re.match(query)
+        if match and self._cursor.rowcount and self._cursor.rowcount > 0:
+            self._metrics.add_rows(match.group(1), self._cursor.rowcount)
+        
+    def execute(self, query, params=None):
+        self._cursor.execute(query, params)
+        self._record('execute', query)
+        
+    def executemany(self, query, params_seq):
+        self._cursor.executemany(query, params_seq)
+        self._record('executemany', query)
+        
+    def copy_expert(self, sql, file):
+        self._cursor.copy_expert(sql, file)
+        self._record('copy', sql)
+        
+    def fetchone(self):
+        return self._cursor.fetchone()
+    
+    def fetchall(self):
+        return self._cursor.fetchall()
+    
+    def __iter__(self):
+        return iter(self._cursor)
+    
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+    
+
+class InstrumentedConnection:
+    """
+    Connection wrapper returning instrumented cursors and timing commits
+    """
+    
+    def __init__(self, conn, metrics=METRICS):
+        self._conn = conn
+        self._metrics = metrics
+        
+    def cursor(self):
+        return InstrumentedCursor(self._conn.cursor(), self._metrics)
+    
+    def commit(self):
+        with self._metrics.timer('commit'):
+            self._conn.commit()
+        self._metrics.add_round_trip('commit')
+        
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
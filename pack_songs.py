@@ -0,0 +1,89 @@
+# pack_songs.py
+#
+# PURPOSE: Tool to consolidate the song_data tree (one small json file per song) into a few large json lines shards
+#          which etl.py can load in batches (etl.py --song-shards DIR) without per-file filesystem and commit overhead.
+#
+# Output (in the target directory):
+#     songs-00000.jsonl[.gz], ...  - one song record per line, optionally gzip compressed
+#     index.json                   - offset index: for every shard its size, the number of records and the byte offset of
+#                                    every block of --block-size records. Compressed shards write each block as a separate
+#                                    gzip member so a reader can start at any block. etl.py --workers uses it to hand byte
+#                                    ranges of one shard to separate workers (see etl.shard_ranges).
+#
+# Included functions:
+#     pack_songs          - pack song files into shards and write the offset index
+#     main                - main function parses arguments and packs the song tree
+#
+
+import os
+import json
+import gzip
+import argparse
+from etl import get_files, SONG_SHARD_INDEX
+from compression import open_compressed
+
+
+def pack_songs(source_path, target_path, shard_size=100000, block_size=1000, compress=False):
+    """
+    Pack song files into json lines shards and write the offset index
+    Parameters:
+      source_path - filepath to the song_data tree
+      target_path - directory to write the shards and index to
+      shard_size - number of song records per shard
+      block_size - number of song records per indexed block
+      compress - gzip compress the shards
+    Returns:
+      the offset index (also written to index.json)
+    """
+    
+    os.makedirs(target_path, exist_ok=True)
+    all_files = sorted(get_files(source_path))
+    suffix = '.jsonl.gz' if compress else '.jsonl'
+    
+    index = {'compressed': compress, 'block_size': block_size, 'shards': []}
+    for shard_no, start in enumerate(range(0, len(all_files), shard_size)):
+        shard_files = all_files[start:start + shard_size]
+        shard_name = f'songs-{shard_no:05d}{suffix}'
+        blocks = []
+        
+        with open(os.path.join(target_path, shard_name), 'wb') as shard:
+            for block_start in range(0, len(shard_files), block_size):
+                lines = []
+                for filepath in shard_files[block_start:block_start + block_size]:
+                    with open_compressed(filepath) as json_file:
+                        # song files hold a single record - re-serialise it so every record is exactly one line
+                        lines.append(json.dumps(json.load(json_file)) + '\n')
+                data = ''.join(lines).encode('utf-8')
+                
+                blocks.append([block_start, shard.tell()])
+                shard.write(gzip.compress(data) if compress else data)
+            size = shard.tell()
+                
+        index['shards'].append({'file': shard_name, 'size': size, 'records': len(shard_files), 'blocks': blocks})
+        print(f'Packed {len(shard_files)} songs into {shard_name}')
+        
+    with open(os.path.join(target_path, SONG_SHARD_INDEX), 'w') as index_file:
+        json.dump(index, index_file, indent=1)
+        
+    return index
+
+
+def main():
+    """
+    main function parses arguments and packs the song tree
+    Parameters: none
+    """
+    
+    parser = argparse.ArgumentParser(description='Pack the song_data tree into json lines shards for etl.py --song-shards.')
+    parser.add_argument('source', nargs='?', default='data/song_data', help='song_data tree to pack')
+    parser.add_argument('target', nargs='?', default='data/song_shards', help='directory to write the shards to')
+    parser.add_argument('--shard-size', type=int, default=100000, help='number of songs per shard')
+    parser.add_argument('--block-size', type=int, default=1000, help='number of songs per indexed block')
+    parser.add_argument('--compress', action='store_true', help='gzip compress the shards')
+    args = parser.parse_args()
+    
+    pack_songs(args.source, args.target, args.shard_size, args.block_size, args.compress)
+
+
+if __name__ == "__main__":
+    main()
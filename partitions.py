@@ -0,0 +1,156 @@
+# partitions.py
+#
+# PURPOSE: Range partitioning of the songplays fact table on start_time. Partitions are created automatically as new log
+#          dates appear and a single partition can be truncated and reloaded or detached.
+#
+# Included functions:
+#     partition_bounds   - lower and upper bound of the partition holding a timestamp
+#     partition_name     - name of the partition starting at a lower bound
+#     SongplayPartitions - class: partition grain plus the set of partitions known to exist, creates missing ones
+#
+
+from datetime import datetime, timedelta
+from sql_queries import (songplay_partition_grain_select, songplay_partition_select, songplay_partition_create,
+                         songplay_partition_truncate, songplay_partition_detach, rollup_range_delete)
+
+PARTITION_GRAINS = ('none', 'year', 'month', 'week', 'day')
+
+
+def partition_bounds(ts, grain):
+    """
+    Lower (inclusive) and upper (exclusive) bound of the partition holding a timestamp - the same as DATE_TRUNC for the grain
+    Parameters:
+      ts - timestamp (datetime or pandas Timestamp)
+      grain - one of PARTITION_GRAINS except 'none'
+    """
+    
+    if grain == 'year':
+        return datetime(ts.year, 1, 1), datetime(ts.year + 1, 1, 1)
+    if grain == 'month':
+        lower = datetime(ts.year, ts.month, 1)
+        return lower, datetime(ts.year + ts.month // 12, ts.month % 12 + 1, 1)
+    lower = datetime(ts.year, ts.month, ts.day)
+    if grain == 'week':
+        lower -= timedelta(days=lower.weekday())     # weeks start on monday
+        return lower, lower + timedelta(days=7)
+    return lower, lower + timedelta(days=1)
+
+
+def partition_name(lower):
+    """
+    Name of the partition starting at a lower bound
+    Parameters:
+      lower - lower bound of the partition
+    """
+    
+    return f"songplays_p{lower:%Y%m%d}"
+
+
+class SongplayPartitions:
+    """
+    Partition grain of songplays plus the set of partitions known to exist. ensure() creates the partitions missing for a
+    batch of start times. With a target the loaders only write the rows that fall into that one partition.
+    """
+    
+    def __init__(self, grain, known=(), target=None):
+        """
+        Parameters:
+          grain - partition grain (one of PARTITION_GRAINS except 'none')
+          known - names of the partitions that already exist
+          target - optional timestamp - restrict the load to the partition holding it
+        """
+        
+        self.grain = grain
+        self.known = set(known)
+        self.target = partition_bounds(target, grain) if target is not None else None
+    
+    @classmethod
+    def load(cls, cur, target=None):
+        """
+        Read the partition grain and existing partitions of songplays from the database
+        Parameters:
+          cur - cursor
+          target - optional timestamp - restrict the load to the partition holding it
+        Returns:
+          SongplayPartitions or None when songplays is not partitioned
+        """
+        
+        cur.execute(songplay_partition_grain_select)
+        comment = (cur.fetchone() or [None])[0] or ''
+        if not comment.startswith('partition_grain='):
+            return None
+        partitions = cls(comment.split('=', 1)[1], target=target)
+        partitions.reload(cur)
+        return partitions
+    
+    def reload(self, cur):
+        """re-read the existing partitions - used after a rollback may have removed partitions created by the load"""
+        
+        cur.execute(songplay_partition_select)
+        self.known = {name for name, in cur.fetchall()}
+    
+    def ensure(self, cur, timestamps):
+        """
+        Create the partitions missing for a batch of start times
+        Parameters:
+          cur - cursor
+          timestamps - iterable of songplay start times
+        """
+        
+        for lower, upper in {partition_bounds(ts, self.grain) for ts in timestamps}:
+            name = partition_name(lower)
+            if name not in self.known:
+                cur.execute(songplay_partition_create.format(name=name), (lower, upper))
+                self.known.add(name)
+                print(f"Created partition {name} of songplays for {lower:%Y-%m-%d} to {upper:%Y-%m-%d}.")
+    
+    def prepare(self, cur, rows):
+        """
+        Make a batch of time, user and songplay rows ready to be written - with a target only the time and songplay rows
+        inside the target partition are kept (users are left as they are) - and create the partitions the songplays need
+        Parameters:
+          cur - cursor
+          rows - dictionary of table name to list of row tuples (start_time first in the time and songplay rows)
+        """
+        
+        if self.target is not None:
+            lower, upper = self.target
+            rows = {'time': [row for row in rows['time'] if lower <= row[0] < upper],
+                    'user': [],
+                    'songplay': [row for row in rows['songplay'] if lower <= row[0] < upper]}
+        self.ensure(cur, (row[0] for row in rows['songplay']))
+        return rows
+    
+    def truncate(self, cur, ts):
+        """
+        Truncate the partition holding a timestamp (if it exists) - its range is removed from the rollups as well
+        Parameters:
+          cur - cursor
+          ts - timestamp within the partition
+        """
+        
+        lower, upper = partition_bounds(ts, self.grain)
+        name = partition_name(lower)
+        if name in self.known:
+            cur.execute(songplay_partition_truncate.format(name=name))
+            cur.execute(rollup_range_delete, {'lower': lower, 'upper': upper})
+            print(f"Truncated partition {name} of songplays.")
+        return name
+    
+    def detach(self, cur, ts):
+        """
+        Detach the partition holding a timestamp - it stays behind as a standalone table e.g. for archiving and its range is
+        removed from the rollups
+        Parameters:
+          cur - cursor
+          ts - timestamp within the partition
+        """
+        
+        lower, upper = partition_bounds(ts, self.grain)
+        name = partition_name(lower)
+        if name in self.known:
+            cur.execute(songplay_partition_detach.format(name=name))
+            cur.execute(rollup_range_delete, {'lower': lower, 'upper': upper})
+            self.known.discard(name)
+            print(f"Detached partition {name} of songplays - it is now a standalone table.")
+        return name
@@ -0,0 +1,127 @@
+# prepared.py
+#
+# PURPOSE: Server-side prepared statements for the hot statements of the Sparkify ETL (see prepared_statements in
+#          sql_queries.py). Each statement is PREPAREd once per connection and then run with EXECUTE so Postgres parses and
+#          plans it once instead of for every row. The prepared statements of a connection are held in a bounded cache keyed
+#          by statement name - the least recently used one is DEALLOCATEd when the cache is full.
+#
+# Included functions:
+#     prepare_sql          - translate a statement with %s parameters into the PREPARE statement for it
+#     PreparedStatements   - class: bounded cache of the statements prepared on one connection
+#     PreparedCursor       - class: cursor wrapper running the registered statements through their prepared versions
+#     PreparedConnection   - class: connection wrapper returning prepared cursors sharing one statement cache
+#
+
+import re
+from collections import OrderedDict
+from sql_queries import prepared_statements
+
+_parameter_re = re.compile(r'%s|%%')
+
+
+def prepare_sql(name, query, parameter_types):
+    """
+    Translate a statement with %s parameters into the PREPARE statement for it
+    Parameters:
+      name - statement name
+      query - statement with positional %s parameters
+      parameter_types - list of the Postgres types of the parameters in order
+    """
+    
+    position = iter(range(1, len(parameter_types) + 1))
+    body = _parameter_re.sub(lambda match: f'${next(position)}' if match.group() == '%s' else '%', query.strip())
+    return f"PREPARE {name} ({', '.join(parameter_types)}) AS {body}"
+
+
+class PreparedStatements:
+    """
+    Bounded cache of the statements prepared on one connection. Prepared statements belong to the session and are kept
+    through commits and rollbacks so a statement is only prepared again after it was evicted.
+    """
+    
+    def __init__(self, max_statements=32, statements=prepared_statements):
+        """
+        Parameters:
+          max_statements - number of statements kept prepared at a time
+          statements - dictionary of statement name to (statement, parameter types)
+        """
+        
+        self.max_statements = max_statements
+        self.names = {query: name for name, (query, parameter_types) in statements.items()}
+        self.statements = statements
+        self.prepared = OrderedDict()      # statement name -> EXECUTE statement, least recently used first
+        self.prepares = 0
+        self.evictions = 0
+    
+    def execute_sql(self, cur, name):
+        """
+        Get the EXECUTE statement of a registered statement, preparing it first when it is not in the cache
+        Parameters:
+          cur - raw cursor of the connection
+          name - statement name
+        """
+        
+        if name in self.prepared:
+            self.prepared.move_to_end(name)
+            return self.prepared[name]
+        
+        if len(self.prepared) >= self.max_statements:
+            evicted, _ = self.prepared.popitem(last=False)
+            cur.execute(f"DEALLOCATE {evicted}")
+            self.evictions += 1
+        query, parameter_types = self.statements[name]
+        cur.execute(prepare_sql(name, query, parameter_types))
+        self.prepares += 1
+        self.prepared[name] = f"EXECUTE {name} ({', '.join(['%s'] * len(parameter_types))})"
+        return self.prepared[name]
+    
+    def stats(self):
+        """return cache counters as a dictionary"""
+        
+        return {'statements_prepared': self.prepares, 'statements_evicted': self.evictions}
+
+
+class PreparedCursor:
+    """
+    Cursor wrapper running the statements registered in PreparedStatements through their prepared versions - callers keep
+    passing the statements of sql_queries.py and any other statement is passed through unchanged. executemany runs the
+    prepared statement for every row of the batch so one plan serves the whole batch.
+    """
+    
+    def __init__(self, cursor, statements):
+        self._cursor = cursor
+        self._statements = statements
+    
+    def execute(self, query, params=None):
+        name = self._statements.names.get(query)
+        if name is not None and params is not None:
+            query = self._statements.execute_sql(self._cursor, name)
+        self._cursor.execute(query, params)
+    
+    def executemany(self, query, params_seq):
+        name = self._statements.names.get(query)
+        if name is not None:
+            query = self._statements.execute_sql(self._cursor, name)
+        self._cursor.executemany(query, params_seq)
+    
+    def __iter__(self):
+        return iter(self._cursor)
+    
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class PreparedConnection:
+    """
+    Connection wrapper returning prepared cursors - all cursors of the connection share its statement cache
+    """
+    
+    def __init__(self, conn, max_statements=32):
+        self._conn = conn
+        self.statements = PreparedStatements(max_statements)
+    
+    def cursor(self):
+        return PreparedCursor(self._conn.cursor(), self.statements)
+    
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
@@ -0,0 +1,351 @@
+# sinks.py
+#
+# PURPOSE: Pluggable database sinks for the Sparkify ETL scripts. Every sink exposes a DB-API style connection and cursor
+#          (cursor, execute, fetchone, fetchall, commit, ...) so the loaders in etl.py run unchanged against any of them.
+#
+# Sinks:
+#     postgres  - the Sparkify Postgres database (original behaviour)
+#     sqlite    - a local SQLite file using the star schema from sql_queries.py translated to SQLite
+#     null      - discards everything and only counts the rows sent to each table, to measure parse/transform throughput
+#
+# The sink is chosen with the SPARKIFY_SINK environment variable (default postgres) or the --sink argument of the scripts.
+# The Postgres server is SPARKIFY_DSN (a libpq connection string or URI without the database - default the local student
+# login) or the --dsn argument of the scripts. The SQLite file is SPARKIFY_SQLITE_PATH (default sparkifydb.sqlite in the 
+# working directory).
+#
+# Included functions:
+#     connect            - connect to the sparkify database of a sink
+#     connection_pool    - pool of connections to the sparkify database for parallel writers
+#     create_database    - drop and recreate the sparkify database of a sink
+#     table_queries      - get the drop and create table statements for a sink
+#     execute_values     - write a batch of rows with one multi-row statement (postgres) or an executemany (other sinks)
+#     SQLiteConnection   - class: DB-API wrapper translating the Postgres flavoured SQL in sql_queries.py to SQLite
+#     NullConnection     - class: connection of the null sink
+#
+
+import os
+import re
+import sqlite3
+from datetime import datetime
+from sql_queries import (drop_table_queries, create_table_queries, sqlite_create_table_queries, songplay_table_create,
+                         songplay_partition_comment, songplay_natural_key_create, song_match_key_create, match_normalizations,
+                         user_history_table_create)
+from song_lookup import song_match_key
+
+try:
+    import psycopg2
+    import psycopg2.pool
+    import psycopg2.extras
+except ImportError:                    # the sqlite and null sinks do not need psycopg2
+    psycopg2 = None
+
+SINKS = ('postgres', 'sqlite', 'null')
+DEFAULT_SINK = os.environ.get('SPARKIFY_SINK', 'postgres')
+POSTGRES_DSN = os.environ.get('SPARKIFY_DSN', "host=127.0.0.1 user=student password=student")
+SQLITE_PATH = os.environ.get('SPARKIFY_SQLITE_PATH', 'sparkifydb.sqlite')
+
+# database errors raised by any sink
+Error = (sqlite3.Error,) + ((psycopg2.Error,) if psycopg2 else ())
+
+
+def connect(sink=None, dbname='sparkifydb', dsn=None):
+    """
+    Connect to the sparkify database of a sink
+    Parameters:
+      sink - one of SINKS (None uses DEFAULT_SINK)
+      dbname - Postgres database name (ignored by the other sinks)
+      dsn - Postgres connection string without the database (None uses POSTGRES_DSN)
+    """
+    
+    sink = sink or DEFAULT_SINK
+    if sink == 'postgres':
+        if psycopg2 is None:
+            raise RuntimeError("The postgres sink requires psycopg2 - install it or choose the sqlite or null sink.")
+        return psycopg2.connect(dsn or POSTGRES_DSN, dbname=dbname)
+    if sink == 'sqlite':
+        return SQLiteConnection(SQLITE_PATH)
+    if sink == 'null':
+        return NullConnection()
+    raise ValueError(f"Unknown sink '{sink}' - expected one of {SINKS}.")
+
+
+def connection_pool(size, sink=None, dsn=None):
+    """
+    Create a pool of connections to the sparkify database - connections are opened as they are first requested
+    Parameters:
+      size - maximum number of connections
+      sink - one of SINKS (None uses DEFAULT_SINK) - only postgres supports concurrent writers
+      dsn - Postgres connection string without the database (None uses POSTGRES_DSN)
+    Returns:
+      psycopg2 ThreadedConnectionPool (getconn, putconn, closeall)
+    """
+    
+    if (sink or DEFAULT_SINK) != 'postgres':
+        raise ValueError("A connection pool requires the postgres sink.")
+    if psycopg2 is None:
+        raise RuntimeError("The postgres sink requires psycopg2 - install it or choose the sqlite or null sink.")
+    return psycopg2.pool.ThreadedConnectionPool(1, size, dsn or POSTGRES_DSN, dbname='sparkifydb')
+
+
+def create_database(sink=None, dsn=None):
+    """
+    Drop and recreate the sparkify database of a sink
+    Parameters:
+      sink - one of SINKS (None uses DEFAULT_SINK)
+      dsn - Postgres connection string without the database (None uses POSTGRES_DSN)
+    Returns:
+      cur, conn - cursor and autocommit connection to the new database
+    """
+    
+    sink = sink or DEFAULT_SINK
+    if sink == 'postgres':
+        # connect to default database
+        conn = connect(sink, dbname='studentdb', dsn=dsn)
+        conn.set_session(autocommit=True)
+        cur = conn.cursor()
+
+        # create sparkify database with UTF8 encoding
+        cur.execute("DROP DATABASE IF EXISTS sparkifydb")
+        cur.execute("CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
+
+        # close connection to default database
+        conn.close()
+    elif sink == 'sqlite' and os.path.exists(SQLITE_PATH):
+        os.remove(SQLITE_PATH)
+    
+    # connect to new sparkify database
+    conn = connect(sink, dsn=dsn)
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+    
+    return cur, conn
+
+
+def table_queries(sink=None, partition_grain='month', natural_key=False, match_normalization='exact', user_history=False):
+    """
+    Get the drop and create table statements for a sink
+    Parameters:
+      sink - one of SINKS (None uses DEFAULT_SINK)
+      partition_grain - range partition grain of songplays on postgres (see partitions.py - 'none' keeps a single table)
+      natural_key - add the unique natural key index of songplays so reloaded songplays are skipped
+      match_normalization - normalization of title and artist name in the song match key on postgres (see match_normalizations)
+      user_history - add the user_history table keeping a type 2 history of users on postgres (see user_history.py)
+    Returns:
+      drop_queries, create_queries - dictionaries of table name to statement
+    """
+    
+    if (sink or DEFAULT_SINK) == 'sqlite':
+        create_queries = dict(sqlite_create_table_queries)
+    else:
+        create_queries = dict(create_table_queries)
+        if partition_grain == 'none':
+            create_queries['songplay'] = songplay_table_create
+            del create_queries['songplay_partitioning']
+        else:
+            create_queries['songplay_partitioning'] = songplay_partition_comment.format(grain=partition_grain)
+        normalize = match_normalizations[match_normalization]
+        create_queries['song_match_key'] = song_match_key_create.format(title=normalize.format('title'), 
+                                                                        artist=normalize.format('artist'),
+                                                                        normalization=match_normalization)
+        if user_history:
+            create_queries['user_history'] = user_history_table_create
+    if natural_key:
+        create_queries['songplay_natural_key'] = songplay_natural_key_create
+    return drop_table_queries, create_queries
+
+
+def execute_values(cur, values_query, row_query, rows):
+    """
+    Write a batch of rows with one statement - psycopg2.extras.execute_values expands the VALUES %s of values_query to all
+    rows of the batch on postgres. The sqlite and null sinks have no such statement and run row_query with executemany.
+    Parameters:
+      cur - cursor of any sink (or a wrapper of it)
+      values_query - statement with a single VALUES %s placeholder for all rows
+      row_query - the same statement for a single row with one %s per column
+      rows - list of row tuples
+    """
+    
+    if not rows:
+        return
+    if hasattr(cur, 'mogrify'):        # psycopg2 cursors only
+        psycopg2.extras.execute_values(cur, values_query, rows, page_size=len(rows))
+    else:
+        cur.executemany(row_query, rows)
+
+
+# SQLITE SINK
+
+def _adapt_timestamp(value):
+    return value.isoformat(' ')
+
+
+def _convert_timestamp(value):
+    return datetime.fromisoformat(value.decode())
+
+
+sqlite3.register_adapter(datetime, _adapt_timestamp)
+sqlite3.register_converter('TIMESTAMP', _convert_timestamp)
+try:
+    import pandas as pd
+    sqlite3.register_adapter(pd.Timestamp, _adapt_timestamp)
+except ImportError:
+    pass
+
+
+class SQLiteCursor:
+    """
+    Cursor translating the Postgres flavoured statements in sql_queries.py (%s parameters, DEFAULT values) to SQLite
+    """
+    
+    _translations = {}
+    
+    def __init__(self, cursor):
+        self._cursor = cursor
+    
+    @classmethod
+    def translate(cls, query):
+        """translate a statement once and cache the result"""
+        
+        if query not in cls._translations:
+            sql = re.sub(r'%\((\w+)\)s', r':\1', query)
+            sql = sql.replace('%s', '?').replace('%%', '%')
+            sql = re.sub(r'VALUES \(DEFAULT,', 'VALUES (NULL,', sql)
+            cls._translations[query] = sql
+        return cls._translations[query]
+    
+    def execute(self, query, params=None):
+        if params is None:
+            self._cursor.execute(self.translate(query))
+        else:
+            self._cursor.execute(self.translate(query), tuple(params) if not isinstance(params, dict) else params)
+        
+    def executemany(self, query, params_seq):
+        self._cursor.executemany(self.translate(query), [tuple(params) for params in params_seq])
+    
+    def copy_expert(self, sql, file):
+        raise NotImplementedError("COPY is not available with the sqlite sink - use the row load mode.")
+    
+    def fetchone(self):
+        return self._cursor.fetchone()
+    
+    def fetchall(self):
+        return self._cursor.fetchall()
+    
+    def __iter__(self):
+        return iter(self._cursor)
+    
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+    
+    def close(self):
+        self._cursor.close()
+        
+
+class SQLiteConnection:
+    """
+    Connection of the sqlite sink with the psycopg2 methods used by the ETL scripts
+    """
+    
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        self._conn.create_function('song_match_key', 3, song_match_key, deterministic=True)
+        
+    def set_session(self, autocommit=False):
+        self._conn.isolation_level = None if autocommit else ''
+        
+    @property
+    def autocommit(self):
+        return self._conn.isolation_level is None
+        
+    def cursor(self):
+        return SQLiteCursor(self._conn.cursor())
+    
+    def commit(self):
+        self._conn.commit()
+        
+    def rollback(self):
+        self._conn.rollback()
+        
+    def close(self):
+        self._conn.close()
+
+
+# NULL SINK
+
+class NullCursor:
+    """
+    Cursor that discards every statement and counts the rows sent to each table. Queries return no rows, except
+    SELECT COUNT(*) FROM table which returns the number of rows sent to that table.
+    """
+    
+    _insert_re = re.compile(r'^\s*INSERT\s+INTO\s+(\w+)', re.IGNORECASE)
+    _copy_re = re.compile(r'^\s*COPY\s+(\w+)', re.IGNORECASE)
+    _count_re = re.compile(r'^\s*SELECT\s+COUNT\(\*\)\s+FROM\s+(\w+)\s*$', re.IGNORECASE)
+    
+    def __init__(self, row_counts):
+        self.row_counts = row_counts
+        self._result = []
+        self.rowcount = 0
+        
+    def _count(self, table, rows):
+        self.row_counts[table] = self.row_counts.get(table, 0) + rows
+        self.rowcount = rows
+        
+    def execute(self, query, params=None):
+        self._result = []
+        self.rowcount = 0
+        match = self._insert_re.match(query)
+        if match and params is not None:
+            self._count(match.group(1), 1)
+            return
+        match = self._count_re.match(query)
+        if match:
+            self._result = [(self.row_counts.get(match.group(1), 0),)]
+            
+    def executemany(self, query, params_seq):
+        match = self._insert_re.match(query)
+        if match:
+            self._count(match.group(1), sum(1 for params in params_seq))
+        
+    def copy_expert(self, sql, file):
+        self._count(self._copy_re.match(sql).group(1), sum(1 for line in file))
+        
+    def fetchone(self):
+        return self._result.pop(0) if self._result else None
+    
+    def fetchall(self):
+        result, self._result = self._result, []
+        return result
+    
+    def __iter__(self):
+        return iter(self.fetchall())
+    
+    def close(self):
+        pass
+        
+
+class NullConnection:
+    """
+    Connection of the null sink - row_counts holds the number of rows sent to each table
+    """
+    
+    def __init__(self):
+        self.row_counts = {}
+        self.autocommit = False
+        
+    def set_session(self, autocommit=False):
+        self.autocommit = autocommit
+        
+    def cursor(self):
+        return NullCursor(self.row_counts)
+    
+    def commit(self):
+        pass
+        
+    def rollback(self):
+        pass
+        
+    def close(self):
+        pass
@@ -0,0 +1,133 @@
+# song_cache.py
+#
+# PURPOSE: Persistent columnar cache of the song catalog for the Sparkify ETL. The catalog (songs joined to artists) is
+#          stored as one NumPy array file per column which is memory-mapped when read. The cache is keyed on a fingerprint of
+#          the song source files so it is invalidated as soon as a source file is added, removed or modified.
+#
+# Included functions:
+#     source_fingerprint - fingerprint of a set of source files from their paths, sizes and modification times
+#     SongCache          - class: song catalog cache directory (one .npy file per column plus catalog.json)
+#
+
+import os
+import json
+import hashlib
+import numpy as np
+from song_lookup import song_duration_key
+from sql_queries import song_catalog_cache_select
+
+CATALOG_COLUMNS = ('song_id', 'title', 'artist_id', 'year', 'duration', 'duration_key',
+                   'artist_name', 'artist_location', 'artist_latitude', 'artist_longitude')
+NULL_STRING = '\x1e'     # marks a NULL in the string columns - the record separator never occurs in the catalog
+
+
+def source_fingerprint(filepaths):
+    """
+    Fingerprint of a set of source files - only the paths, sizes and modification times are read, not the content
+    Parameters:
+      filepaths - list of source files
+    """
+    
+    digest = hashlib.sha256()
+    for filepath in sorted(filepaths):
+        stat = os.stat(filepath)
+        digest.update(f'{filepath}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class SongCache:
+    """
+    Song catalog cache directory holding one .npy file per column (fixed width strings with NULL_STRING for nulls, floats
+    with NaN for nulls) and catalog.json with the fingerprint of the source files and the row count. catalog.json is
+    written last and removed first so a partly written cache is never taken for a valid one.
+    """
+    
+    def __init__(self, path):
+        """
+        Parameters:
+          path - cache directory
+        """
+        
+        self.path = path
+        self._meta_path = os.path.join(path, 'catalog.json')
+    
+    def read(self):
+        """return the metadata of the cache or None when there is no valid cache"""
+        
+        try:
+            with open(self._meta_path) as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+    
+    def valid(self, fingerprint):
+        """
+        True when the cache was written for source files with this fingerprint
+        Parameters:
+          fingerprint - fingerprint of the current song source files (see source_fingerprint)
+        """
+        
+        meta = self.read()
+        return meta is not None and meta['fingerprint'] == fingerprint
+    
+    def column(self, name):
+        """
+        memory-map one column of the catalog
+        Parameters:
+          name - one of CATALOG_COLUMNS
+        """
+        
+        return np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+    
+    def text_column(self, name):
+        """
+        read one string column of the catalog as a list with None for the NULLs
+        Parameters:
+          name - one of CATALOG_COLUMNS holding strings
+        """
+        
+        return [None if value == NULL_STRING else value for value in self.column(name).tolist()]
+    
+    def write(self, cur, fingerprint):
+        """
+        Write the song catalog as loaded in the database to the cache
+        Parameters:
+          cur - cursor
+          fingerprint - fingerprint of the song source files the database was loaded from
+        Returns:
+          number of songs written
+        """
+        
+        cur.execute(song_catalog_cache_select)
+        rows = cur.fetchall()
+        song_ids, titles, artist_ids, years, durations, names, locations, latitudes, longitudes = zip(*rows) if rows else [()] * 9
+        
+        def strings(values):
+            return np.array([NULL_STRING if value is None else value for value in values], dtype=str)
+        
+        def floats(values):
+            return np.array([np.nan if value is None else float(value) for value in values], dtype=np.float64)
+        
+        columns = {'song_id': strings(song_ids),
+                   'title': strings(titles),
+                   'artist_id': strings(artist_ids),
+                   'year': np.array([value or 0 for value in years], dtype=np.int32),
+                   'duration': floats(durations),
+                   'duration_key': np.array([song_duration_key(value) if value is not None else -1 for value in durations],
+                                            dtype=np.int64),
+                   'artist_name': strings(names),
+                   'artist_location': strings(locations),
+                   'artist_latitude': floats(latitudes),
+                   'artist_longitude': floats(longitudes)}
+        
+        os.makedirs(self.path, exist_ok=True)
+        if os.path.exists(self._meta_path):
+            os.remove(self._meta_path)
+        for name, values in columns.items():
+            np.save(os.path.join(self.path, name + '.npy'), values)
+        
+        tmp_path = self._meta_path + '.tmp'
+        with open(tmp_path, 'w') as meta_file:
+            json.dump({'fingerprint': fingerprint, 'songs': len(rows), 'columns': list(CATALOG_COLUMNS)}, meta_file)
+        os.replace(tmp_path, self._meta_path)
+        return len(rows)
@@ -0,0 +1,230 @@
+# song_lookup.py
+#
+# PURPOSE: In-memory song/artist lookup used by the ETL to resolve song_id/artist_id for log events without
+#          running the song_select query once per event.
+#
+# Included functions:
+#     song_duration_key  - round a song duration the way Postgres rounds songs.duration
+#     event_length_key   - round a log event length the way Postgres rounds the song_select parameter
+#     song_match_key     - build the song match key the way the song_match_key() database function does
+#     match_normalization - read the normalization of the song match key from the database
+#     SongLookup         - class: hash index keyed on the song match key with optional memory bound and counters
+#
+
+import re
+import string
+from collections import OrderedDict
+from decimal import Decimal, ROUND_HALF_UP
+from sql_queries import song_select, song_catalog_select, match_normalization_select
+
+MATCH_NORMALIZATIONS = ('exact', 'fold')
+_ascii_lower = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+_ascii_space_re = re.compile(r'[ \t\n\r\f\v]+')
+
+
+def song_duration_key(duration):
+    """
+    Round a song duration the way Postgres does for songs.duration: stored as NUMERIC(12,2) then ROUND() to an integer
+    Parameters:
+      duration - song duration from a song file (float) or the songs table (Decimal)
+    """
+    
+    if duration is None:
+        return None
+    value = Decimal(str(duration)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+    return int(value.quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+def event_length_key(length):
+    """
+    Round a log event length the way Postgres does for the NUMERIC length of song_select and songplay_stage (round half 
+    away from zero, the same as song_duration_key)
+    Parameters:
+      length - song length from a log event
+    """
+    
+    if length is None or length != length:      # None or NaN never match in SQL either
+        return None
+    return int(Decimal(str(length)).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+def song_match_key(title, artist_name, duration_key, normalization='exact'):
+    """
+    Build the song match key the way the song_match_key() database function does (see sql_queries.py) - 'fold' lower cases 
+    and collapses whitespace in ASCII only, as Postgres does under the C collation
+    Parameters:
+      title - song title
+      artist_name - artist name
+      duration_key - rounded duration (see song_duration_key and event_length_key)
+      normalization - one of MATCH_NORMALIZATIONS
+    Returns:
+      key or None when any part is missing (a NULL key never matches in SQL either)
+    """
+    
+    if title is None or artist_name is None or duration_key is None:
+        return None
+    if normalization == 'fold':
+        title = _ascii_space_re.sub(' ', title).translate(_ascii_lower).strip(' ')
+        artist_name = _ascii_space_re.sub(' ', artist_name).translate(_ascii_lower).strip(' ')
+    return f"{title}\x1f{artist_name}\x1f{int(duration_key)}"
+
+
+def match_normalization(cur):
+    """
+    Read the normalization of the song match key from the comment of the song_match_key() function (postgres only)
+    Parameters:
+      cur - cursor
+    """
+    
+    cur.execute(match_normalization_select)
+    comment = (cur.fetchone() or [None])[0] or ''
+    return comment.split('=', 1)[1] if comment.startswith('match_normalization=') else 'exact'
+
+
+class SongLookup:
+    """
+    Hash index of the song catalog keyed on the song match key (title, artist name, rounded duration).
+    
+    With max_entries=None the whole catalog is held in memory: call load() once and/or add() each song as it is parsed.
+    With max_entries set the index is a bounded LRU cache; keys not in the cache are resolved with song_select on the
+    supplied cursor and the result (including no match) is cached, evicting the least recently used entry when full.
+    """
+    
+    def __init__(self, max_entries=None, normalization='exact'):
+        """
+        Parameters:
+          max_entries - maximum number of keys held in memory (None means unbounded, i.e. the whole catalog)
+          normalization - normalization of the song match key in the database (see match_normalization)
+        """
+        
+        self.max_entries = max_entries
+        self.normalization = normalization
+        self.index = OrderedDict()
+        self.hits = 0             # events resolved to a song
+        self.misses = 0           # events without a matching song
+        self.cache_hits = 0       # bounded mode: keys answered from memory
+        self.db_lookups = 0       # bounded mode: keys answered by a song_select round trip
+        self.evictions = 0
+        
+    @property
+    def bounded(self):
+        return self.max_entries is not None
+        
+    def _store(self, key, value):
+        """store a key, evicting the least recently used entry when the bound is reached"""
+        
+        if key in self.index:
+            self.index.move_to_end(key)
+            return
+        self.index[key] = value
+        if self.bounded and len(self.index) > self.max_entries:
+            self.index.popitem(last=False)
+            self.evictions += 1
+            
+    def _wins(self, key, song_id):
+        """a song replaces the one stored for its key if it has a lower song_id - the song song_select picks"""
+        
+        current = self.index.get(key)
+        return current is None or song_id < current[0]
+            
+    def add(self, title, artist_name, duration, song_id, artist_id):
+        """
+        Add one song to the index - of the songs sharing a key the lowest song_id wins, as with song_select
+        Parameters:
+          title - song title
+          artist_name - artist name
+          duration - song duration
+          song_id - song id
+          artist_id - artist id
+        """
+        
+        key = song_match_key(title, artist_name, song_duration_key(duration), self.normalization)
+        if key is not None and self._wins(key, song_id):
+            self.index.pop(key, None)       # replace a cached 'no match' or a song with a higher song_id for this key
+            self._store(key, (song_id, artist_id))
+        
+    def load(self, cur):
+        """
+        Load the song catalog with a single query - the match keys are taken as stored in songs
+        Parameters:
+          cur - cursor
+        """
+        
+        cur.execute(song_catalog_select)
+        for key, song_id, artist_id in cur:
+            if self._wins(key, song_id):
+                self.index.pop(key, None)
+                self._store(key, (song_id, artist_id))
+            
+    def load_cache(self, cache):
+        """
+        Load the song catalog from a SongCache instead of the database - the index is built straight from the cached columns.
+        Songs with a NULL title, artist name or duration have no match key and are skipped, as in the database.
+        Parameters:
+          cache - valid SongCache
+        """
+        
+        keys = (song_match_key(title, artist_name, None if duration_key < 0 else duration_key, self.normalization)
+                for title, artist_name, duration_key in zip(cache.text_column('title'), cache.text_column('artist_name'), 
+                                                            cache.column('duration_key').tolist()))
+        values = zip(cache.column('song_id').tolist(), cache.column('artist_id').tolist())
+        for key, value in zip(keys, values):
+            if key is not None and self._wins(key, value[0]):
+                self.index.pop(key, None)
+                self._store(key, value)
+                
+    def reload(self, cur):
+        """
+        Discard the index and rebuild it from the database - used after a rollback removed songs it had been given
+        Parameters:
+          cur - cursor
+        """
+        
+        self.index.clear()
+        if not self.bounded:
+            self.load(cur)
+            
+    def lookup(self, cur, song, artist, length):
+        """
+        Resolve song_id and artist_id for a log event
+        Parameters:
+          cur - cursor (only used in bounded mode for keys not held in memory)
+          song - song title from the log event
+          artist - artist name from the log event
+          length - song length from the log event
+        Returns:
+          (song_id, artist_id) or (None, None) when there is no match
+        """
+        
+        key = song_match_key(song, artist, event_length_key(length), self.normalization)
+        if key in self.index:
+            result = self.index[key]
+            if self.bounded:
+                self.index.move_to_end(key)
+                self.cache_hits += 1
+        elif self.bounded and key is not None:
+            cur.execute(song_select, (song, artist, length))
+            result = cur.fetchone()
+            self.db_lookups += 1
+            self._store(key, result)
+        else:
+            result = None
+            
+        if result:
+            self.hits += 1
+            return result
+        self.misses += 1
+        return None, None
+    
+    def stats(self):
+        """return hit/miss counters as a dictionary"""
+        
+        lookups = self.hits + self.misses
+        return {'entries': len(self.index),
+                'lookups': lookups,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'cache_hits': self.cache_hits,
+                'db_lookups': self.db_lookups,
+                'evictions': self.evictions}
@@ -8,9 +8,14 @@
 
 songplay_table_drop = "DROP TABLE IF EXISTS songplays"
 user_table_drop =     "DROP TABLE IF EXISTS users"
+user_history_table_drop = "DROP TABLE IF EXISTS user_history"
 song_table_drop =     "DROP TABLE IF EXISTS songs"
 artist_table_drop =   "DROP TABLE IF EXISTS artists"
 time_table_drop =     "DROP TABLE IF EXISTS time"
+manifest_table_drop = "DROP TABLE IF EXISTS load_manifest"
+deferred_table_drop = "DROP TABLE IF EXISTS load_deferred"
+hourly_level_table_drop = "DROP TABLE IF EXISTS plays_hourly_level"
+daily_user_table_drop = "DROP TABLE IF EXISTS plays_daily_user"
 
 # CREATE TABLES
 
@@ -23,8 +28,10 @@ CREATE TABLE IF NOT EXISTS songplays(
     song_id VARCHAR(256),
     artist_id VARCHAR(256),
     session_id INT NOT NULL,
+    item_in_session INT,
     location VARCHAR(256),
     user_agent VARCHAR(256),
+    match_key VARCHAR(1024),
     PRIMARY KEY (songplay_id),
     FOREIGN KEY (start_time) REFERENCES time(start_time),
     FOREIGN KEY (user_id) REFERENCES users(user_id),
@@ -46,6 +53,39 @@ CREATE TABLE IF NOT EXISTS songplays(
 #       be applied to the secondary, natural key. I suspect that a natural key for this data is some concatenation of columns such as
 #       session_id, song_id or start_time and perhaps user_id. However without being able to study the source system/data in detail I'm
 #       not sure about the best definition of that key so I'm leaving this as designed since it is not raising alarms with the reviewers.
+#       Update: item_in_session (itemInSession of the source events) is now loaded and create_tables.py --natural-key adds a unique
+#       index on (session_id, user_id, start_time, item_in_session). Every songplay insert path uses ON CONFLICT DO NOTHING so with
+#       the natural key a retried or reloaded file skips the rows already present; without it the behaviour is unchanged.
+
+songplay_table_create_partitioned = ("""
+CREATE TABLE IF NOT EXISTS songplays(
+    songplay_id BIGSERIAL,         
+    start_time TIMESTAMP NOT NULL,
+    user_id INT NOT NULL,
+    level VARCHAR(256),
+    song_id VARCHAR(256),
+    artist_id VARCHAR(256),
+    session_id INT NOT NULL,
+    item_in_session INT,
+    location VARCHAR(256),
+    user_agent VARCHAR(256),
+    match_key VARCHAR(1024),
+    PRIMARY KEY (songplay_id, start_time),
+    FOREIGN KEY (start_time) REFERENCES time(start_time),
+    FOREIGN KEY (user_id) REFERENCES users(user_id),
+    FOREIGN KEY (song_id) REFERENCES songs(song_id),
+    FOREIGN KEY (artist_id) REFERENCES artists(artist_id)
+) PARTITION BY RANGE (start_time)
+""")
+songplay_partition_comment = "COMMENT ON TABLE songplays IS 'partition_grain={grain}'"
+
+songplay_unmatched_index_create = "CREATE INDEX songplays_unmatched_idx ON songplays (match_key) WHERE song_id IS NULL"
+# Note: match_key is the song match key of an event that matched no song when it was loaded (NULL once matched) so songplays
+#       can be resolved later against songs that arrive after their events without the source logs (see etl.py 
+#       backfill_songplays). The partial index only holds the unmatched songplays.
+# Note: By default songplays is range partitioned on start_time, one partition per month (create_tables.py --partition-grain 
+#       year|month|week|day|none). The grain is kept in the table comment so etl.py knows which partitions to create as new log
+#       dates appear. A primary key of a partitioned table must include the partition key, hence (songplay_id, start_time).
 
 user_table_create = ("""
 CREATE TABLE IF NOT EXISTS users(
@@ -56,6 +96,26 @@ CREATE TABLE IF NOT EXISTS users(
     level VARCHAR(256))
 """)
 
+user_history_table_create = ("""
+CREATE TABLE IF NOT EXISTS user_history(
+    user_id INT NOT NULL,
+    first_name VARCHAR(256),
+    last_name VARCHAR(256),
+    gender VARCHAR(256),
+    level VARCHAR(256),
+    valid_from TIMESTAMP NOT NULL,
+    valid_to TIMESTAMP,
+    last_seen TIMESTAMP NOT NULL,
+    PRIMARY KEY (user_id, valid_from),
+    FOREIGN KEY (user_id) REFERENCES users(user_id)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS user_history_current_idx ON user_history (user_id) WHERE valid_to IS NULL;
+""")
+# Note: Optional type 2 history of users (create_tables.py --user-history). users stays a type 1 dimension holding the latest
+#       state of each user so the songplays foreign key is unchanged. A version is valid from the ts of the first event showing
+#       the new state up to (not including) valid_to; the current version has valid_to NULL. last_seen is the ts of the last
+#       event known with the state of the version, so events loaded later can be placed before or after it by their ts.
+
 song_table_create = ("""
 CREATE TABLE IF NOT EXISTS songs(
     song_id VARCHAR(256) PRIMARY KEY,
@@ -63,12 +123,48 @@ CREATE TABLE IF NOT EXISTS songs(
     artist_id VARCHAR(256),
     year INT,
     duration NUMERIC(12,2),
+    match_key VARCHAR(1024),
+    loaded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (artist_id) REFERENCES artists(artist_id)
 );
 CREATE INDEX songs_artists_fk_idx ON songs (artist_id);
+CREATE INDEX songs_match_key_idx ON songs (match_key);
 """)
 # could add non unique index to artist_id to support FK function...
 # experiment with adding one index to support one FK just to see how it works in Postgres...
+# Note: match_key is the song match key (title, artist name, rounded duration) built by song_match_key() below. It is filled
+#       by a trigger on every insert path (single row, COPY, ELT) so matching a log event is a single probe of
+#       songs_match_key_idx instead of a scan of songs joined to artists.
+# Note: loaded_at is the start of the transaction that added the song, which tells the songplays backfill which songs are new.
+
+song_match_key_create = ("""
+CREATE OR REPLACE FUNCTION song_match_key(title TEXT, artist TEXT, duration_key BIGINT) RETURNS TEXT
+LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+AS $$ SELECT {title} || CHR(31) || {artist} || CHR(31) || duration_key $$;
+COMMENT ON FUNCTION song_match_key(TEXT, TEXT, BIGINT) IS 'match_normalization={normalization}';
+""")
+# Note: {title}/{artist} are filled with one of match_normalizations (create_tables.py --match-normalization) so the function,
+#       the stored keys and the probes of the loaders always agree. It is a plain SQL expression which Postgres inlines.
+#       song_lookup.song_match_key is the same key built in Python for the in-memory song lookup.
+
+match_normalizations = {'exact': '{0}',
+                        'fold':  "BTRIM(LOWER(REGEXP_REPLACE({0} COLLATE \"C\", '\\s+', ' ', 'g')))"}
+# Note: 'fold' ignores case and collapses runs of whitespace. The C collation restricts both to ASCII so the result does not
+#       depend on the database locale and can be reproduced exactly in Python.
+
+song_match_key_trigger_create = ("""
+CREATE OR REPLACE FUNCTION song_match_key_fill() RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    NEW.match_key := song_match_key(NEW.title, (SELECT name FROM artists WHERE artist_id = NEW.artist_id), 
+                                    ROUND(NEW.duration)::BIGINT);
+    RETURN NEW;
+END $$;
+CREATE TRIGGER songs_match_key_fill BEFORE INSERT OR UPDATE OF title, artist_id, duration ON songs
+    FOR EACH ROW EXECUTE FUNCTION song_match_key_fill();
+""")
+# Note: The artist row always exists when a song is inserted (foreign key) since every loader writes artists before songs.
 
 artist_table_create = ("""
 CREATE TABLE IF NOT EXISTS artists(
@@ -91,12 +187,127 @@ CREATE TABLE IF NOT EXISTS time(
 """)
 # Note: This table should probably have a grain of one second or perhaps one minute. Currently it may have a grain of microseconds.
 #       A side effect of this is that there is almost one time dimension row for every songplays fact row.
+#       etl.py --time-grain second|minute|hour truncates start_time in both time and songplays to a coarser grain.
+
+hourly_level_table_create = ("""
+CREATE TABLE IF NOT EXISTS plays_hourly_level(
+    hour TIMESTAMP NOT NULL,
+    level VARCHAR(256) NOT NULL,
+    plays BIGINT NOT NULL,
+    PRIMARY KEY (hour, level))
+""")
+
+daily_user_table_create = ("""
+CREATE TABLE IF NOT EXISTS plays_daily_user(
+    day DATE NOT NULL,
+    user_id INT NOT NULL,
+    plays BIGINT NOT NULL,
+    PRIMARY KEY (day, user_id))
+""")
+# Note: Rollups of songplays for the dashboards (plays per hour and level, plays per day and user) so those queries read a few
+#       thousand rows instead of scanning the fact table. etl.py adds the songplays each batch actually inserted (conflicts
+#       skipped by the natural key are not counted), truncating or detaching a songplays partition removes its range, and
+#       create_tables.py --rebuild-rollups recomputes them from songplays e.g. after a backfill. A NULL level counts as 'unknown'.
+
+manifest_table_create = ("""
+CREATE TABLE IF NOT EXISTS load_manifest(
+    file_path VARCHAR(1024) PRIMARY KEY,
+    file_size BIGINT NOT NULL,
+    file_mtime DOUBLE PRECISION NOT NULL,
+    content_hash VARCHAR(64) NOT NULL,
+    status VARCHAR(16) NOT NULL,
+    loaded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)
+""")
+# Note: The load manifest records every source file processed by etl.py so that a rerun only loads new or changed files.
+#       file_size and file_mtime are a cheap first check; content_hash (sha256) decides whether a touched file really changed.
+
+# CREATE TABLES (SQLITE)
+# Note: The same star schema translated to SQLite for the sqlite sink (see sinks.py). SQLite has no BIGSERIAL so songplay_id
+#       is an INTEGER PRIMARY KEY AUTOINCREMENT and NUMERIC columns are stored as REAL. Foreign keys are declared as above.
+
+sqlite_songplay_table_create = ("""
+CREATE TABLE IF NOT EXISTS songplays(
+    songplay_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    start_time TIMESTAMP NOT NULL,
+    user_id INT NOT NULL,
+    level VARCHAR(256),
+    song_id VARCHAR(256),
+    artist_id VARCHAR(256),
+    session_id INT NOT NULL,
+    item_in_session INT,
+    location VARCHAR(256),
+    user_agent VARCHAR(256),
+    match_key VARCHAR(1024),
+    FOREIGN KEY (start_time) REFERENCES time(start_time),
+    FOREIGN KEY (user_id) REFERENCES users(user_id),
+    FOREIGN KEY (song_id) REFERENCES songs(song_id),
+    FOREIGN KEY (artist_id) REFERENCES artists(artist_id)
+)
+""")
+
+sqlite_song_table_create = ("""
+CREATE TABLE IF NOT EXISTS songs(
+    song_id VARCHAR(256) PRIMARY KEY,
+    title VARCHAR(256),
+    artist_id VARCHAR(256),
+    year INT,
+    duration NUMERIC(12,2),
+    match_key VARCHAR(1024),
+    loaded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (artist_id) REFERENCES artists(artist_id)
+)
+""")
+
+sqlite_song_index_create = "CREATE INDEX IF NOT EXISTS songs_artists_fk_idx ON songs (artist_id)"
+sqlite_song_match_key_index_create = "CREATE INDEX IF NOT EXISTS songs_match_key_idx ON songs (match_key)"
+
+sqlite_song_match_key_trigger_create = ("""
+CREATE TRIGGER IF NOT EXISTS songs_match_key_fill AFTER INSERT ON songs
+BEGIN
+    UPDATE songs 
+       SET match_key = song_match_key(NEW.title, (SELECT name FROM artists WHERE artist_id = NEW.artist_id), 
+                                      CAST(ROUND(ROUND(NEW.duration, 2)) AS INTEGER))
+     WHERE song_id = NEW.song_id;
+END
+""")
+# Note: song_match_key is registered as a Python function on every SQLite connection (see sinks.py). SQLite keeps the
+#       duration as a REAL, so it is rounded to cents first like NUMERIC(12,2) in Postgres (see song_duration_key).
+
+sqlite_manifest_table_create = ("""
+CREATE TABLE IF NOT EXISTS load_manifest(
+    file_path VARCHAR(1024) PRIMARY KEY,
+    file_size BIGINT NOT NULL,
+    file_mtime DOUBLE PRECISION NOT NULL,
+    content_hash VARCHAR(64) NOT NULL,
+    status VARCHAR(16) NOT NULL,
+    loaded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)
+""")
+
+deferred_table_create = ("""
+CREATE TABLE IF NOT EXISTS load_deferred(
+    object_name VARCHAR(256) PRIMARY KEY,
+    object_type VARCHAR(16) NOT NULL,
+    table_name VARCHAR(256) NOT NULL,
+    definition TEXT NOT NULL,
+    deferred_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)
+""")
+# Note: Foreign keys and secondary indexes dropped for a bulk load (create_tables.py --defer-constraints or etl.py 
+#       --defer-constraints) are recorded here with their definition so they can be restored even after a failed load.
+
+songplay_natural_key_create = ("""
+CREATE UNIQUE INDEX IF NOT EXISTS songplays_natural_key_idx ON songplays (session_id, user_id, start_time, item_in_session)
+""")
+# Note: start_time is part of the key anyway and has to be since a unique index of a partitioned table must include the partition key.
 
 # INSERT RECORDS
 
 songplay_table_insert = ("""
-INSERT INTO songplays(songplay_id, start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) 
-VALUES (DEFAULT, %s, %s, %s, %s, %s, %s, %s, %s)
+INSERT INTO songplays(songplay_id, start_time, user_id, level, song_id, artist_id, session_id, item_in_session, location, user_agent,
+                      match_key) 
+VALUES (DEFAULT, %s, %s, %s, %s, %s, %s, %s, %s, %s, 
+        CASE WHEN %s IS NULL THEN song_match_key(%s, %s, CAST(ROUND(CAST(%s AS NUMERIC)) AS BIGINT)) END)
+ON CONFLICT 
+  DO NOTHING
 """)
 
 user_table_insert = ("""
@@ -110,6 +321,19 @@ ON CONFLICT (user_id)
     level = EXCLUDED.level
 """)
 
+user_table_upsert = ("""
+INSERT INTO users(user_id, first_name, last_name, gender, level) 
+VALUES %s
+ON CONFLICT (user_id) 
+  DO UPDATE SET
+    first_name = EXCLUDED.first_name,
+    last_name = EXCLUDED.last_name,
+    gender = EXCLUDED.gender,
+    level = EXCLUDED.level
+""")
+# Note: user_table_insert for a whole batch at once - psycopg2.extras.execute_values expands VALUES %s to one row per user.
+#       The batch holds one row per user_id (see etl.latest_user_rows), as ON CONFLICT DO UPDATE cannot touch a row twice.
+
 song_table_insert = ("""
 INSERT INTO songs(song_id, title, artist_id, year, duration) 
 VALUES (%s, %s, %s, %s, %s)
@@ -141,6 +365,391 @@ ON CONFLICT (start_time)
   DO NOTHING
 """)
 
+user_history_select = ("""
+SELECT user_id, first_name, last_name, gender, level, valid_from, valid_to, last_seen
+  FROM user_history
+ WHERE user_id = ANY(%s)
+ ORDER BY user_id, valid_from
+""")
+
+user_history_delete = "DELETE FROM user_history WHERE user_id = %s AND valid_from = %s"
+
+user_history_upsert = ("""
+INSERT INTO user_history(user_id, first_name, last_name, gender, level, valid_from, valid_to, last_seen) 
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+ON CONFLICT (user_id, valid_from) 
+  DO UPDATE SET
+    first_name = EXCLUDED.first_name,
+    last_name = EXCLUDED.last_name,
+    gender = EXCLUDED.gender,
+    level = EXCLUDED.level,
+    valid_to = EXCLUDED.valid_to,
+    last_seen = EXCLUDED.last_seen
+""")
+# Note: Closed versions are upserted before the new current version of a user, so user_history_current_idx never sees two
+#       current versions of one user.
+
+user_history_exists_select = "SELECT to_regclass('user_history') IS NOT NULL"
+
+hourly_level_upsert = ("""
+INSERT INTO plays_hourly_level(hour, level, plays) 
+VALUES (%s, %s, %s)
+ON CONFLICT (hour, level) 
+  DO UPDATE SET
+    plays = plays_hourly_level.plays + EXCLUDED.plays
+""")
+
+daily_user_upsert = ("""
+INSERT INTO plays_daily_user(day, user_id, plays) 
+VALUES (%s, %s, %s)
+ON CONFLICT (day, user_id) 
+  DO UPDATE SET
+    plays = plays_daily_user.plays + EXCLUDED.plays
+""")
+
+songplay_rollup_insert = ("""
+WITH inserted AS (
+{insert}
+RETURNING start_time, user_id, level
+), hourly AS (
+INSERT INTO plays_hourly_level(hour, level, plays)
+SELECT DATE_TRUNC('hour', start_time), COALESCE(level, 'unknown'), COUNT(*)
+  FROM inserted
+ GROUP BY 1, 2
+ ORDER BY 1, 2
+ON CONFLICT (hour, level) 
+  DO UPDATE SET
+    plays = plays_hourly_level.plays + EXCLUDED.plays
+), daily AS (
+INSERT INTO plays_daily_user(day, user_id, plays)
+SELECT start_time::DATE, user_id, COUNT(*)
+  FROM inserted
+ GROUP BY 1, 2
+ ORDER BY 1, 2
+ON CONFLICT (day, user_id) 
+  DO UPDATE SET
+    plays = plays_daily_user.plays + EXCLUDED.plays
+)
+SELECT COUNT(*) FROM inserted
+""")
+# Note: Wraps one of the set based songplays inserts ({insert}) so the rollups are updated from exactly the rows it inserted
+#       in the same statement. Returns the number of songplays inserted.
+
+rollup_range_delete = ("""
+DELETE FROM plays_hourly_level WHERE hour >= %(lower)s AND hour < %(upper)s;
+DELETE FROM plays_daily_user WHERE day >= %(lower)s AND day < %(upper)s;
+""")
+
+rollup_range_rebuild = ("""
+INSERT INTO plays_hourly_level(hour, level, plays)
+SELECT DATE_TRUNC('hour', start_time), COALESCE(level, 'unknown'), COUNT(*)
+  FROM songplays
+ WHERE start_time >= %(lower)s AND start_time < %(upper)s
+ GROUP BY 1, 2;
+INSERT INTO plays_daily_user(day, user_id, plays)
+SELECT start_time::DATE, user_id, COUNT(*)
+  FROM songplays
+ WHERE start_time >= %(lower)s AND start_time < %(upper)s
+ GROUP BY 1, 2;
+""")
+# Note: The bounds are dates (or '-infinity'/'infinity') so a range always covers whole days of both rollups.
+
+# LATE ARRIVING SONGS
+
+load_start_select = "SELECT LOCALTIMESTAMP"
+# Note: The same clock as the loaded_at default of songs - every song added after this query has a loaded_at at or after it.
+
+songplay_backfill_update = ("""
+WITH resolved AS (
+UPDATE songplays sp
+   SET song_id = m.song_id,
+       artist_id = m.artist_id,
+       match_key = NULL
+  FROM (SELECT DISTINCT ON (s.match_key) s.match_key, s.song_id, s.artist_id
+          FROM songs s
+         WHERE s.match_key IN (SELECT match_key FROM songs WHERE loaded_at >= %(since)s)
+         ORDER BY s.match_key, s.song_id) m
+ WHERE sp.match_key = m.match_key
+   AND sp.song_id IS NULL
+   AND sp.start_time >= %(lower)s AND sp.start_time < %(upper)s
+RETURNING sp.tableoid::regclass::text AS partition
+)
+SELECT partition, COUNT(*)
+  FROM resolved
+ GROUP BY partition
+ ORDER BY partition
+""")
+# Note: Resolves the unmatched songplays whose match key belongs to a song loaded since %(since)s in one join - each partition
+#       is probed through songplays_unmatched_idx and the start_time bounds prune the partitions outside the range. A key
+#       is resolved to the same song the loaders would pick (the lowest song_id). Returns the rows resolved per partition.
+#       The rollups count plays regardless of the song so they are not affected.
+
+# BULK LOAD (COPY)
+# Note: The bulk load path streams each file's rows into temporary staging tables using COPY FROM STDIN and then merges
+#       them into the DWH tables with a single set based statement per table. The merge statements keep the same conflict
+#       handling as the single row inserts above so both load paths produce the same table contents.
+
+time_stage_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS time_stage(
+    LIKE time)
+""")
+
+user_stage_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS user_stage(
+    LIKE users)
+""")
+
+songplay_stage_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS songplay_stage(
+    seq INT NOT NULL,
+    start_time TIMESTAMP NOT NULL,
+    user_id INT NOT NULL,
+    level VARCHAR(256),
+    song VARCHAR(256),
+    artist VARCHAR(256),
+    length NUMERIC,
+    session_id INT NOT NULL,
+    item_in_session INT,
+    location VARCHAR(256),
+    user_agent VARCHAR(256))
+""")
+# Note: length is NUMERIC so ROUND() rounds half away from zero, exactly as for the NUMERIC parameter of song_select and in
+#       song_lookup.event_length_key - ROUND() of a double precision would round half to even.
+
+songplay_resolved_stage_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS songplay_resolved_stage(
+    seq INT NOT NULL,
+    start_time TIMESTAMP NOT NULL,
+    user_id INT NOT NULL,
+    level VARCHAR(256),
+    song_id VARCHAR(256),
+    artist_id VARCHAR(256),
+    session_id INT NOT NULL,
+    item_in_session INT,
+    location VARCHAR(256),
+    user_agent VARCHAR(256),
+    match_key VARCHAR(1024))
+""")
+
+time_stage_copy =     "COPY time_stage(start_time, hour, day, week, month, year, weekday) FROM STDIN"
+user_stage_copy =     "COPY user_stage(user_id, first_name, last_name, gender, level) FROM STDIN"
+songplay_stage_copy = ("COPY songplay_stage(seq, start_time, user_id, level, song, artist, length, session_id, item_in_session, "
+                       "location, user_agent) FROM STDIN")
+
+time_table_merge = ("""
+INSERT INTO time(start_time, hour, day, week, month, year, weekday)
+SELECT start_time, hour, day, week, month, year, weekday
+  FROM time_stage
+ ORDER BY start_time
+ON CONFLICT (start_time) 
+  DO NOTHING
+""")
+
+user_table_merge = ("""
+INSERT INTO users(user_id, first_name, last_name, gender, level)
+SELECT user_id, first_name, last_name, gender, level
+  FROM user_stage
+ ORDER BY user_id
+ON CONFLICT (user_id) 
+  DO UPDATE SET
+    first_name = EXCLUDED.first_name,
+    last_name = EXCLUDED.last_name,
+    gender = EXCLUDED.gender,
+    level = EXCLUDED.level
+""")
+# Note: ON CONFLICT DO UPDATE cannot touch the same row twice in one statement so user_stage must hold one row per user_id.
+#       The ETL reduces each file to the last row per user which is the row the single row upserts would have left behind.
+# Note: The merges and the rollup upserts write their rows in key order so concurrent writers (etl.py --writers) lock shared
+#       dimension and rollup rows in the same order and cannot deadlock.
+
+songplay_table_merge = ("""
+INSERT INTO songplays(start_time, user_id, level, song_id, artist_id, session_id, item_in_session, location, user_agent, match_key)
+SELECT sp.start_time, sp.user_id, sp.level, m.song_id, m.artist_id, sp.session_id, sp.item_in_session, sp.location, sp.user_agent,
+       CASE WHEN m.song_id IS NULL THEN k.match_key END
+  FROM songplay_stage sp
+ CROSS JOIN LATERAL (SELECT song_match_key(sp.song, sp.artist, ROUND(sp.length)::BIGINT) AS match_key) k
+  LEFT JOIN LATERAL (SELECT s.song_id, s.artist_id
+                       FROM songs s
+                      WHERE s.match_key = k.match_key
+                      ORDER BY s.song_id
+                      LIMIT 1) m ON TRUE
+ ORDER BY sp.seq
+ON CONFLICT 
+  DO NOTHING
+""")
+
+songplay_resolved_stage_copy = ("COPY songplay_resolved_stage(seq, start_time, user_id, level, song_id, artist_id, session_id, "
+                                "item_in_session, location, user_agent, match_key) FROM STDIN")
+
+songplay_resolved_merge = ("""
+INSERT INTO songplays(start_time, user_id, level, song_id, artist_id, session_id, item_in_session, location, user_agent, match_key)
+SELECT start_time, user_id, level, song_id, artist_id, session_id, item_in_session, location, user_agent, match_key
+  FROM songplay_resolved_stage
+ ORDER BY seq
+ON CONFLICT 
+  DO NOTHING
+""")
+# Note: Used instead of songplay_table_merge when song_id/artist_id have already been resolved by the in-memory song lookup. The
+#       rows go through a staging table rather than straight into songplays since COPY cannot skip natural key duplicates.
+
+stage_table_truncate = "TRUNCATE time_stage, user_stage, songplay_stage, songplay_resolved_stage"
+
+manifest_table_upsert = ("""
+INSERT INTO load_manifest(file_path, file_size, file_mtime, content_hash, status, loaded_at) 
+VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+ON CONFLICT (file_path) 
+  DO UPDATE SET
+    file_size = EXCLUDED.file_size,
+    file_mtime = EXCLUDED.file_mtime,
+    content_hash = EXCLUDED.content_hash,
+    status = EXCLUDED.status,
+    loaded_at = EXCLUDED.loaded_at
+""")
+
+manifest_select = ("""
+SELECT file_path, file_size, file_mtime, content_hash
+  FROM load_manifest
+ WHERE status = 'loaded'
+""")
+
+manifest_table_clear = "DELETE FROM load_manifest"
+
+# ELT (RAW STAGING + SET BASED TRANSFORMS)
+# Note: The ELT load path copies the raw json records into staging tables without parsing them in Python and then fills the
+#       DWH tables with one set based INSERT ... SELECT per table so Postgres does all the transformation work. seq records the
+#       order the records were staged in so duplicate handling matches the file by file load (first artist/song wins, last
+#       user row wins, songplay_id follows file order).
+
+staging_events_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS staging_events(
+    seq BIGSERIAL,
+    data JSONB NOT NULL)
+""")
+
+staging_songs_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS staging_songs(
+    seq BIGSERIAL,
+    data JSONB NOT NULL)
+""")
+
+staging_events_copy = "COPY staging_events(data) FROM STDIN"
+staging_songs_copy =  "COPY staging_songs(data) FROM STDIN"
+
+staging_table_truncate = "TRUNCATE staging_events, staging_songs RESTART IDENTITY"
+
+artist_table_transform = ("""
+INSERT INTO artists(artist_id, name, location, latitude, longitude)
+SELECT DISTINCT ON (data->>'artist_id')
+       data->>'artist_id', data->>'artist_name', data->>'artist_location', 
+       (data->>'artist_latitude')::NUMERIC, (data->>'artist_longitude')::NUMERIC
+  FROM staging_songs
+ ORDER BY data->>'artist_id', seq
+ON CONFLICT (artist_id) 
+  DO NOTHING
+""")
+
+song_table_transform = ("""
+INSERT INTO songs(song_id, title, artist_id, year, duration)
+SELECT DISTINCT ON (data->>'song_id')
+       data->>'song_id', data->>'title', data->>'artist_id', (data->>'year')::INT, (data->>'duration')::NUMERIC
+  FROM staging_songs
+ ORDER BY data->>'song_id', seq
+ON CONFLICT (song_id) 
+  DO NOTHING
+""")
+
+time_table_transform = ("""
+INSERT INTO time(start_time, hour, day, week, month, year, weekday)
+SELECT start_time, EXTRACT(hour FROM start_time), EXTRACT(day FROM start_time), EXTRACT(week FROM start_time),
+       EXTRACT(month FROM start_time), EXTRACT(year FROM start_time), EXTRACT(isodow FROM start_time) - 1   -- Monday=0, Sunday=6
+  FROM (SELECT DISTINCT DATE_TRUNC(%(time_grain)s, TIMESTAMP 'epoch' + (data->>'ts')::BIGINT * INTERVAL '1 millisecond') AS start_time
+          FROM staging_events
+         WHERE data->>'page' = 'NextSong') e
+ON CONFLICT (start_time) 
+  DO NOTHING
+""")
+
+user_table_transform = ("""
+INSERT INTO users(user_id, first_name, last_name, gender, level)
+SELECT DISTINCT ON ((data->>'userId')::INT)
+       (data->>'userId')::INT, data->>'firstName', data->>'lastName', data->>'gender', data->>'level'
+  FROM staging_events
+ WHERE data->>'page' = 'NextSong'
+ ORDER BY (data->>'userId')::INT, (data->>'ts')::BIGINT DESC, seq DESC
+ON CONFLICT (user_id) 
+  DO UPDATE SET
+    first_name = EXCLUDED.first_name,
+    last_name = EXCLUDED.last_name,
+    gender = EXCLUDED.gender,
+    level = EXCLUDED.level
+""")
+
+songplay_table_transform = ("""
+INSERT INTO songplays(start_time, user_id, level, song_id, artist_id, session_id, item_in_session, location, user_agent, match_key)
+SELECT DATE_TRUNC(%(time_grain)s, TIMESTAMP 'epoch' + (e.data->>'ts')::BIGINT * INTERVAL '1 millisecond'), 
+       (e.data->>'userId')::INT, e.data->>'level',
+       m.song_id, m.artist_id, (e.data->>'sessionId')::INT, (e.data->>'itemInSession')::INT, 
+       e.data->>'location', e.data->>'userAgent', CASE WHEN m.song_id IS NULL THEN k.match_key END
+  FROM staging_events e
+ CROSS JOIN LATERAL (SELECT song_match_key(e.data->>'song', e.data->>'artist', 
+                                           ROUND((e.data->>'length')::NUMERIC)::BIGINT) AS match_key) k
+  LEFT JOIN (SELECT DISTINCT ON (s.match_key) s.match_key, s.song_id, s.artist_id
+               FROM songs s
+              WHERE s.match_key IS NOT NULL
+              ORDER BY s.match_key, s.song_id) m 
+         ON m.match_key = k.match_key
+ WHERE e.data->>'page' = 'NextSong'
+ ORDER BY e.seq
+ON CONFLICT 
+  DO NOTHING
+""")
+# Note: %(time_grain)s is the grain of the time dimension (millisecond, second, minute or hour) passed in by the ETL.
+# Note: The song match is a single equi-join on the song match key (title, artist name, rounded duration) which Postgres runs as a hash join
+#       instead of one song_select query per event. The catalog is reduced to one song per key so no event can match twice.
+
+user_history_transform_select = ("""
+SELECT user_id, first_name, last_name, gender, level, ts
+  FROM (SELECT e.*, LAG(ROW(first_name, last_name, gender, level)) OVER (PARTITION BY user_id ORDER BY ts) AS previous,
+               LEAD(ROW(first_name, last_name, gender, level)) OVER (PARTITION BY user_id ORDER BY ts) AS next
+          FROM (SELECT DISTINCT ON ((data->>'userId')::INT, (data->>'ts')::BIGINT)
+                       (data->>'userId')::INT AS user_id, data->>'firstName' AS first_name, data->>'lastName' AS last_name, 
+                       data->>'gender' AS gender, data->>'level' AS level, (data->>'ts')::BIGINT AS ts
+                  FROM staging_events
+                 WHERE data->>'page' = 'NextSong'
+                 ORDER BY (data->>'userId')::INT, (data->>'ts')::BIGINT, seq DESC) e) v
+ WHERE previous IS DISTINCT FROM ROW(first_name, last_name, gender, level)
+    OR next IS DISTINCT FROM ROW(first_name, last_name, gender, level)
+ ORDER BY user_id, ts
+""")
+# Note: Used by the ELT load with user history - of the last event per user and ts only the first and the last event of each
+#       run of events with the same state are returned, which are the only rows UserHistory.write needs (see user_history.py).
+
+time_key_select = "SELECT start_time FROM time"
+
+# SONGPLAYS PARTITIONS
+# Note: Partitions are named songplays_pYYYYMMDD after their lower bound. A detached partition stays behind as a standalone table.
+
+songplay_partition_grain_select = "SELECT obj_description(to_regclass('songplays'), 'pg_class')"
+
+songplay_partition_select = ("""
+SELECT c.relname
+  FROM pg_inherits i
+  JOIN pg_class c ON c.oid = i.inhrelid
+ WHERE i.inhparent = 'songplays'::regclass
+""")
+
+songplay_partition_create = "CREATE TABLE IF NOT EXISTS {name} PARTITION OF songplays FOR VALUES FROM (%s) TO (%s)"
+songplay_partition_truncate = "TRUNCATE {name}"
+songplay_partition_detach = "ALTER TABLE songplays DETACH PARTITION {name}"
+
+staging_event_time_select = ("""
+SELECT DISTINCT DATE_TRUNC(%(partition_grain)s, TIMESTAMP 'epoch' + (data->>'ts')::BIGINT * INTERVAL '1 millisecond')
+  FROM staging_events
+ WHERE data->>'page' = 'NextSong'
+""")
+# Note: Used by the ELT load to create the songplays partitions needed before songplay_table_transform runs - one row per
+#       partition (the start of its range) is returned rather than every distinct start_time.
+
 # COUNT TABLES
 
 songplay_table_count = "SELECT COUNT(*) FROM songplays"
@@ -152,30 +761,159 @@ time_table_count =     "SELECT COUNT(*) FROM time"
 # FIND SONGS
 
 song_select = ("""
-SELECT s.song_id, a.artist_id
+SELECT s.song_id, s.artist_id
+  FROM songs s
+ WHERE s.match_key = song_match_key(%s, %s, CAST(ROUND(CAST(%s AS NUMERIC)) AS BIGINT))   -- relax match criteria slightly to avoid ETL rounding errors
+ ORDER BY s.song_id
+ LIMIT 1
+""")
+# Note: song_match_key() of the constant parameters is evaluated once so the query is a single probe of songs_match_key_idx.
+#       Songs sharing a match key resolve to the lowest song_id, as in every other loader (see SongLookup).
+
+song_catalog_select = ("""
+SELECT s.match_key, s.song_id, s.artist_id
+  FROM songs s
+ WHERE s.match_key IS NOT NULL
+""")
+# Note: Used to load the whole song catalog once so the ETL can match log events in memory instead of running song_select per event.
+
+song_catalog_cache_select = ("""
+SELECT s.song_id, s.title, s.artist_id, s.year, s.duration, a.name, a.location, a.latitude, a.longitude
   FROM songs s
   JOIN artists a ON s.artist_id = a.artist_id 
- WHERE s.title = %s
-   AND a.name = %s
-   AND ROUND(s.duration) = ROUND(%s)   -- relax match criteria slightly to avoid ETL rounding errors
+ ORDER BY s.song_id
+""")
+# Note: Used to write the columnar song catalog cache (see song_cache.py).
+
+match_normalization_select = "SELECT obj_description(to_regprocedure('song_match_key(text,text,bigint)'), 'pg_proc')"
+
+# LOAD TIME CONSTRAINT MANAGEMENT
+# Note: For a large load the foreign keys and secondary (non unique) indexes of the DWH tables are dropped and their 
+#       definitions saved in load_deferred. Afterwards foreign keys are added back NOT VALID (no table scan under an
+#       exclusive lock) and then validated, and indexes are rebuilt CONCURRENTLY. Primary keys are kept since the 
+#       ON CONFLICT clauses of the loaders depend on them. Postgres supports neither NOT VALID foreign keys nor concurrent 
+#       index builds on a partitioned table, so on the partitioned songplays they are added back in one (validating) step.
+
+deferrable_constraint_select = ("""
+SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid)
+  FROM pg_constraint
+ WHERE contype = 'f'
+   AND conrelid = ANY(%s::regclass[])
+""")
+
+secondary_index_select = ("""
+SELECT i.indrelid::regclass::text, c.relname, pg_get_indexdef(i.indexrelid)
+  FROM pg_index i
+  JOIN pg_class c ON c.oid = i.indexrelid
+ WHERE i.indrelid = ANY(%s::regclass[])
+   AND NOT i.indisprimary
+   AND NOT i.indisunique
+   AND c.relname <> 'songs_match_key_idx'
+""")
+# Note: The song match key index is kept since the log load probes it for every event.
+
+deferred_insert = ("""
+INSERT INTO load_deferred(object_name, object_type, table_name, definition)
+VALUES (%s, %s, %s, %s)
+ON CONFLICT (object_name)
+  DO NOTHING
 """)
 
+deferred_select = ("""
+SELECT object_name, object_type, table_name, definition
+  FROM load_deferred
+ ORDER BY object_type DESC, object_name    -- indexes before constraints
+""")
+
+deferred_delete = "DELETE FROM load_deferred WHERE object_name = %s"
+
+constraint_exists_select = "SELECT convalidated FROM pg_constraint WHERE conname = %s AND conrelid = %s::regclass"
+
+partitioned_table_select = "SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass"
+
+index_valid_select = ("""
+SELECT i.indisvalid
+  FROM pg_index i
+  JOIN pg_class c ON c.oid = i.indexrelid
+ WHERE c.relname = %s
+""")
+
+constraint_drop =      "ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {name}"
+constraint_add =       "ALTER TABLE {table} ADD CONSTRAINT {name} {definition} NOT VALID"
+constraint_add_partitioned = "ALTER TABLE {table} ADD CONSTRAINT {name} {definition}"
+constraint_validate =  "ALTER TABLE {table} VALIDATE CONSTRAINT {name}"
+index_drop =           "DROP INDEX IF EXISTS {name}"
+index_drop_concurrently = "DROP INDEX CONCURRENTLY IF EXISTS {name}"
+
 # QUERY LISTS
 
 drop_table_queries   = {'songplay': songplay_table_drop, 
                         'song': song_table_drop, 
                         'artist': artist_table_drop, 
+                        'user_history': user_history_table_drop, 
                         'user': user_table_drop, 
-                        'time': time_table_drop}
+                        'time': time_table_drop,
+                        'manifest': manifest_table_drop,
+                        'deferred': deferred_table_drop,
+                        'hourly_level': hourly_level_table_drop,
+                        'daily_user': daily_user_table_drop}
 
 create_table_queries = {'time': time_table_create,
                         'user': user_table_create, 
                         'artist': artist_table_create,
+                        'song_match_key': song_match_key_create.format(title='title', artist='artist', normalization='exact'),
                         'song': song_table_create, 
-                        'songplay': songplay_table_create}
+                        'song_match_key_fill': song_match_key_trigger_create,
+                        'songplay': songplay_table_create_partitioned,
+                        'songplay_partitioning': songplay_partition_comment.format(grain='month'),
+                        'songplay_unmatched_index': songplay_unmatched_index_create,
+                        'manifest': manifest_table_create,
+                        'deferred': deferred_table_create,
+                        'hourly_level': hourly_level_table_create,
+                        'daily_user': daily_user_table_create}
+
+dwh_tables = ['songplays', 'songs', 'artists', 'users', 'time']
 
 count_table_queries = {'songplay': songplay_table_count, 
                         'song': song_table_count, 
                         'artist': artist_table_count, 
                         'user': user_table_count, 
                         'time': time_table_count}
+
+stage_table_queries = {'time': time_stage_create,
+                       'user': user_stage_create,
+                       'songplay': songplay_stage_create,
+                       'songplay_resolved': songplay_resolved_stage_create}
+
+sqlite_create_table_queries = {'time': time_table_create,
+                               'user': user_table_create, 
+                               'artist': artist_table_create,
+                               'song': sqlite_song_table_create, 
+                               'song_index': sqlite_song_index_create, 
+                               'song_match_key_index': sqlite_song_match_key_index_create,
+                               'song_match_key_fill': sqlite_song_match_key_trigger_create,
+                               'songplay': sqlite_songplay_table_create,
+                               'manifest': sqlite_manifest_table_create,
+                               'deferred': deferred_table_create,
+                               'hourly_level': hourly_level_table_create,
+                               'daily_user': daily_user_table_create}
+# Note: The time, users, artists and rollup DDL above is already valid SQLite.
+
+elt_table_queries = {'staging_events': staging_events_create,
+                     'staging_songs': staging_songs_create}
+
+elt_transform_queries = {'artist': artist_table_transform,
+                         'song': song_table_transform,
+                         'time': time_table_transform,
+                         'user': user_table_transform,
+                         'songplay': songplay_table_transform}
+
+prepared_statements = {'song_select': (song_select, ['TEXT', 'TEXT', 'NUMERIC']),
+                       'songplay_table_insert': (songplay_table_insert, ['TIMESTAMP', 'INT', 'VARCHAR', 'VARCHAR', 'VARCHAR', 'INT', 
+                                                                         'INT', 'VARCHAR', 'VARCHAR', 'VARCHAR', 'TEXT', 'TEXT', 
+                                                                         'NUMERIC']),
+                       'user_table_insert': (user_table_insert, ['INT', 'VARCHAR', 'VARCHAR', 'VARCHAR', 'VARCHAR']),
+                       'time_table_insert': (time_table_insert, ['TIMESTAMP', 'INT', 'INT', 'INT', 'INT', 'INT', 'INT'])}
+# Note: The statements run once per row (or per row of an executemany batch) by the row load mode, with the types of their
+#       parameters. They are prepared once per connection and then run with EXECUTE (see prepared.py). The event length is
+#       NUMERIC (as in the unprepared statements) so ROUND() rounds half away from zero, like song_lookup.event_length_key.
@@ -0,0 +1,35 @@
+# conftest.py
+#
+# PURPOSE: Shared pytest fixtures for the Sparkify ETL tests. The scripts live in the repository root so it is put on the
+#          import path. Checks against Postgres use the pg_cur fixture and are skipped when no server is reachable.
+#
+# Included functions:
+#     pg_cur   - fixture: cursor in a transaction on sparkifydb, rolled back after the test
+#
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sinks
+
+
+@pytest.fixture
+def pg_cur():
+    """
+    Cursor in a transaction on sparkifydb of the Postgres server (SPARKIFY_DSN - see create_tables.py) - everything the
+    test creates or replaces is rolled back afterwards, so the database is left as it was
+    """
+    
+    if sinks.psycopg2 is None:
+        pytest.skip('psycopg2 is not installed')
+    try:
+        conn = sinks.connect('postgres')
+    except sinks.Error as error:
+        pytest.skip(f'no sparkifydb on the Postgres server: {error}')
+    cur = conn.cursor()
+    yield cur
+    conn.rollback()
+    conn.close()
@@ -0,0 +1,65 @@
+# test_partitions.py
+#
+# PURPOSE: partition_bounds must give the partition Postgres routes a songplay to (DATE_TRUNC of the grain), in particular
+#          for start times on the first and last instant of a day, week, month and year.
+#
+
+from datetime import datetime
+import pandas as pd
+import pytest
+from partitions import PARTITION_GRAINS, partition_bounds, partition_name
+
+EDGES = [datetime(2018, 11, 1, 0, 0, 0),
+         datetime(2018, 11, 30, 23, 59, 59, 999999),
+         datetime(2018, 12, 1, 0, 0, 0),
+         datetime(2018, 12, 31, 23, 59, 59, 999000),
+         datetime(2019, 1, 1, 0, 0, 0),
+         datetime(2020, 2, 28, 23, 59, 59, 999999),
+         datetime(2020, 2, 29, 12, 0, 0),               # leap day
+         datetime(2020, 3, 1, 0, 0, 0),
+         datetime(2018, 11, 4, 23, 59, 59, 999999),     # sunday - last day of a week
+         datetime(2018, 11, 5, 0, 0, 0)]                # monday - first day of a week
+
+
+def test_month_bounds():
+    assert partition_bounds(datetime(2018, 11, 30, 23, 59, 59, 999999), 'month') == (datetime(2018, 11, 1),
+                                                                                      datetime(2018, 12, 1))
+    assert partition_bounds(datetime(2018, 12, 31, 23, 59, 59), 'month') == (datetime(2018, 12, 1), datetime(2019, 1, 1))
+    assert partition_bounds(datetime(2019, 1, 1), 'month') == (datetime(2019, 1, 1), datetime(2019, 2, 1))
+    assert partition_bounds(datetime(2020, 2, 29), 'month') == (datetime(2020, 2, 1), datetime(2020, 3, 1))
+
+
+def test_day_bounds():
+    assert partition_bounds(datetime(2018, 11, 30, 23, 59, 59, 999999), 'day') == (datetime(2018, 11, 30),
+                                                                                    datetime(2018, 12, 1))
+    assert partition_bounds(datetime(2018, 12, 1), 'day') == (datetime(2018, 12, 1), datetime(2018, 12, 2))
+    assert partition_bounds(datetime(2018, 12, 31, 12), 'day') == (datetime(2018, 12, 31), datetime(2019, 1, 1))
+    assert partition_bounds(datetime(2020, 2, 28, 23), 'day') == (datetime(2020, 2, 28), datetime(2020, 2, 29))
+
+
+def test_week_and_year_bounds():
+    assert partition_bounds(datetime(2018, 11, 4, 23, 59), 'week') == (datetime(2018, 10, 29), datetime(2018, 11, 5))
+    assert partition_bounds(datetime(2018, 11, 5), 'week') == (datetime(2018, 11, 5), datetime(2018, 11, 12))
+    assert partition_bounds(datetime(2018, 12, 31, 23), 'year') == (datetime(2018, 1, 1), datetime(2019, 1, 1))
+
+
+@pytest.mark.parametrize('grain', [grain for grain in PARTITION_GRAINS if grain != 'none'])
+def test_bounds_hold_the_timestamp(grain):
+    for ts in EDGES:
+        lower, upper = partition_bounds(ts, grain)
+        assert lower <= ts < upper
+        assert partition_bounds(pd.Timestamp(ts), grain) == (lower, upper)     # the loaders pass pandas timestamps
+        assert partition_bounds(lower, grain) == (lower, upper)
+        assert partition_bounds(upper, grain)[0] == upper                     # partitions are adjacent
+
+
+def test_partition_name():
+    assert partition_name(datetime(2018, 11, 1)) == 'songplays_p20181101'
+
+
+@pytest.mark.parametrize('grain', [grain for grain in PARTITION_GRAINS if grain != 'none'])
+def test_bounds_match_date_trunc(pg_cur, grain):
+    for ts in EDGES:
+        pg_cur.execute("SELECT DATE_TRUNC(%s, %s::TIMESTAMP), DATE_TRUNC(%s, %s::TIMESTAMP) + ('1 ' || %s)::INTERVAL",
+                       (grain, ts, grain, ts, grain))
+        assert partition_bounds(ts, grain) == pg_cur.fetchone(), (grain, ts)
@@ -0,0 +1,106 @@
+# test_song_lookup.py
+#
+# PURPOSE: The song match key built in Python (song_lookup.py) must be the key the song_match_key() database function and
+#          the loaders' ROUND() build, or the in-memory song lookup matches other songs than the database.
+#
+
+import pytest
+import sinks
+from song_cache import SongCache
+from song_lookup import SongLookup, song_duration_key, event_length_key, song_match_key
+from sql_queries import (song_match_key_create, match_normalizations, artist_table_create, artist_table_insert,
+                         sqlite_song_table_create, sqlite_song_match_key_trigger_create, song_table_insert)
+
+TITLES = [('Setanta matins', 'Elena'),
+          ('  Hey  Jude\t', 'The  BEATLES '),
+          ('MIXED case\nTitle', 'Artist\r\nName'),
+          ('Déjà Vu', 'BEYONCÉ'),                     # not ASCII - case is kept by 'fold'
+          ('no\u00a0break', 'x\u2003y')]                # not ASCII whitespace - kept by 'fold'
+
+LENGTHS = [0.5, 1.5, 2.5, 100.5, 217.49999, 217.5, 180.59252, 0.49, 1e-05]
+
+DURATIONS = [0.495, 2.345, 100.5, 100.49, 218.93179, 1.005]
+
+
+def test_event_length_key_rounds_half_up():
+    assert [event_length_key(length) for length in (0.5, 1.5, 2.5, 100.5, 217.49999)] == [1, 2, 3, 101, 217]
+    assert event_length_key(None) is None
+    assert event_length_key(float('nan')) is None
+
+
+def test_song_duration_key_rounds_to_cents_then_half_up():
+    assert [song_duration_key(duration) for duration in (0.495, 2.345, 100.49, 100.5)] == [1, 2, 100, 101]
+
+
+def test_fold_is_ascii_only():
+    assert song_match_key('  Hey  Jude\t', 'The  BEATLES ', 431, 'fold') == 'hey jude\x1fthe beatles\x1f431'
+    assert song_match_key('Déjà Vu', 'BEYONCÉ', 1, 'fold') == 'déjà vu\x1fbeyoncÉ\x1f1'
+    assert song_match_key('Déjà Vu', None, 1, 'fold') is None
+
+
+def test_lookup_keeps_the_lowest_song_id():
+    lookup = SongLookup()
+    for song_id in ('SOB', 'SOA', 'SOC'):
+        lookup.add('Setanta matins', 'Elena', 269.58889, song_id, 'AR' + song_id)
+    assert lookup.lookup(None, 'Setanta matins', 'Elena', 269.58889) == ('SOA', 'ARSOA')
+
+
+def test_cache_skips_songs_without_a_title_or_artist(tmp_path):
+    class CatalogCursor:
+        def execute(self, query):
+            pass
+        
+        def fetchall(self):
+            return [('SOA', None, 'ARA', 2018, 200.0, 'Elena', None, None, None),
+                    ('SOB', 'Setanta matins', 'ARB', 2018, 200.0, None, None, None, None),
+                    ('SOC', 'Setanta matins', 'ARC', 2018, 200.0, 'Elena', 'Dublin', 53.3, -6.2)]
+    
+    cache = SongCache(str(tmp_path))
+    assert cache.write(CatalogCursor(), 'fingerprint') == 3
+    assert cache.text_column('title') == [None, 'Setanta matins', 'Setanta matins']
+    lookup = SongLookup()
+    lookup.load_cache(cache)
+    assert dict(lookup.index) == {song_match_key('Setanta matins', 'Elena', 200): ('SOC', 'ARC')}
+
+
+@pytest.mark.parametrize('normalization', sorted(match_normalizations))
+def test_event_key_matches_sql(pg_cur, normalization):
+    normalize = match_normalizations[normalization]
+    pg_cur.execute(song_match_key_create.format(title=normalize.format('title'), artist=normalize.format('artist'),
+                                                normalization=normalization))
+    for title, artist in TITLES:
+        for length in LENGTHS:
+            pg_cur.execute("SELECT song_match_key(%s, %s, CAST(ROUND(CAST(%s AS NUMERIC)) AS BIGINT))",
+                           (title, artist, length))
+            assert pg_cur.fetchone()[0] == song_match_key(title, artist, event_length_key(length), normalization), \
+                (title, artist, length)
+
+
+@pytest.mark.parametrize('normalization', sorted(match_normalizations))
+def test_song_key_matches_sql(pg_cur, normalization):
+    normalize = match_normalizations[normalization]
+    pg_cur.execute(song_match_key_create.format(title=normalize.format('title'), artist=normalize.format('artist'),
+                                                normalization=normalization))
+    for title, artist in TITLES:
+        for duration in DURATIONS:
+            # songs.duration is NUMERIC(12,2) and the trigger rounds it to the key
+            pg_cur.execute("SELECT song_match_key(%s, %s, ROUND(CAST(%s AS NUMERIC(12,2)))::BIGINT)",
+                           (title, artist, duration))
+            assert pg_cur.fetchone()[0] == song_match_key(title, artist, song_duration_key(duration), normalization), \
+                (title, artist, duration)
+
+
+def test_song_key_matches_sqlite():
+    conn = sinks.SQLiteConnection(':memory:')
+    cur = conn.cursor()
+    for query in (artist_table_create, sqlite_song_table_create, sqlite_song_match_key_trigger_create):
+        cur.execute(query)
+    for i, (title, artist) in enumerate(TITLES):
+        cur.execute(artist_table_insert, (f'A{i}', artist, None, None, None))
+        for j, duration in enumerate(DURATIONS):
+            # the trigger fills songs.match_key (SQLite has no normalization option - always 'exact')
+            cur.execute(song_table_insert, (f'S{i}_{j}', title, f'A{i}', 2018, duration))
+            cur.execute("SELECT match_key FROM songs WHERE song_id = ?", (f'S{i}_{j}',))
+            assert cur.fetchone()[0] == song_match_key(title, artist, song_duration_key(duration)), \
+                (title, artist, duration)
+    conn.close()
@@ -0,0 +1,102 @@
+# test_user_history.py
+#
+# PURPOSE: The users dimension and user_history must not depend on the order the events are loaded in - files loaded out
+#          of date order, late files and reloaded files give the same latest state and the same versions.
+#
+
+from datetime import datetime
+import pytest
+from etl import latest_user_rows, write_user_rows
+from user_history import UserHistory, event_time, user_versions
+
+FREE = ('Lily', 'Koch', 'F', 'free')
+PAID = ('Lily', 'Koch', 'F', 'paid')
+
+# four files of events of users 15 and 8 - user 15 goes free -> paid -> free, user 8 free -> paid
+BATCHES = [[(15, *FREE, 1541100000000), (15, *FREE, 1541100100000), (8, 'Kaylee', 'Summers', 'F', 'free', 1541100200000)],
+           [(15, *PAID, 1541200000000), (15, *PAID, 1541200100000)],
+           [(15, *FREE, 1541300000000), (8, 'Kaylee', 'Summers', 'F', 'paid', 1541300100000)],
+           [(15, *FREE, 1541400000000), (8, 'Kaylee', 'Summers', 'F', 'paid', 1541400100000)]]
+
+
+def test_latest_user_rows_picks_the_latest_event_by_ts():
+    rows = [(15, *PAID, 300), (8, 'Kaylee', 'Summers', 'F', 'free', 100), (15, *FREE, 100), (15, *FREE, 200)]
+    assert latest_user_rows(rows) == [(8, 'Kaylee', 'Summers', 'F', 'free'), (15, *PAID)]
+    assert latest_user_rows(list(reversed(rows))) == latest_user_rows(rows)
+    assert latest_user_rows([(15, *FREE, 300), (15, *PAID, 300)]) == [(15, *PAID)]    # same ts - the later event wins
+
+
+def test_user_versions_out_of_order():
+    t = [datetime(2018, 11, day) for day in range(1, 7)]
+    events = [(FREE, t[0]), (FREE, t[1]), (PAID, t[2]), (PAID, t[3]), (FREE, t[4]), (FREE, t[5])]
+    in_order = user_versions([], events)
+    assert in_order == [(FREE, t[0], t[2], t[1]), (PAID, t[2], t[4], t[3]), (FREE, t[4], None, t[5])]
+    
+    def stored(versions):
+        return [(attributes, valid_from, last_seen) for attributes, valid_from, valid_to, last_seen in versions]
+    
+    # every split of the events into an earlier and a later loaded part gives the same versions
+    for split in range(len(events) + 1):
+        for first, then in ((events[:split], events[split:]), (events[split:], events[:split])):
+            assert user_versions(stored(user_versions([], first)), then) == in_order, (first, then)
+    
+    # events inside a version with the state of that version change nothing (a reloaded file)
+    assert user_versions(stored(in_order), [(PAID, t[3]), (FREE, t[1])]) == in_order
+    
+    # a newer event with the current state only moves last_seen
+    later = datetime(2018, 11, 7)
+    assert user_versions(stored(in_order), [(FREE, later)]) == in_order[:2] + [(FREE, t[4], None, later)]
+
+
+@pytest.fixture
+def history_cur(pg_cur):
+    """pg_cur with empty users and user_history tables of its own (temporary tables hide the ones of sparkifydb)"""
+    
+    pg_cur.execute("""
+        CREATE TEMP TABLE users(user_id INT PRIMARY KEY, first_name VARCHAR, last_name VARCHAR, gender VARCHAR,
+                                level VARCHAR);
+        CREATE TEMP TABLE user_history(user_id INT NOT NULL, first_name VARCHAR, last_name VARCHAR, gender VARCHAR,
+                                       level VARCHAR, valid_from TIMESTAMP NOT NULL, valid_to TIMESTAMP,
+                                       last_seen TIMESTAMP NOT NULL, PRIMARY KEY (user_id, valid_from));
+        CREATE UNIQUE INDEX ON user_history (user_id) WHERE valid_to IS NULL;
+        """)
+    return pg_cur
+
+
+def load(cur, batches):
+    """write the batches like the row load mode does and return the resulting users and user_history"""
+    
+    cur.execute("TRUNCATE users, user_history")
+    user_history = UserHistory()
+    for batch in batches:
+        write_user_rows(cur, batch, user_history)
+    cur.execute("SELECT * FROM users ORDER BY user_id")
+    users = cur.fetchall()
+    cur.execute("SELECT * FROM user_history ORDER BY user_id, valid_from")
+    return users, cur.fetchall(), user_history.versions
+
+
+def test_history_does_not_depend_on_the_load_order(history_cur):
+    expected_users, expected_history, versions = load(history_cur, BATCHES)
+    assert expected_users == [(8, 'Kaylee', 'Summers', 'F', 'paid'), (15, *FREE)]
+    assert [row[4:] for row in expected_history] == [
+        ('free', event_time(1541100200000), event_time(1541300100000), event_time(1541100200000)),
+        ('paid', event_time(1541300100000), None, event_time(1541400100000)),
+        ('free', event_time(1541100000000), event_time(1541200000000), event_time(1541100100000)),
+        ('paid', event_time(1541200000000), event_time(1541300000000), event_time(1541200100000)),
+        ('free', event_time(1541300000000), None, event_time(1541400000000))]
+    assert versions == 5
+
+    # reversed, the oldest file last, a late file in the gap after a version and one splitting a version between two files
+    for order in ((3, 2, 1, 0), (1, 2, 3, 0), (0, 1, 3, 2), (0, 2, 1, 3)):
+        users, history, versions = load(history_cur, [BATCHES[i] for i in order])
+        assert users == expected_users, order
+        # last_seen of a version split by a late file is the last event of the version known before it
+        assert [row[:7] for row in history] == [row[:7] for row in expected_history], order
+
+
+def test_reloading_a_batch_writes_nothing(history_cur):
+    load(history_cur, BATCHES)
+    user_history = UserHistory()
+    for batch in BATCHES:
+        assert user_history.write(history_cur, batch) == 0
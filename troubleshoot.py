@@ -1,9 +1,28 @@
 # analyze test data for relationship between logs and artist-songs
+#
+# Included functions:
+#     get_files          - get all json files found under a directory
+#     setup              - (re)create the sparkify database for the database analysis
+#     analyze_database   - load logs and songs row by row into work tables and count the matches with SQL (destructive)
+#     read_log_events    - read the NextSong events of all log files into a dataframe
+#     read_song_records  - read the records of all song files into a dataframe
+#     match_flags        - flag the log events whose key columns occur in the songs (vectorized hash join)
+#     analyze_in_memory  - count the same matches plus rounded, case folded and near matches in memory without a database
+#     main               - run one of the analyses
+#
 
 import os
 import glob
-import psycopg2
 import json
+import string
+import argparse
+from time import time
+import numpy as np
+import pandas as pd
+import sinks
+from compression import open_compressed, source_patterns
+
+_ascii_lower = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
 
 def get_files(filepath):
     all_files = []
@@ -15,25 +34,13 @@ def get_files(filepath):
     return all_files    
 
 def setup():
-    # connect to default database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=studentdb user=student password=student")
-    conn.set_session(autocommit=True)
-    cur = conn.cursor()
-
-    # create sparkify database with UTF8 encoding
-    cur.execute("DROP DATABASE IF EXISTS sparkifydb")
-    cur.execute("CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
-
-    # close connection to default database
-    conn.close()
-
-    # connect to sparkify database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
-    cur = conn.cursor()
+    # (re)create sparkify database - the queries below are Postgres specific so always use the postgres sink
+    cur, conn = sinks.create_database('postgres')
+    conn.set_session(autocommit=False)
 
     return conn, cur
     
-def main():
+def analyze_database():
 
     log_table_create = ("""
     CREATE TABLE IF NOT EXISTS log_work(
@@ -201,6 +208,124 @@ def main():
     conn.close()
 
 
+def read_log_events(filepath):
+    """
+    Read the NextSong events of all log files (json lines, optionally compressed) into a dataframe
+    Parameters:
+      filepath - directory of the log files
+    """
+    
+    frames = []
+    for pattern in source_patterns('*.json'):
+        for datafile in sorted(glob.glob(os.path.join(filepath, '**', pattern), recursive=True)):
+            with open_compressed(datafile) as f:
+                # object keeps numeric looking titles as text and nulls as missing (str would turn them into 'None')
+                frames.append(pd.read_json(f, lines=True, dtype={'artist': object, 'song': object}))
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['page', 'artist', 'song', 'length'])
+    return df[df['page'] == 'NextSong'].reset_index(drop=True)
+
+
+def read_song_records(filepath):
+    """
+    Read the records of all song files (one json record per line, optionally compressed) into a dataframe - the files are 
+    tiny so they are parsed with the json library and turned into columns once
+    Parameters:
+      filepath - directory of the song files
+    """
+    
+    records = []
+    for pattern in source_patterns('*.json'):
+        for datafile in glob.glob(os.path.join(filepath, '**', pattern), recursive=True):
+            with open_compressed(datafile) as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+    return pd.DataFrame.from_records(records, columns=['song_id', 'title', 'artist_id', 'artist_name', 'duration'])
+
+
+def match_flags(log_keys, song_keys):
+    """
+    Flag the log events whose key columns occur in the songs - a left hash join against the distinct song keys. Missing
+    values never match, as in SQL.
+    Parameters:
+      log_keys - dataframe of the key columns of the log events
+      song_keys - dataframe of the same key columns (same names) of the songs
+    Returns:
+      boolean numpy array with one flag per log event
+    """
+    
+    columns = list(log_keys.columns)
+    distinct = song_keys.dropna().drop_duplicates().assign(_matched=True)
+    merged = log_keys.merge(distinct, how='left', on=columns, sort=False)
+    return merged['_matched'].notna().to_numpy() & log_keys.notna().all(axis=1).to_numpy()
+
+
+def analyze_in_memory(log_path, song_path):
+    """
+    Count how many log events match a song without touching the database: exactly on (artist, title, duration) as the 
+    database analysis does, on the rounded duration as the ETL matches them (song_lookup.song_match_key), additionally 
+    ignoring case and whitespace (create_tables.py --match-normalization fold) and the near misses that agree on two of 
+    the three fields
+    Parameters:
+      log_path - directory of the log files
+      song_path - directory of the song files
+    """
+    
+    start_time = time()
+    events = read_log_events(log_path)
+    songs = read_song_records(song_path)
+    print(f'Read {len(events)} NextSong events and {len(songs)} song records in {time() - start_time:.1f}s.')
+    
+    # exact keys: the json values as they are
+    log_exact = pd.DataFrame({'artist': events['artist'], 'title': events['song'], 'duration': events['length']})
+    song_exact = pd.DataFrame({'artist': songs['artist_name'], 'title': songs['title'], 'duration': songs['duration']})
+    
+    # rounded keys: durations rounded the way song_lookup.song_duration_key and event_length_key do
+    song_duration = np.floor(songs['duration'].astype(float) * 100 + 0.5) / 100        # NUMERIC(12,2), half up
+    log_rounded = log_exact.assign(duration=np.floor(events['length'].astype(float) + 0.5))    # NUMERIC, half up
+    song_rounded = song_exact.assign(duration=np.floor(song_duration + 0.5))
+    
+    # folded keys: lower case and collapsed whitespace in ASCII only, like the 'fold' match normalization
+    def fold(values):
+        return values.str.replace(r'[ \t\n\r\f\v]+', ' ', regex=True).str.translate(_ascii_lower).str.strip(' ')
+    log_folded = log_rounded.assign(artist=fold(log_rounded['artist']), title=fold(log_rounded['title']))
+    song_folded = song_rounded.assign(artist=fold(song_rounded['artist']), title=fold(song_rounded['title']))
+    
+    exact = match_flags(log_exact, song_exact)
+    rounded = match_flags(log_rounded, song_rounded)
+    folded = match_flags(log_folded, song_folded)
+    
+    print('Number of song records:', len(songs))
+    print('Number of log records:', len(events))
+    print('Number of distinct songs in log records:', len(log_exact.dropna().drop_duplicates()))
+    print('Number of song records matched from log records:', int(exact.sum()))
+    print('Number of log records matched on the rounded duration (ETL match key):', int(rounded.sum()))
+    print('Number of log records matched on the rounded duration ignoring case and whitespace:', int(folded.sum()))
+    
+    # near misses: events the ETL does not match that agree with a song on two of the three (folded, rounded) fields
+    unmatched = ~folded
+    for field, pair in (('duration', ['artist', 'title']), ('artist', ['title', 'duration']), ('title', ['artist', 'duration'])):
+        near = match_flags(log_folded[pair], song_folded[pair]) & unmatched
+        print(f'Number of unmatched log records differing only in {field}:', int(near.sum()))
+    
+    if exact.any():
+        print('Matched row:', tuple(events.loc[exact.argmax(), ['artist', 'song', 'length', 'userId', 'ts']]))
+    print(f'Analysis took {time() - start_time:.1f}s.')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyze how many log events match a song in the song files.')
+    parser.add_argument('--database', action='store_true',
+                        help="load both sources row by row into work tables of a recreated sparkifydb and count the matches "
+                             "with SQL (slow and destructive - the default analyses in memory without a database)")
+    parser.add_argument('--log-path', default='data/log_data', help="directory of the log files")
+    parser.add_argument('--song-path', default='data/song_data', help="directory of the song files")
+    args = parser.parse_args()
+    
+    if args.database:
+        analyze_database()
+    else:
+        analyze_in_memory(args.log_path, args.song_path)
+
+
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,127 @@
+# user_history.py
+#
+# PURPOSE: Optional type 2 history of the users dimension. users keeps the latest state of every user (type 1) while
+#          user_history keeps one version per change of name, gender or level with its valid_from/valid_to period, so the
+#          free -> paid transitions survive the upserts. Only changes are written, never one row per event.
+#
+# Included functions:
+#     event_time    - convert a log/event ts value (milliseconds since the epoch) to a timestamp
+#     user_versions - merge the versions of a user with new events into the user's versions
+#     UserHistory   - class: writes the versions of user_history for batches of user rows
+#
+
+from datetime import datetime, timedelta
+from sql_queries import user_history_exists_select, user_history_select, user_history_delete, user_history_upsert, \
+                        user_table_insert
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def event_time(ts):
+    """
+    Convert a log/event ts value to a timestamp
+    Parameters:
+      ts - milliseconds since the epoch (UTC)
+    """
+    
+    return EPOCH + timedelta(milliseconds=int(ts))
+
+
+def user_versions(versions, events):
+    """
+    Merge the versions of a user with new events of the user. Every version counts as two events, at its valid_from and at
+    its last_seen. The events are put in ts order (a new event wins over a version at the same ts) and each run of events
+    with the same state becomes one version - so the result does not depend on the order the events are loaded in.
+    Parameters:
+      versions - list of (attributes, valid_from, last_seen) of the user's versions, attributes being (first_name, 
+                 last_name, gender, level)
+      events - list of (attributes, ts) of the new events
+    Returns:
+      list of (attributes, valid_from, valid_to, last_seen) in valid_from order - the current version has valid_to None
+    """
+    
+    timeline = {}
+    for attributes, valid_from, last_seen in versions:
+        timeline[valid_from] = timeline[last_seen] = attributes
+    timeline.update((ts, attributes) for attributes, ts in events)
+    
+    runs = []
+    for ts in sorted(timeline):
+        if runs and timeline[ts] == runs[-1][0]:
+            runs[-1][2] = ts
+        else:
+            runs.append([timeline[ts], ts, ts])
+    valid_to = [valid_from for attributes, valid_from, last_seen in runs[1:]] + [None]
+    return [(attributes, valid_from, end, last_seen) for (attributes, valid_from, last_seen), end in zip(runs, valid_to)]
+
+
+class UserHistory:
+    """
+    Writes user_history from batches of user rows (user_id, first_name, last_name, gender, level, ts). The versions of the
+    users in a batch are read with one query and merged with the batch's events by ts (the last event wins when a user has
+    several at the same ts, see user_versions). Only the versions that change are written: versions whose start moved are
+    deleted and the new or changed ones are upserted. Events older than a user's current version are placed by their ts
+    too, so files loaded out of date order give the same history, and reloading a file that was already loaded writes
+    nothing. The batch's users must be upserted before: a user with a newer event than the batch's is set back to the
+    state of that event.
+    """
+    
+    def __init__(self):
+        self.versions = 0        # versions written
+    
+    @classmethod
+    def load(cls, cur):
+        """
+        Check whether the database keeps user history
+        Parameters:
+          cur - cursor
+        Returns:
+          UserHistory or None when there is no user_history table (see create_tables.py --user-history)
+        """
+        
+        cur.execute(user_history_exists_select)
+        return cls() if (cur.fetchone() or [None])[0] else None
+    
+    def write(self, cur, user_rows):
+        """
+        Write the versions for a batch of user rows
+        Parameters:
+          cur - cursor
+          user_rows - list of (user_id, first_name, last_name, gender, level, ts) tuples in any order
+        Returns:
+          number of versions written
+        """
+        
+        if not user_rows:
+            return 0
+        latest = {(int(user_data[0]), int(user_data[5])): user_data for user_data in user_rows}    # last event per ts wins
+        events = {}
+        for (user_id, ts), user_data in sorted(latest.items()):
+            events.setdefault(user_id, []).append((tuple(user_data[1:5]), event_time(ts)))
+        
+        cur.execute(user_history_select, (sorted(events),))
+        current = {}
+        for user_id, *attributes, valid_from, valid_to, last_seen in cur.fetchall():
+            current.setdefault(user_id, {})[valid_from] = (tuple(attributes), valid_from, valid_to, last_seen)
+        
+        deletes, upserts, restores, written = [], [], [], 0
+        for user_id, user_events in sorted(events.items()):
+            versions = current.get(user_id, {})
+            merged = user_versions([(attributes, valid_from, last_seen) 
+                                    for attributes, valid_from, valid_to, last_seen in versions.values()], user_events)
+            starts = {version[1] for version in merged}
+            deletes.extend((user_id, valid_from) for valid_from in versions if valid_from not in starts)
+            for version in merged:
+                if versions.get(version[1]) != version:
+                    upserts.append((user_id,) + version[0] + version[1:])
+                    written += version[1] not in versions
+            latest_state, latest_ts = merged[-1][0], merged[-1][3]
+            if latest_ts > user_events[-1][1] and latest_state != user_events[-1][0]:    # the batch is not the latest
+                restores.append((user_id,) + latest_state)
+        
+        # close versions before a new current version is written (see user_history_current_idx)
+        cur.executemany(user_history_delete, deletes)
+        cur.executemany(user_history_upsert, sorted(upserts, key=lambda version: version[6] is None))
+        cur.executemany(user_table_insert, restores)
+        self.versions += written
+        return written